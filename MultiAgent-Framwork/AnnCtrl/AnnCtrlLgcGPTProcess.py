@@ -4,9 +4,11 @@ import copy
 from datetime import datetime
 import configparser
 import os
-from openai import OpenAI
 import yaml
 
+from LLMConnect import LLMCon
+from LLMConnect import LLMKeyPool
+
 print("Current working directory:", os.getcwd())
 
 config = configparser.ConfigParser()
@@ -19,8 +21,8 @@ print("Config sections found:", config.sections())
 
 if 'OpenAI' not in config:
     print("Error: 'OpenAI' section not found in config.ini")
-openai_key = config['OpenAI']['key']
-client = OpenAI(api_key=openai_key)
+openai_keys = LLMKeyPool.keys_from_config(config['OpenAI'], 'key')
+client = LLMCon.make_client(openai_keys)
 
 
 yaml_path = os.path.join(base_dir, 'char_config.yaml')
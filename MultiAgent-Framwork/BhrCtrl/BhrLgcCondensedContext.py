@@ -0,0 +1,147 @@
+import sys
+import os
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the base directory (one level up from the current directory)
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(base_dir)
+
+from DBConnect import DBCon
+from DBConnect import BhrDBCondensedContext
+
+import BhrLgcGPTProcess
+from LLMConnect import LLMRateLimit
+from LLMConnect import LLMPrompt
+
+# Per-NPC condensed context.
+# A short rolling summary of each NPC (situation, relationships, goals, recent
+# events) is kept in behavior_condensed_context, next to the reflection stream.
+# It is rewritten in the background, off the request path, once a few new
+# memories or a new reflection have been written, by folding only those into
+# the previous summary. Decision and talk prompts then carry the summary and a
+# handful of the most relevant memories instead of the raw reflection and up to
+# 30 memories.
+# Settings come from the optional [CondensedContext] section of config.ini:
+#   enabled = true
+#   update_every = 5          new memories before the summary is rewritten
+#   memories_in_prompt = 8    most relevant memories still sent with the summary
+#   max_words = 200           length of the summary
+
+config = configparser.ConfigParser()
+config.read(os.path.join(base_dir, 'config.ini'))
+
+ENABLED = config.getboolean('CondensedContext', 'enabled', fallback=True)
+UPDATE_EVERY = config.getint('CondensedContext', 'update_every', fallback=5)
+MEMORIES_IN_PROMPT = config.getint('CondensedContext', 'memories_in_prompt', fallback=8)
+MAX_WORDS = config.getint('CondensedContext', 'max_words', fallback=200)
+
+
+class CondensedContextStore:
+
+    def __init__(self, update_every=UPDATE_EVERY, max_words=MAX_WORDS):
+        self.update_every = update_every
+        self.max_words = max_words
+        self.lock = threading.Lock()
+        self.entries = {}             # npcId -> condensed context, None when there is none yet
+        self.pending_memories = {}    # npcId -> [(time, memory text)] written since the last update
+        self.pending_reflection = {}  # npcId -> (time, reflection text) written since the last update
+        self.running = set()
+        self.table_checked = False
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="CondensedContext")
+
+    def _with_connection(self, action):
+        db_conn = DBCon.establish_sql_connection()
+        try:
+            if not self.table_checked:
+                if not BhrDBCondensedContext.table_exists(db_conn):
+                    BhrDBCondensedContext.create_table(db_conn)
+                self.table_checked = True
+            return action(db_conn)
+        finally:
+            if db_conn and DBCon.is_connected(db_conn):
+                DBCon.close_sql_connection(db_conn)
+
+    def get(self, npcId):
+        """
+        Returns the condensed context of the NPC, or None if it has none yet.
+        Read from the database once per process, then kept up to date in memory.
+        """
+        with self.lock:
+            if npcId in self.entries:
+                return self.entries[npcId]
+        try:
+            entry = self._with_connection(lambda db_conn: BhrDBCondensedContext.retrieve_entry(db_conn, npcId))
+        except Exception as e:
+            # Decide on the raw memories this time rather than fail the request
+            print(f"Method: CondensedContextStore | npcId: {npcId} | Could not read the condensed context: {e}")
+            return None
+        content = entry[1] if entry else None
+        with self.lock:
+            return self.entries.setdefault(npcId, content)
+
+    def note_memory(self, npcId, time, memory_str):
+        with self.lock:
+            self.pending_memories.setdefault(npcId, []).append((time, memory_str))
+        self._schedule(npcId)
+
+    def note_reflection(self, npcId, time, reflection_str):
+        with self.lock:
+            self.pending_reflection[npcId] = (time, reflection_str)
+        self._schedule(npcId)
+
+    def _schedule(self, npcId):
+        if not ENABLED:
+            return
+        with self.lock:
+            due = (len(self.pending_memories.get(npcId, [])) >= self.update_every
+                   or npcId in self.pending_reflection)
+            if not due or npcId in self.running:
+                return
+            self.running.add(npcId)
+        self.executor.submit(self._update, npcId)
+
+    def _update(self, npcId):
+        with self.lock:
+            memories = self.pending_memories.pop(npcId, [])
+            reflection = self.pending_reflection.pop(npcId, None)
+        try:
+            prior = self.get(npcId)
+            memories_str = "\n".join(memory for time, memory in memories)
+            reflection_str = reflection[1] if reflection else ''
+            with LLMRateLimit.priority(LLMRateLimit.PRIORITY_LOW):
+                condensed = BhrLgcGPTProcess.updateCondensedContext(prior, memories_str, reflection_str, npcId, self.max_words)
+            times = [time for time, memory in memories] + ([reflection[0]] if reflection else [])
+            self._with_connection(lambda db_conn: BhrDBCondensedContext.insert_into_table(db_conn, npcId, max(times), condensed))
+            with self.lock:
+                self.entries[npcId] = condensed
+            print(f"Method: CondensedContextStore | npcId: {npcId} | Folded {len(memories)} memories"
+                  f"{' and a reflection' if reflection else ''} into the condensed context")
+        except Exception as e:
+            print(f"Method: CondensedContextStore | npcId: {npcId} | Update failed: {e}")
+            # Keep the notes for the next update
+            with self.lock:
+                self.pending_memories[npcId] = memories + self.pending_memories.get(npcId, [])
+                if reflection and npcId not in self.pending_reflection:
+                    self.pending_reflection[npcId] = reflection
+        finally:
+            with self.lock:
+                self.running.discard(npcId)
+
+
+store = CondensedContextStore()
+
+
+def decision_context(memories_str, reflection_str, condensed_str):
+    """
+    Memories and reflection text for the decision and talk prompts: the most relevant
+    memories and the condensed context when the NPC has one, the raw ones otherwise.
+    """
+    if not ENABLED or not condensed_str:
+        return memories_str, reflection_str
+    if isinstance(memories_str, LLMPrompt.RankedText) and len(memories_str.lines) > MEMORIES_IN_PROMPT:
+        best = sorted(range(len(memories_str.lines)), key=lambda i: memories_str.scores[i], reverse=True)[:MEMORIES_IN_PROMPT]
+        best.sort()
+        memories_str = LLMPrompt.RankedText([memories_str.lines[i] for i in best], [memories_str.scores[i] for i in best])
+    return memories_str, condensed_str
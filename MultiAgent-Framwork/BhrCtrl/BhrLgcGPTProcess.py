@@ -6,7 +6,22 @@ import os
 import yaml
 import random
 
-from openai import OpenAI
+
+try:
+    import BhrLgcSchedule
+    import BhrLgcInstSchema
+    import BhrLgcPersona
+except ImportError:
+    # Imported as BhrCtrl.BhrLgcGPTProcess from the other controllers
+    from BhrCtrl import BhrLgcSchedule
+    from BhrCtrl import BhrLgcInstSchema
+    from BhrCtrl import BhrLgcPersona
+
+from LLMConnect import LLMCon
+from LLMConnect import LLMKeyPool
+from LLMConnect import LLMCache
+from LLMConnect import LLMEmbBatch
+from LLMConnect import LLMPrompt
 
 print("Current working directory:", os.getcwd())
 
@@ -20,30 +35,26 @@ print("Config sections found:", config.sections())
 
 if 'OpenAI' not in config:
     print("Error: 'OpenAI' section not found in config.ini")
-openai_key = config['OpenAI']['chatgpt_key']
-# deepseek_key1 = config['OpenAI']['deepseek_key']
-# deepseek_key2 = config['OpenAI']['deepseek_key2']
-# deepseek_key = random.choice([
-#     config['OpenAI']['deepseek_key'],
-#     config['OpenAI']['deepseek_key2']
-# ])
-deepseek_key=config['OpenAI']['deepseek_key']
+# Every provider can have several keys (deepseek_key, deepseek_key2, ... or deepseek_keys = a, b),
+# the calls are balanced over them by the key pool of LLMCon
+openai_keys = LLMKeyPool.keys_from_config(config['OpenAI'], 'chatgpt_key')
+deepseek_keys = LLMKeyPool.keys_from_config(config['OpenAI'], 'deepseek_key')
 
-google_key=config['OpenAI']['google_key']
+google_keys = LLMKeyPool.keys_from_config(config['OpenAI'], 'google_key')
 
 is_chatgpt = config['OpenAI'].getboolean('useChatGPT', fallback=True)
 is_google = config['OpenAI'].getboolean('useGoogle', fallback=False)
 if is_chatgpt:
     print("Using ChatGPT API")
-    client = OpenAI(api_key=openai_key)
-    client_embedding = OpenAI(api_key=openai_key)
+    chat_base_url = None
+    chat_api_keys = openai_keys
     model_small = "gpt-4o-mini"
     model_large = "gpt-4o"
 elif is_google:
     print("Using Google API")
-    # client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=deepseek_key) 
-    client = OpenAI(base_url="https://generativelanguage.googleapis.com/v1beta/openai/", api_key=google_key) 
-    client_embedding = OpenAI(api_key=openai_key)
+    # chat_base_url = "https://openrouter.ai/api/v1"
+    chat_base_url = "https://generativelanguage.googleapis.com/v1beta/openai/"
+    chat_api_keys = google_keys
 
     # model_small = "deepseek/deepseek-r1-distill-llama-70b"
     # model_large = "deepseek/deepseek-r1-distill-llama-70b"
@@ -51,15 +62,30 @@ elif is_google:
     model_large = "gemini-2.5-flash"
 else:
     print("Using DeepSeek API")
-    # client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=deepseek_key) 
-    client = OpenAI(base_url="https://api.deepseek.com", api_key=deepseek_key) 
-    client_embedding = OpenAI(api_key=openai_key)
+    # chat_base_url = "https://openrouter.ai/api/v1"
+    chat_base_url = "https://api.deepseek.com"
+    chat_api_keys = deepseek_keys
 
     # model_small = "deepseek/deepseek-r1-distill-llama-70b"
     # model_large = "deepseek/deepseek-r1-distill-llama-70b"
     model_small = "deepseek-chat"
     model_large = "deepseek-chat"
 
+# The async variant (BhrLgcGPTProcessAsync) builds its clients from the same settings.
+# All clients share the process-wide connection pool of LLMCon.
+client = LLMCon.make_client(chat_api_keys, chat_base_url)
+client_embedding = LLMCon.make_client(openai_keys)
+# Slow or failing chat calls are raced against the [Hedge] fallback provider, if configured
+keys_by_provider = {'openai': openai_keys, 'google': google_keys, 'deepseek': deepseek_keys}
+LLMCon.configure_fallback(client, keys_by_provider, model_small, model_large)
+
+def create_embeddings(texts, model):
+    response = client_embedding.embeddings.create(input = texts, model=model)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+# Concurrent get_embedding calls from all worker threads share batched requests
+embedding_batcher = LLMEmbBatch.EmbeddingBatcher(create_embeddings)
+
 
 yaml_path = os.path.join(base_dir, 'char_config.yaml')
 
@@ -108,16 +134,56 @@ def get_npc_id_mapping():
         mappings.append(f"{npc['npcId']} : {npc['name']}")
     return "\n".join(mappings)
 
+def get_other_npc_ids(npcId):
+    # Ids an NPC can find or talk to
+    return [npc['npcId'] for npc in char_config.get("npcCharacters", []) if npc['npcId'] != npcId]
+
+# Static prompt blocks of every NPC, compiled once from char_config.yaml
+personas = BhrLgcPersona.compile_personas(char_config, get_npc_descriptions, get_npc_id_mapping())
+
+def get_persona(npcId):
+    persona = personas.get(npcId)
+    if persona is None:
+        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
+    return persona
+
+
+############################################
+# Model Call Driver
+############################################
+
+# Every prompt function below is written once as a generator ("<name>_steps")
+# that yields the keyword arguments of each chat.completions.create call and
+# receives the completion back. run_steps drives it with the blocking client;
+# BhrLgcGPTProcessAsync drives the very same generators with the async client.
+
+def run_steps(steps):
+    try:
+        request = next(steps)
+        while True:
+            completion = client.chat.completions.create(**request)
+            request = steps.send(completion)
+    except StopIteration as stop:
+        return stop.value
+
 
 ############################################
 # Memory and Reflection Related Functions
 ############################################
 
 def get_embedding(text, model="text-embedding-3-small"):
-    text = str(text.replace("\n", " "))
-    return client_embedding.embeddings.create(input = text, model=model).data[0].embedding
+    # Served from the shared embedding cache, misses are batched with the other threads' texts
+    return LLMCache.embedding_cache.get_or_create(
+        text, model, lambda input_text: embedding_batcher.embed(input_text, model)
+    )
 
-def get_importance(mem_single_str):
+def get_embeddings(texts, model="text-embedding-3-small"):
+    # Embeds a list of texts, with at most one request for all the cache misses
+    return LLMCache.embedding_cache.get_or_create_many(
+        texts, model, lambda input_texts: embedding_batcher.embed_many(input_texts, model)
+    )
+
+def get_importance_steps(mem_single_str):
     prompt = f'''
     On the scale of 1 to 10, where 1 is purely mundane (e.g., brushing teeth, making bed) 
     and 10 is extremely poignant (e.g., a breakup, college acceptance), 
@@ -130,7 +196,7 @@ def get_importance(mem_single_str):
 
     Just give me a number with no extra text.
     '''
-    completion = client.chat.completions.create(
+    completion = yield dict(
         model=model_large,
         messages=[
             {
@@ -165,7 +231,94 @@ def get_importance(mem_single_str):
     
     return importance
 
-def condenseMemoriesAndReflections(npc_name, npc_description, npc_context, recent_schedule_str, memories_str, reflections_str):
+def get_importance(mem_single_str):
+    # Memoized process-wide, concurrent requests for the same text share one call
+    return LLMCache.importance_cache.get_or_compute(
+        LLMCache.text_key(mem_single_str, "importance:" + model_large),
+        lambda: run_steps(get_importance_steps(mem_single_str))
+    )
+
+def get_importance_batch_steps(mem_strs):
+    # Scores already memoized are reused, the others are rated together in one call
+    keys = [LLMCache.text_key(mem_str, "importance:" + model_large) for mem_str in mem_strs]
+    importances = [LLMCache.importance_cache.get(key) for key in keys]
+    to_score = list(dict.fromkeys(mem_str for mem_str, importance in zip(mem_strs, importances) if importance is None))
+
+    scored = {}
+    if len(to_score) == 1:
+        scored[to_score[0]] = yield from get_importance_steps(to_score[0])
+    elif to_score:
+        memories_list = "\n".join(f"{i}. {mem_str}" for i, mem_str in enumerate(to_score, start=1))
+        prompt = f'''
+    On the scale of 1 to 10, where 1 is purely mundane (e.g., brushing teeth, making bed) 
+    and 10 is extremely poignant (e.g., a breakup, college acceptance), 
+    rate the likely poignancy of each of the following {len(to_score)} pieces of memory, independently.
+
+    Memories:
+    {memories_list}
+
+    Output only one JSON object that can be loaded using `json.loads()`, in this format:
+    {{"ratings": [<one integer from 1 to 10 per memory, in the same order>]}}
+    '''
+        completion = yield dict(
+            model=model_large,
+            response_format={"type": "json_object"},
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "You are a good instruction-to-language translator. "
+                        "You will process the information given to you and "
+                        "give instruction in a fixed format."
+                    )
+                },
+                {"role": "user", "content": prompt}
+            ]
+        )
+        raw_output = completion.choices[0].message.content.strip()
+
+        print("Function: get_importance_batch")
+        print("Prompt:")
+        print(prompt)
+        print("Raw Output:")
+        print(raw_output)
+        print("\n\n")
+
+        try:
+            ratings = json.loads(raw_output.replace('```json', '').replace('```', '')).get('ratings', [])
+        except (ValueError, AttributeError):
+            ratings = []
+        if isinstance(ratings, list) and len(ratings) == len(to_score):
+            for mem_str, rating in zip(to_score, ratings):
+                try:
+                    rating = int(rating)
+                except (ValueError, TypeError):
+                    continue
+                if 1 <= rating <= 10:
+                    scored[mem_str] = rating
+
+        # Items the batch didn't rate properly are scored one by one
+        for mem_str in to_score:
+            if mem_str not in scored:
+                scored[mem_str] = yield from get_importance_steps(mem_str)
+
+    for mem_str, importance in scored.items():
+        LLMCache.importance_cache.put(LLMCache.text_key(mem_str, "importance:" + model_large), importance)
+    return [importance if importance is not None else scored[mem_str] for mem_str, importance in zip(mem_strs, importances)]
+
+def get_importance_batch(mem_strs):
+    """
+    Returns the importance of each memory string, in order, rating all the
+    ones not memoized yet in a single call.
+    """
+    return run_steps(get_importance_batch_steps(mem_strs))
+
+def condenseMemoriesAndReflections_steps(npc_name, npc_description, npc_context, recent_schedule_str, memories_str, reflections_str):
+    budget = LLMPrompt.PromptBudget('condense', model_large)
+    recent_schedule_str, memories_str, reflections_str = budget.fit_all(
+        schedule=recent_schedule_str, memories=memories_str, reflections=reflections_str
+    )
+
     prompt = f'''
     You are a NPC character in a simulated town.
     You are {npc_name}, {npc_description}.
@@ -183,7 +336,8 @@ def condenseMemoriesAndReflections(npc_name, npc_description, npc_context, recen
     {reflections_str}
     Please provide a condensed version of the memories and reflections, focusing on the most important and relevant details that will be used to make decision on next action.
     '''
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
       model=model_large,
       messages=[
         {"role": "system", "content": "You are a great schedule planner and instruction giver. You will process the information given to you and give instruction."},
@@ -199,7 +353,63 @@ def condenseMemoriesAndReflections(npc_name, npc_description, npc_context, recen
     print("\n\n")
     return output
 
-def needDeepTalk(memories, reflections, npc_context, npc_action, npcId):
+def condenseMemoriesAndReflections(npc_name, npc_description, npc_context, recent_schedule_str, memories_str, reflections_str):
+    return run_steps(condenseMemoriesAndReflections_steps(npc_name, npc_description, npc_context, recent_schedule_str, memories_str, reflections_str))
+
+def updateCondensedContext_steps(prior_condensed_str, new_memories_str, new_reflection_str, npcId, max_words=200):
+    """
+    Folds the memories and the reflection written since the last update into the
+    NPC's condensed context, and returns the new condensed context.
+    """
+    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
+    if not npc:
+        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
+
+    npc_name = npc['name']
+    npc_description = npc['description']
+
+    budget = LLMPrompt.PromptBudget('condense', model_small)
+    prior_condensed_str, new_memories_str, new_reflection_str = budget.fit_all(
+        condensed=prior_condensed_str, memories=new_memories_str, reflections=new_reflection_str
+    )
+
+    prompt = f'''
+    You are {npc_name}, {npc_description}.
+
+    This is the condensed context you keep about yourself, your relationships, goals and recent events:
+    {prior_condensed_str if prior_condensed_str else 'Nothing yet.'}
+
+    New memories since it was written:
+    {new_memories_str if new_memories_str else 'None.'}
+
+    New reflection since it was written:
+    {new_reflection_str if new_reflection_str else 'None.'}
+
+    Rewrite the condensed context so that it includes what matters in the new memories and reflection,
+    focusing on the details that will be used to decide your next actions and conversations.
+    Drop what is no longer relevant. Use at most {max_words} words, and give only the condensed context.
+    '''
+    budget.report(prompt)
+    completion = yield dict(
+      model=model_small,
+      messages=[
+        {"role": "system", "content": "You keep a short, up-to-date summary of a character's situation."},
+        {"role": "user", "content": prompt}
+      ]
+    )
+    output = completion.choices[0].message.content.strip()
+    print("Function: updateCondensedContext")
+    print("Prompt:")
+    print(prompt)
+    print("Output:")
+    print(output)
+    print("\n\n")
+    return output
+
+def updateCondensedContext(prior_condensed_str, new_memories_str, new_reflection_str, npcId, max_words=200):
+    return run_steps(updateCondensedContext_steps(prior_condensed_str, new_memories_str, new_reflection_str, npcId, max_words))
+
+def needDeepTalk_steps(memories, reflections, npc_context, npc_action, npcId):
     npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
     if not npc:
         raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
@@ -207,6 +417,9 @@ def needDeepTalk(memories, reflections, npc_context, npc_action, npcId):
     npc_name = npc['name']
     npc_description = npc['description']
 
+    budget = LLMPrompt.PromptBudget('generation', model_small)
+    memories, reflections = budget.fit_all(memories=memories, reflections=reflections)
+
     prompt = f"""
     You are an expert in determining narrative significance for NPC dialogues.
 
@@ -229,7 +442,8 @@ def needDeepTalk(memories, reflections, npc_context, npc_action, npcId):
     Please return "True" if a meaningful speech is warranted (e.g., when you reading, thinking, analyzing, dreaming, etc.), 
     or "False" if not.
     """
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
         model=model_small,
         messages=[
             {
@@ -256,7 +470,10 @@ def needDeepTalk(memories, reflections, npc_context, npc_action, npcId):
     else:
         return False
 
-def generate_reflection_new(memories_str, reflections_str, java_input_str, npcId):
+def needDeepTalk(memories, reflections, npc_context, npc_action, npcId):
+    return run_steps(needDeepTalk_steps(memories, reflections, npc_context, npc_action, npcId))
+
+def generate_reflection_new_steps(memories_str, reflections_str, java_input_str, npcId):
     npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
     if not npc:
         raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
@@ -266,6 +483,9 @@ def generate_reflection_new(memories_str, reflections_str, java_input_str, npcId
 
     question_1 = "Given only the information above, what are 5 most salient high-level questions we can answer about the subjects in the statements during the daily life not included in the npc current information? Moreover, what is your 3 recent goals, and 3 long terms goals? Do you want to make adjustment to your goals, and how far are you there to achieving those goals?"
 
+    budget = LLMPrompt.PromptBudget('reflection', model_large)
+    memories_str, reflections_str = budget.fit_all(memories=memories_str, reflections=reflections_str)
+
     prompt_1 = f'''
     You are {npc_name}, {npc_description}, .
 
@@ -280,7 +500,8 @@ def generate_reflection_new(memories_str, reflections_str, java_input_str, npcId
 
     {question_1}
     '''
-    completion_1 = client.chat.completions.create(
+    budget.report(prompt_1)
+    completion_1 = yield dict(
         model=model_large,
         messages=[
             {"role": "system", "content": "You are a deep thinker and reflective analyst."},
@@ -307,7 +528,7 @@ def generate_reflection_new(memories_str, reflections_str, java_input_str, npcId
 
     Just give me the insights, do not provide explanations or any other information.
     '''
-    completion_2 = client.chat.completions.create(
+    completion_2 = yield dict(
         model=model_large,
         messages=[
             {"role": "system", "content": "You are a deep thinker and reflective analyst."},
@@ -329,12 +550,24 @@ def generate_reflection_new(memories_str, reflections_str, java_input_str, npcId
     print("\n\n")
     return question_2_answer
 
+def generate_reflection_new(memories_str, reflections_str, java_input_str, npcId):
+    return run_steps(generate_reflection_new_steps(memories_str, reflections_str, java_input_str, npcId))
+
 
 ############################################
 # Scheduling Related Functions
 ############################################
 
-def onlyMostRecentSchedule(npc_context, schedule_str):
+def onlyMostRecentSchedule_steps(npc_context, schedule_str):
+    # Regular "HH:MM-HH:MM Action: details" schedules are sliced locally,
+    # the model is only asked when the schedule text can't be parsed
+    recent_schedule_str = BhrLgcSchedule.recent_schedule_slice(npc_context, schedule_str)
+    if recent_schedule_str is not None:
+        print("Function: onlyMostRecentSchedule | Local schedule slice:")
+        print(recent_schedule_str)
+        print("\n\n")
+        return recent_schedule_str
+
     prompt = f'''
     You are a NPC character in a simulated town.
     You are given the current context of the NPC and the schedule for the day.
@@ -347,7 +580,7 @@ def onlyMostRecentSchedule(npc_context, schedule_str):
 
     Please provide only the most recent schedule item from the calendar that are relevent to the context, and are need for making decision about what to do next.
     '''
-    completion = client.chat.completions.create(
+    completion = yield dict(
       model=model_small,
       messages=[
         {"role": "system", "content": "You are a great schedule planner and instruction giver. You will process the information given to you and give instruction."},
@@ -365,7 +598,10 @@ def onlyMostRecentSchedule(npc_context, schedule_str):
     print("\n\n")
     return output
 
-def generate_schedule(current_schedule, memories, reflections, npc_context, npcId):
+def onlyMostRecentSchedule(npc_context, schedule_str):
+    return run_steps(onlyMostRecentSchedule_steps(npc_context, schedule_str))
+
+def generate_schedule_steps(current_schedule, memories, reflections, npc_context, npcId):
     npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
     if not npc:
         raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
@@ -374,6 +610,11 @@ def generate_schedule(current_schedule, memories, reflections, npc_context, npcI
     npc_description = npc['description']
     npc_schedule = npc.get('schedule', [])
 
+    budget = LLMPrompt.PromptBudget('schedule', model_large)
+    current_schedule, memories, reflections = budget.fit_all(
+        schedule=current_schedule, memories=memories, reflections=reflections
+    )
+
     prompt = f"""
     You are {npc_name}, {npc_description}.
 
@@ -396,7 +637,8 @@ def generate_schedule(current_schedule, memories, reflections, npc_context, npcI
 
     Please create a new detailed schedule using 24-hour time format for the NPC for today, adapting to the current situation.
     """
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
         model=model_large,
         messages=[
             {
@@ -418,7 +660,10 @@ def generate_schedule(current_schedule, memories, reflections, npc_context, npcI
     print("\n\n")
     return output
 
-def need_new_schedule(current_schedule, memories, reflections, npc_context, npcId):
+def generate_schedule(current_schedule, memories, reflections, npc_context, npcId):
+    return run_steps(generate_schedule_steps(current_schedule, memories, reflections, npc_context, npcId))
+
+def need_new_schedule_steps(current_schedule, memories, reflections, npc_context, npcId):
     npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
     if not npc:
         raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
@@ -426,6 +671,11 @@ def need_new_schedule(current_schedule, memories, reflections, npc_context, npcI
     npc_name = npc['name']
     npc_description = npc['description']
 
+    budget = LLMPrompt.PromptBudget('schedule', model_small)
+    current_schedule, memories, reflections = budget.fit_all(
+        schedule=current_schedule, memories=memories, reflections=reflections
+    )
+
     prompt = f"""
     You are {npc_name}, {npc_description}, .
 
@@ -446,7 +696,8 @@ def need_new_schedule(current_schedule, memories, reflections, npc_context, npcI
     Based on the above, do need a new schedule for the rest of the day? 
     Respond only with 'yes' or 'no'.
     """
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
         model=model_small,
         messages=[
             {
@@ -476,32 +727,59 @@ def need_new_schedule(current_schedule, memories, reflections, npc_context, npcI
     else:
         return False
 
+def need_new_schedule(current_schedule, memories, reflections, npc_context, npcId):
+    return run_steps(need_new_schedule_steps(current_schedule, memories, reflections, npc_context, npcId))
+
 
 ############################################
 # Action Decision Functions
 ############################################
 
-def processInputGiveWhatToDo(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction = ''):
-    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
-    if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
+def fit_schedule(budget, npc_context, schedule_str):
+    # A calendar over its budget is first narrowed to the slots around the current time
+    limit = budget.budget('schedule')
+    if limit and LLMPrompt.count_tokens(schedule_str, budget.model) > limit:
+        schedule_str = BhrLgcSchedule.recent_schedule_slice(npc_context, schedule_str, next_n=6) or schedule_str
+    return budget.fit('schedule', schedule_str)
 
-    npc_name = npc['name']
-    npc_description = npc['description']
-    available_actions = npc.get('availableActions', [])
+def talk_prefix(persona, npc_descriptions):
+    # Shared by all the conversation prompts of the NPC, so they hit the same cached prefix
+    return persona.prefix('talk', lambda: f'''
+    You are a npc character in a simulated town.
+    Characters in the town:
+    {npc_descriptions}
 
-    npc_action = ""
-    for action in available_actions:
-        npc_action += (
-            f"- **{action['actionName']}**: {action['description']} (location: {action['location']})\n"
-        )
+    You are {persona.name}, {persona.description}.
+
+    Your Tone is:
+    {persona.tone_instructions}
+
+    Your examples of speaking style:
+    {persona.talk_examples}
+''')
 
-    recent_schedule_str = onlyMostRecentSchedule(npc_context, schedule_str)
+def processInputGiveWhatToDo_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction = ''):
+    persona = get_persona(npcId)
+    npc_name = persona.name
+
+    recent_schedule_str = yield from onlyMostRecentSchedule_steps(npc_context, schedule_str)
     
-    prompt = f'''
-    You are {npc_name}, {npc_description}.
+    budget = LLMPrompt.PromptBudget('decision', model_large)
+    npc_descriptions = budget.fit_static('npc_descriptions', persona.town)
+    recent_schedule_str, memories_str, reflections_str = budget.fit_all(
+        schedule=recent_schedule_str, memories=memories_str, reflections=reflections_str
+    )
+
+    # What never changes for the NPC comes first, so the provider can reuse it from its prompt cache
+    prefix = persona.prefix('processInputGiveWhatToDo', lambda: f'''
+    You are {persona.name}, {persona.description}.
     You are one of the characters in the town, here are all the characters in the town:
-    {get_npc_descriptions(npcId)}
+    {npc_descriptions}
+
+    Your available Actions:
+    {persona.decision_actions}''')
+
+    prompt = prefix + f'''
     Your recent schedule:
       {recent_schedule_str}
 
@@ -513,8 +791,7 @@ def processInputGiveWhatToDo(memories_str, reflections_str, schedule_str, npc_co
     Your reflections:
     {reflections_str}
 
-    Tell me what you should do next, choosing one (include the location) from available Actions:
-    {npc_action}
+    Tell me what you should do next, choosing one (include the location) from your available Actions above.
     {special_instruction if special_instruction else ''}
 
     What should you do next? Choose a single action. Provide your name, action name, location, duration(needs to be over 30 minutes at least, if time not allow, jump to next action on schedule), and a short explanation.
@@ -522,7 +799,8 @@ def processInputGiveWhatToDo(memories_str, reflections_str, schedule_str, npc_co
     output format and example:
         - {npc_name} using computer at the computer desk for 2 hours. He surf the internet for fishing tutorial. {npc_name} feeling none.
     '''
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
       model=model_large,
       messages=[
         {"role": "system", "content": "You are a great schedule planner and instruction giver. You will process the information give to you and give instruction."},
@@ -540,46 +818,168 @@ def processInputGiveWhatToDo(memories_str, reflections_str, schedule_str, npc_co
     print("\n\n")
     return output
 
-def talkToSomeone(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, special_instruction = '', max_tokens=20):
+def processInputGiveWhatToDo(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction = ''):
+    return run_steps(processInputGiveWhatToDo_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction))
+
+def get_npc_mode(npcId, key, default):
+    """
+    Returns a per-NPC "chain" / "fused" switch from char_config.yaml, or the default when unset.
+    """
     npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
     if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
-    
-    npc_name = npc['name']
-    npc_description = npc['description']
-    npc_way_of_speak = npc['announcements']
-    format_instructions = npc_way_of_speak.get('Format', '').lstrip('> ').strip()
-    tone_instructions = npc_way_of_speak.get('Tone', '').lstrip('> ').strip() 
-    talk_examples = npc_way_of_speak.get('Talk', '').lstrip('> ').strip()
+        return default
+    mode = str(npc.get(key, default)).strip().lower()
+    return mode if mode in ("chain", "fused") else default
 
-    recent_schedule_str = onlyMostRecentSchedule(npc_context, schedule_str)
+def get_decision_mode(npcId):
+    """
+    Returns how the next action of an idle NPC is decided, set per NPC with
+    `decisionMode` in char_config.yaml:
+    - "chain": processInputGiveWhatToDo, then the words to say, then the JSON translation (default)
+    - "fused": one structured call to decideNextActionFused
+    """
+    return get_npc_mode(npcId, 'decisionMode', 'chain')
 
+def get_talk_mode(npcId):
+    """
+    Returns how a conversation turn is produced, set per NPC with
+    `talkMode` in char_config.yaml:
+    - "chain": talkToSomeone, then shoudConversationEnd, then humanInstToJava_talk (default)
+    - "fused": one structured call to talkTurn, the JSON is assembled locally
+    """
+    return get_npc_mode(npcId, 'talkMode', 'chain')
 
-    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
-    if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
+def decideNextActionFused_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction = ''):
+    persona = get_persona(npcId)
+    npc_name = persona.name
 
-    npc_name = npc['name']
-    npc_description = npc['description']
-    npc_way_of_speak= npc['announcements']
-    format_instructions = npc_way_of_speak.get('Format', '').lstrip('> ').strip()
-    tone_instructions = npc_way_of_speak.get('Tone', '').lstrip('> ').strip() 
-    talk_examples = npc_way_of_speak.get('Talk', '').lstrip('> ').strip()
+    budget = LLMPrompt.PromptBudget('decision', model_large)
+    npc_descriptions = budget.fit_static('npc_descriptions', persona.town)
+    schedule_str = fit_schedule(budget, npc_context, schedule_str)
+    memories_str, reflections_str = budget.fit_all(memories=memories_str, reflections=reflections_str)
+
+    # What never changes for the NPC comes first, so the provider can reuse it from its prompt cache
+    prefix = persona.prefix('decideNextActionFused', lambda: f'''
+    You are {persona.name}, {persona.description}.
+    You are one of the characters in the town, here are all the characters in the town:
+    {npc_descriptions}
 
-    recent_schedule_str = onlyMostRecentSchedule(npc_context, schedule_str)
+    ### Action ID and Corresponding Actions:
+    {persona.fused_actions}
+
+    ### NPC ID and Corresponding Character Names:
+    {persona.npc_id_mapping}
+
+    This is how you should structure your speech:
+    {persona.format_instructions}
+
+    Your tone should be:
+    {persona.tone_instructions}
+
+    Here are examples of how you speak:
+    {persona.talk_examples}
+
+    If the action is 127 (finding someone to talk), the `data` field holds the `npcId` of the target npc instead of an `oid`.
+    Your answers are only one JSON object that can be loaded using `json.loads()`, in this format:
+    {{
+        "instruction": "<fill in, one sentence with your name, action name, location, duration and a short explanation, e.g. {persona.name} using computer at the computer desk for 2 hours. He surf the internet for fishing tutorial.>",
+        "npcId": {persona.npcId},
+        "actionId": <fill in, the Action Id of what you are doing>,
+        "data": {{
+            "oid": "<fill in, the oid of where the action is performed, only use the given oid>"
+        }},
+        "durationTime": <fill in, action duration time in milliseconds>,
+        "speak": [
+            "<fill in, sentence to say at the beginning of the action>",
+            "<fill in, sentence to say during the action>",
+            ...
+            "<fill in, sentence to say at the end of the action>"
+        ],
+        "mood": "<fill in, one of happy, sad, curious, anger, none>"
+    }}
+''')
+
+    prompt = prefix + f'''
+    Your calendar of the day:
+      {schedule_str}
+
+    Current time and information: {npc_context}
+
+    Your relevent memeories:
+    {memories_str}
+
+    Your reflections:
+    {reflections_str}
+
+    {special_instruction if special_instruction else ''}
+
+    Decide what you should do next, choosing a single action from the Action ID list above, follow your calendar for the current time.
+    The duration needs to be over 30 minutes at least, if time not allow, jump to next action on schedule.
+    Also write what you say during the action, at least 10 sentences: one for the beginning, multiple during the action and one for the end,
+    structured and in the tone described above. Keep each sentence under 40 words. No emojis.
+
+    Output only one JSON object in the format above.
+    '''
+    budget.report(prompt)
+    other_npc_ids = get_other_npc_ids(npcId)
+    action_ids = [action['actionId'] for action in persona.available_actions]
+    completion = yield dict(
+        model=model_large,
+        response_format=BhrLgcInstSchema.response_format(
+            "decision", BhrLgcInstSchema.decision_schema(npcId, action_ids, other_npc_ids)
+        ),
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a great schedule planner and instruction giver. You will process the information given to you and give instruction in JSON."
+            },
+            {
+                "role": "user",
+                "content": prompt.strip()
+            }
+        ]
+    )
+    output = completion.choices[0].message.content
+    print("Function: decideNextActionFused")
+    print("Prompt:")
+    print(prompt)
+    print("Output:")
+    print(output)
+    print("\n\n")
+
+    # Returns the human readable instruction (for the memory stream), the words to say and the action JSON
+    # The action JSON is checked like the translated ones (raises BhrLgcInstSchema.InstructionError)
+    decision = BhrLgcInstSchema.parse_json_object(output)
+    instruction_in_human = str(decision.pop('instruction', '')).strip()
+    if not instruction_in_human:
+        raise BhrLgcInstSchema.InstructionError(f"No instruction in the fused decision output: {output}")
+    instruction_json = BhrLgcInstSchema.validate_decision(decision, npcId, persona.available_actions, other_npc_ids)
+    words_to_say = "\n".join(instruction_json['speak'])
+    if decision.get('mood'):
+        instruction_in_human += f" {npc_name} feeling {instruction_json['mood']}."
+    return instruction_in_human, words_to_say, instruction_json
+
+def decideNextActionFused(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction = ''):
+    return run_steps(decideNextActionFused_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction))
+
+def talkToSomeone_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, special_instruction = '', max_tokens=20):
+    persona = get_persona(npcId)
+    npc_name = persona.name
+
+    recent_schedule_str = yield from onlyMostRecentSchedule_steps(npc_context, schedule_str)
+
+    budget = LLMPrompt.PromptBudget('talk', model_large)
+    npc_descriptions = budget.fit_static('npc_descriptions', persona.town)
+    recent_schedule_str, memories_str, reflections_str = budget.fit_all(
+        schedule=recent_schedule_str, memories=memories_str, reflections=reflections_str
+    )
 
     finder_instruction = ""
     if isFinding:
         finder_instruction = ''' Your calendar of the day, try to follow your schedule, but fill free to adjust to the current situation: 
                             ''' + recent_schedule_str + ''' Try to wrap up the conversation if you need to do other things on your calendar.'''
 
-    prompt = f'''
-    You are a npc character in a simulated town.
-    Characters in the town:
-    {get_npc_descriptions(npcId)}
-        
-    You are {npc_name}, {npc_description}.
-
+    prompt = talk_prefix(persona, npc_descriptions) + f'''
     Your are talking to {targetNPC if targetNPC else 'someone'}, here is some more information you should know.
         
     Your past memories and experiences:
@@ -595,12 +995,7 @@ def talkToSomeone(memories_str, reflections_str, schedule_str, npc_context, npcI
     The output should include your name, only one target npc name, only one sentence of what you want to say next.
     When you want to end an ongoing conversation, you need to say it explicitly telling that you are ending a converstaion with the target npc.
     Please do not talk to other people all day long, end conversation if need to do other things on your calendar.
-
-    Your Tone is:
-    {tone_instructions}
-
-    Your examples of speaking style:
-    {talk_examples}
+    Speak in your tone and speaking style given above.
     
     Only output the next sentence you going to say next, do not provide any other information. You will expecting replies from the target npc, unless you end the conversation. If you don't want to end the talk yet, just output the next sentence.
     Also include you mood now, chooses from: happy, sad, curious, anger, none
@@ -608,7 +1003,8 @@ def talkToSomeone(memories_str, reflections_str, schedule_str, npc_context, npcI
         {npc_name} is felling happy, and talking to <fill in target npc name>, "<fill in content>". # Only next one sentence you say
          {npc_name} ending conversation with <fill in target npc name>  #only include this if you are are ending the talk after saying this one sentence. Otherwise doe not include this line. 
     '''
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
       model=model_large,
       messages=[
         {"role": "system", "content": "You are a great schedule planner and instruction giver. You will process the information give to you and give instruction."},
@@ -624,35 +1020,26 @@ def talkToSomeone(memories_str, reflections_str, schedule_str, npc_context, npcI
     print("\n\n")
     return output
 
+def talkToSomeone(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, special_instruction = '', max_tokens=20):
+    return run_steps(talkToSomeone_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC, special_instruction, max_tokens))
 
-def shoudConversationEnd(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, things_you_say = None, special_instruction = ''):
-    
-    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
-    if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
+def shoudConversationEnd_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, things_you_say = None, special_instruction = ''):
+    persona = get_persona(npcId)
 
-    npc_name = npc['name']
-    npc_description = npc['description']
-    npc_way_of_speak= npc['announcements']
-    # format_instructions = npc_way_of_speak.get('Format', '')
-    tone_instructions = npc_way_of_speak.get('Tone', '')
-    # talk_examples = npc_way_of_speak.get('Talk', '')
+    recent_schedule_str = yield from onlyMostRecentSchedule_steps(npc_context, schedule_str)
 
-    recent_schedule_str = onlyMostRecentSchedule(npc_context, schedule_str)
+    budget = LLMPrompt.PromptBudget('talk', model_large)
+    npc_descriptions = budget.fit_static('npc_descriptions', persona.town)
+    recent_schedule_str, memories_str, reflections_str = budget.fit_all(
+        schedule=recent_schedule_str, memories=memories_str, reflections=reflections_str
+    )
 
     finder_instruction = ""
     if isFinding:
         finder_instruction = ''' Your calendar of the day, try to follow your schedule, but fill free to adjust to the current situation: 
                             ''' + recent_schedule_str + ''' Try to wrap up the conversation if you need to do other things on your calendar.'''
 
-    prompt = f'''
-    You are a npc character in a simulated town.
-    Characters in the town:
-    {get_npc_descriptions(npcId)}
-
-        
-    You are {npc_name}, {npc_description}.
-
+    prompt = talk_prefix(persona, npc_descriptions) + f'''
     Your are talking to {targetNPC if targetNPC else 'someone'}, here is some more information you should know.
         
     Your past memories and experiences:
@@ -670,7 +1057,8 @@ def shoudConversationEnd(memories_str, reflections_str, schedule_str, npc_contex
     Respond with 'End the conversation' or 'Continue Conversation'.
 
     '''
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
       model=model_large,
       messages=[
         {"role": "system", "content": "You are a great schedule planner and instruction giver. You will process the information give to you and give instruction."},
@@ -686,12 +1074,84 @@ def shoudConversationEnd(memories_str, reflections_str, schedule_str, npc_contex
     print("\n\n")
     return output
 
+def shoudConversationEnd(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, things_you_say = None, special_instruction = ''):
+    return run_steps(shoudConversationEnd_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC, things_you_say, special_instruction))
+
+def talkTurn_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, special_instruction = ''):
+    persona = get_persona(npcId)
+
+    budget = LLMPrompt.PromptBudget('talk', model_large)
+    npc_descriptions = budget.fit_static('npc_descriptions', persona.town)
+    schedule_str = fit_schedule(budget, npc_context, schedule_str)
+    memories_str, reflections_str = budget.fit_all(memories=memories_str, reflections=reflections_str)
+
+    finder_instruction = ""
+    if isFinding:
+        finder_instruction = ''' Your calendar of the day, try to follow your schedule, but fill free to adjust to the current situation: 
+                            ''' + schedule_str + ''' Try to wrap up the conversation if you need to do other things on your calendar.'''
+
+    prompt = talk_prefix(persona, npc_descriptions) + f'''
+    Your are talking to {targetNPC if targetNPC else 'someone'}, here is some more information you should know.
+        
+    Your past memories and experiences:
+    {memories_str}
+    Your reflection past experiences and events: 
+    {reflections_str}
+    {finder_instruction}
+    Your context now:
+    {npc_context}
+    
+    {special_instruction if special_instruction else ''}
+
+    Say only one sentence next to {targetNPC if targetNPC else 'the target npc'}, and decide if the conversation should end after it.
+    When you want to end an ongoing conversation, you need to say it explicitly telling that you are ending a converstaion with the target npc.
+    Please do not talk to other people all day long, end conversation if need to do other things on your calendar.
+    Speak in your tone and speaking style given above.
+
+    Output only one JSON object that can be loaded using `json.loads()`, in this format:
+    {{
+        "content": "<fill in, only the next one sentence you say>",
+        "endingTalk": <fill in 0 or 1, 1 if you are ending the conversation after saying this sentence, 0 if you expect a reply>,
+        "mood": "<fill in, one of happy, sad, curious, anger, none>"
+    }}
+    '''
+    budget.report(prompt)
+    completion = yield dict(
+      model=model_large,
+      response_format={"type": "json_object"},
+      messages=[
+        {"role": "system", "content": "You are a great schedule planner and instruction giver. You will process the information give to you and give instruction in JSON."},
+        {"role": "user", "content": prompt}
+      ]
+    )
+    output = completion.choices[0].message.content
+    print("Function: talkTurn")
+    print("Prompt:")
+    print(prompt)
+    print("Output:")
+    print(output)
+    print("\n\n")
+
+    # Returns the sentence, the ending flag (0 or 1) and the mood
+    turn = json.loads(output.replace('```json', '').replace('```', ''))
+    content = str(turn.get('content', '')).strip()
+    if not content:
+        raise ValueError(f"Empty talk turn output: {output}")
+    ending_talk = 1 if str(turn.get('endingTalk', 0)).strip().lower() in ("1", "true") else 0
+    mood = str(turn.get('mood', 'none')).strip().lower()
+    if mood not in ("happy", "sad", "curious", "anger", "none"):
+        mood = "none"
+    return content, ending_talk, mood
+
+def talkTurn(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, special_instruction = ''):
+    return run_steps(talkTurn_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC, special_instruction))
+
 
 ############################################
 # Content Generation Functions
 ############################################
 
-def generateTheme(memories, reflections, npc_context, npc_action, npcId, special_instruction=''):
+def generateTheme_steps(memories, reflections, npc_context, npc_action, npcId, special_instruction=''):
     npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
     if not npc:
         raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
@@ -699,6 +1159,9 @@ def generateTheme(memories, reflections, npc_context, npc_action, npcId, special
     npc_name = npc['name']
     npc_description = npc['description']
 
+    budget = LLMPrompt.PromptBudget('generation', model_small)
+    memories, reflections = budget.fit_all(memories=memories, reflections=reflections)
+
     prompt = f"""
     You are {npc_name}, {npc_description}.
 
@@ -721,7 +1184,8 @@ def generateTheme(memories, reflections, npc_context, npc_action, npcId, special
     Choose an intriguing topic for today's discussion, incorporating additional relevant details, adding depth and insight to the conversation.
     If the topic has been covered extensively, provide a fresh perspective or a new angle to explore.
     """
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
         model=model_small,
         messages=[
             {
@@ -743,48 +1207,45 @@ def generateTheme(memories, reflections, npc_context, npc_action, npcId, special
     print("\n\n")
     return output
 
+def generateTheme(memories, reflections, npc_context, npc_action, npcId, special_instruction=''):
+    return run_steps(generateTheme_steps(memories, reflections, npc_context, npc_action, npcId, special_instruction))
 
-def generate_new_Announcement(memories, reflections, theme, npcId):
-    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
-    if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
+def speech_prefix(persona):
+    # Who the NPC is and how it speaks, shared by the speech generation prompts
+    return persona.prefix('speech', lambda: f"""
+    You are {persona.name}, {persona.description}.
 
-    npc_name = npc['name']
-    npc_description = npc['description']
-    npc_way_of_speak = npc['announcements']
-    # Extract speaking style instructions from YAML
-    # The .get() method works fine for accessing the values, but YAML block indicators ('>')
-    # are included in the strings, which could affect prompt formatting
-    # .lstrip('> ').strip() removes the YAML block indicator and any extra whitespace
-    format_instructions = npc_way_of_speak.get('Format', '').lstrip('> ').strip()
-    tone_instructions = npc_way_of_speak.get('Tone', '').lstrip('> ').strip() 
-    talk_examples = npc_way_of_speak.get('Talk', '').lstrip('> ').strip()
+    This is how you should structure your speech:
+    {persona.format_instructions}
 
-    prompt = f"""
-    You are {npc_name}, {npc_description}.
+    Your tone should be:
+    {persona.tone_instructions}
+
+    Here are examples of how you speak:
+    {persona.talk_examples}
+""")
 
+def generate_new_Announcement_steps(memories, reflections, theme, npcId):
+    persona = get_persona(npcId)
+
+    budget = LLMPrompt.PromptBudget('generation', model_large)
+    memories, reflections = budget.fit_all(memories=memories, reflections=reflections)
+
+    prompt = speech_prefix(persona) + f"""
     Your past memories and experiences:
     {memories}
 
     Your Reflection on past experiences and events:
     {reflections} 
 
-    This is how you should structure your speech:
-    {format_instructions}
-
-    Your tone should be:
-    {tone_instructions}
-
-    Here are examples of how you speak:
-    {talk_examples}
-
     Please generate an announcement about this topic: {theme}
     Follow the format instructions carefully, maintaining your unique speaking style and tone.
     Keep each section under 30 words.
     No emojis.
     """
 
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
         model=model_large,
         messages=[
             {
@@ -806,21 +1267,16 @@ def generate_new_Announcement(memories, reflections, theme, npcId):
     print("\n\n")
     return output
 
-def generateMultipleSentencesForAction(memories, reflections, npc_context, npc_action, npcId, special_instruction=''):
-    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
-    if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
+def generate_new_Announcement(memories, reflections, theme, npcId):
+    return run_steps(generate_new_Announcement_steps(memories, reflections, theme, npcId))
 
-    npc_name = npc['name']
-    npc_description = npc['description']
-    npc_way_of_speak = npc['announcements']
-    format_instructions = npc_way_of_speak.get('Format', '').lstrip('> ').strip()
-    tone_instructions = npc_way_of_speak.get('Tone', '').lstrip('> ').strip() 
-    talk_examples = npc_way_of_speak.get('Talk', '').lstrip('> ').strip()
+def generateMultipleSentencesForAction_steps(memories, reflections, npc_context, npc_action, npcId, special_instruction=''):
+    persona = get_persona(npcId)
 
-    prompt = f"""
-    You are {npc_name}, {npc_description}.
+    budget = LLMPrompt.PromptBudget('generation', model_small)
+    memories, reflections = budget.fit_all(memories=memories, reflections=reflections)
 
+    prompt = speech_prefix(persona) + f"""
     Your past memories and experiences:
     {memories}
 
@@ -833,15 +1289,6 @@ def generateMultipleSentencesForAction(memories, reflections, npc_context, npc_a
     Your current action:
     {npc_action}
 
-    This is how you should structure your speech:
-    {format_instructions}
-
-    Your tone should be:
-    {tone_instructions}
-
-    Here are examples of how you speak:
-    {talk_examples}
-
     {special_instruction if special_instruction else ''}
 
     Please generate at least 10 sentences that you would say during this action:
@@ -854,7 +1301,8 @@ def generateMultipleSentencesForAction(memories, reflections, npc_context, npc_a
     No emojis.
     """
 
-    completion = client.chat.completions.create(
+    budget.report(prompt)
+    completion = yield dict(
         model=model_small,
         messages=[
             {
@@ -876,42 +1324,39 @@ def generateMultipleSentencesForAction(memories, reflections, npc_context, npc_a
     print("\n\n")
     return output
 
+def generateMultipleSentencesForAction(memories, reflections, npc_context, npc_action, npcId, special_instruction=''):
+    return run_steps(generateMultipleSentencesForAction_steps(memories, reflections, npc_context, npc_action, npcId, special_instruction))
+
+
 ############################################
 # Instruction Translation Functions
 ############################################
 
-def isTheInstructionFindingSomeone(instruction_in_human, words_to_say, npcId):
-    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
-    if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
-
-    npc_name = npc['name']
-    available_actions = npc.get('availableActions', [])
-    ava_npc_action = "\n".join(
-        f"- {action['actionId']} : {action['actionName']}, {action['description']}."
-        for action in available_actions
-    )
+def isTheInstructionFindingSomeone_steps(instruction_in_human, words_to_say, npcId):
+    persona = get_persona(npcId)
 
-    prompt = f"""
+    prefix = persona.prefix('isTheInstructionFindingSomeone', lambda: f"""
     You are an instruction translator in a simulated virtual world. Your task is to convert a natural language instruction 
     into a structured JSON format suitable for NPC behavior.
 
-    {npc_name} initiates the action.
+    {persona.name} initiates the action.
 
     Determine the `actionId` using the action list below.
 
     ### NPC ID List and Character Names (use `npcId` for the target NPC when needed):
-    {get_npc_id_mapping()}
+    {persona.npc_id_mapping}
 
     ### Action ID and Corresponding Actions:
-    {ava_npc_action}
+    {persona.all_actions}
+""")
 
+    prompt = prefix + f"""
     Instruction for the NPC:
     {instruction_in_human}
 
     Tell me if the actionid should be 127? If yes, return "True", if not, return "False". Don't include any other information.
     """
-    completion = client.chat.completions.create(
+    completion = yield dict(
         model=model_small,
         messages=[
             {
@@ -936,50 +1381,35 @@ def isTheInstructionFindingSomeone(instruction_in_human, words_to_say, npcId):
     else:
         return False
 
+def isTheInstructionFindingSomeone(instruction_in_human, words_to_say, npcId):
+    return run_steps(isTheInstructionFindingSomeone_steps(instruction_in_human, words_to_say, npcId))
 
+def humanInstToJava_action_127_steps(instruction_in_human, words_to_say, npcId):
+    persona = get_persona(npcId)
 
-def humanInstToJava_action_127(instruction_in_human, words_to_say, npcId):
-    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
-    if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
-
-    npc_name = npc['name']
-    available_actions = npc.get('availableActions', [])
-    ava_npc_action = "\n".join(
-        f"- {action['actionId']} : {action['actionName']}, {action['description']}."
-        for action in available_actions
-        if action['actionId'] == 127
-    )
-
-    prompt = f"""
+    prefix = persona.prefix('humanInstToJava_action_127', lambda: f"""
     You are an instruction translator in a simulated virtual world. Your task is to convert a natural language instruction 
     into a structured JSON format suitable for NPC behavior.
 
-    {npc_name} initiates the action.
+    {persona.name} initiates the action.
 
     ActionId is 127 for finding someone to talk.
     - Use `npcId` for the target NPC being interacted with.
 
     ### NPC ID and Corresponding Character Names:
-    {get_npc_id_mapping()}
+    {persona.npc_id_mapping}
 
     ### Action ID and Corresponding Actions:
-    {ava_npc_action}
-
-    Instruction for the NPC:
-    {instruction_in_human}
-
-    Words to say before the action, during the action, and at the end of the action:
-    {words_to_say}
+    {persona.find_actions}
 
-    Please convert the instruction into a structured JSON format with the following fields, ensuring it can be loaded using `json.loads()`:
+    Convert the instruction into a structured JSON format with the following fields, ensuring it can be loaded using `json.loads()`:
 
     Do not include any addtional explination or any other text, just in json, Outptu format: 
     {{
-        "npcId": {npcId},
+        "npcId": {persona.npcId},
         "actionId": 127,
         "data": {{
-            "npcId": <target NPC id, here is the npc id list {get_npc_id_mapping()}, only put the id please>
+            "npcId": <target NPC id from the npc id list above, only put the id please>
         }},
         "durationTime": <fill in, action duration time in milliseconds>,
         "speak": [
@@ -990,9 +1420,19 @@ def humanInstToJava_action_127(instruction_in_human, words_to_say, npcId):
         ],
         "mood": <fill in, one of happy, sad, curious, anger, none>
     }}
+""")
+
+    prompt = prefix + f"""
+    Instruction for the NPC:
+    {instruction_in_human}
+
+    Words to say before the action, during the action, and at the end of the action:
+    {words_to_say}
     """
-    completion = client.chat.completions.create(
+    other_npc_ids = get_other_npc_ids(npcId)
+    completion = yield dict(
         model=model_small,
+        response_format=BhrLgcInstSchema.response_format("find_instruction", BhrLgcInstSchema.find_schema(npcId, other_npc_ids)),
         messages=[
             {
                 "role": "system",
@@ -1011,49 +1451,33 @@ def humanInstToJava_action_127(instruction_in_human, words_to_say, npcId):
     print("Output:")
     print(outputinst)
     print("\n\n")
-    return outputinst
+    # Returns the checked instruction as a dict, raises BhrLgcInstSchema.InstructionError if it can't be repaired
+    return BhrLgcInstSchema.validate_find(BhrLgcInstSchema.parse_json_object(outputinst), npcId, other_npc_ids)
 
+def humanInstToJava_action_127(instruction_in_human, words_to_say, npcId):
+    return run_steps(humanInstToJava_action_127_steps(instruction_in_human, words_to_say, npcId))
 
-def humanInstToJava_action_other(instruction_in_human, words_to_say, npcId):
-    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
-    if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
-
-    npc_name = npc['name']
-    available_actions = npc.get('availableActions', [])
-    ava_npc_action = ""
-    available_locations = ""
-    for action in available_actions:
-        if action['actionId'] != 127:
-            ava_npc_action += (
-                f"- {action['actionId']} : {action['actionName']}, {action['description']}.\n"
-            )
-        available_locations += f"{action['location']},"
+def humanInstToJava_action_other_steps(instruction_in_human, words_to_say, npcId):
+    persona = get_persona(npcId)
 
-    prompt = f"""
+    prefix = persona.prefix('humanInstToJava_action_other', lambda: f"""
     You are an instruction translator in a simulated virtual world. Your task is to convert a natural language instruction 
     into a structured JSON format suitable for NPC behavior.
 
-    {npc_name} initiates the action.
+    {persona.name} initiates the action.
 
 
     ### Action ID and Corresponding Actions:
-    {ava_npc_action}
+    {persona.other_actions}
 
     ### Object ID List as Location(oid),  Use `oid` to indicate the object or location where the action is performed:
-    {available_locations}
+    {persona.locations}
 
-    Instruction for the NPC:
-    {instruction_in_human}
-
-    Words to say before the action, during the action, and at the end of the action:
-    {words_to_say}
-
-    Please convert the instruction into a structured JSON format with the following fields, ensuring it can be loaded using `json.loads()`:
+    Convert the instruction into a structured JSON format with the following fields, ensuring it can be loaded using `json.loads()`:
 
     Do not include any addtional explination or any other text, just in json, Outptu format:
     {{
-        "npcId": {npcId},
+        "npcId": {persona.npcId},
         "actionId": <fill in, the Action Id of what the npc is doing>,
         "data": {{
             "oid": <fill in, the Object ID of where the action is performed, only use the given oid>
@@ -1068,9 +1492,18 @@ def humanInstToJava_action_other(instruction_in_human, words_to_say, npcId):
         ],
         "mood": <fill in, one of happy, sad, curious, anger, none>
     }}
+""")
+
+    prompt = prefix + f"""
+    Instruction for the NPC:
+    {instruction_in_human}
+
+    Words to say before the action, during the action, and at the end of the action:
+    {words_to_say}
     """
-    completion = client.chat.completions.create(
+    completion = yield dict(
         model=model_large,
+        response_format=BhrLgcInstSchema.response_format("action_instruction", BhrLgcInstSchema.action_schema(npcId, persona.action_ids)),
         messages=[
             {
                 "role": "system",
@@ -1089,36 +1522,29 @@ def humanInstToJava_action_other(instruction_in_human, words_to_say, npcId):
     print("Output:")
     print(outputinst)
     print("\n\n")
-    return outputinst
+    return BhrLgcInstSchema.validate_action(BhrLgcInstSchema.parse_json_object(outputinst), npcId, persona.available_actions)
 
+def humanInstToJava_action_other(instruction_in_human, words_to_say, npcId):
+    return run_steps(humanInstToJava_action_other_steps(instruction_in_human, words_to_say, npcId))
 
-def humanInstToJava_action(instruction_in_human, words_to_say, npcId):
-    if isTheInstructionFindingSomeone(instruction_in_human, words_to_say, npcId):
-        return humanInstToJava_action_127(instruction_in_human, words_to_say, npcId)
+def humanInstToJava_action_steps(instruction_in_human, words_to_say, npcId):
+    if (yield from isTheInstructionFindingSomeone_steps(instruction_in_human, words_to_say, npcId)):
+        return (yield from humanInstToJava_action_127_steps(instruction_in_human, words_to_say, npcId))
     else:
-        return humanInstToJava_action_other(instruction_in_human, words_to_say, npcId)
+        return (yield from humanInstToJava_action_other_steps(instruction_in_human, words_to_say, npcId))
 
+def humanInstToJava_action(instruction_in_human, words_to_say, npcId):
+    return run_steps(humanInstToJava_action_steps(instruction_in_human, words_to_say, npcId))
 
-def humanInstToJava_talk(instruction_in_human, words_to_say, npcId, target_npc_id):
-    npc = next((npc for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), None)
-    if not npc:
-        raise ValueError(f"NPC with npcId {npcId} not found in char_config.yaml")
 
-    npc_name = npc['name']
-    available_actions = npc.get('availableActions', [])
-    ava_npc_action = ""
-    for action in available_actions:
-        if action['actionId'] != 127:
-            ava_npc_action += (
-                f"- {action['actionId']} : {action['actionName']}, {action['description']}.\n"
-            )
-    available_locations = ",".join(action['location'] for action in available_actions)
+def humanInstToJava_talk_steps(instruction_in_human, words_to_say, npcId, target_npc_id):
+    persona = get_persona(npcId)
 
-    prompt = f"""
+    prefix = persona.prefix('humanInstToJava_talk', lambda: f"""
     You are an instruction translator in a simulated virtual world. Your task is to convert a natural language instruction 
     into a structured JSON format suitable for NPC behavior.
 
-    {npc_name} talks to someone.
+    {persona.name} talks to someone.
 
     Follow these steps:
     1. Extract target npcId from the instruction and place it in the `data` field as `npcId`.
@@ -1126,27 +1552,34 @@ def humanInstToJava_talk(instruction_in_human, words_to_say, npcId, target_npc_i
     3. If the conversation is ending, set `endingTalk` to 1.
 
     ### NPC ID List and Character Names (for npcId field below):
-    {get_npc_id_mapping()}
-
-    Instruction for the NPC:
-    {instruction_in_human}
+    {persona.npc_id_mapping}
 
-    Please convert the instruction into a structured JSON format with the following fields, It is very important that your output can be loaded with json.loads().
+    Convert the instruction into a structured JSON format with the following fields, It is very important that your output can be loaded with json.loads().
     Do not include any addtional explination or any other text, just in json, Outptu format:
     {{
-        "npcId": {npcId},
+        "npcId": {persona.npcId},
         "actionId": 118,
         "data": {{
-            "npcId": {target_npc_id if target_npc_id else f"<fill in, the npcid of the target npc who will receive the talk message, here is the npc id list {get_npc_id_mapping()}>"},
+            "npcId": <fill in, the npcid of the target npc who will receive the talk message, from the npc id list above>,
             "content": <fill in, the content of the chat, what the npc says.>,
             "endingTalk" : <fill in 0 or 1, 1 if the npc is ending the conversation now, 0 if continue conversation>
         }},
         "mood": <fill in, one of happy, sad, curious, anger, none>
     }}
     You only give one instruction at a time, not multiple instruction.
+""")
+
+    target_line = f"The npcId of the target npc is {target_npc_id}." if target_npc_id else ""
+    prompt = prefix + f"""
+    Instruction for the NPC:
+    {instruction_in_human}
+    {target_line}
     """
-    completion = client.chat.completions.create(
+    known_target = BhrLgcInstSchema.npc_id_or_none(target_npc_id)
+    other_npc_ids = [known_target] if known_target is not None else get_other_npc_ids(npcId)
+    completion = yield dict(
         model=model_small,
+        response_format=BhrLgcInstSchema.response_format("talk_instruction", BhrLgcInstSchema.talk_schema(npcId, other_npc_ids)),
         messages=[
             {
                 "role": "system",
@@ -1165,4 +1598,9 @@ def humanInstToJava_talk(instruction_in_human, words_to_say, npcId, target_npc_i
     print("Output:")
     print(outputinst)
     print("\n\n")
-    return outputinst
\ No newline at end of file
+    return BhrLgcInstSchema.validate_talk(
+        BhrLgcInstSchema.parse_json_object(outputinst), npcId, other_npc_ids, target_npc_id, words_to_say
+    )
+
+def humanInstToJava_talk(instruction_in_human, words_to_say, npcId, target_npc_id):
+    return run_steps(humanInstToJava_talk_steps(instruction_in_human, words_to_say, npcId, target_npc_id))
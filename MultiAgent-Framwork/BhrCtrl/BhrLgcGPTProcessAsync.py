@@ -0,0 +1,151 @@
+import asyncio
+
+import BhrLgcGPTProcess
+from LLMConnect import LLMCon
+from LLMConnect import LLMCache
+
+# Async variant of BhrLgcGPTProcess.
+# Prompts, provider selection and output parsing all live in BhrLgcGPTProcess;
+# this module only drives the same "<name>_steps" generators with an
+# AsyncOpenAI client, so a single event loop can keep many NPC decisions
+# in flight instead of parking one worker thread per model call.
+#
+# Usage:
+#   import BhrLgcGPTProcessAsync
+#   outputs = await asyncio.gather(
+#       BhrLgcGPTProcessAsync.processInputGiveWhatToDo(...),
+#       BhrLgcGPTProcessAsync.talkToSomeone(...),
+#   )
+
+client = LLMCon.make_async_client(BhrLgcGPTProcess.chat_api_keys, BhrLgcGPTProcess.chat_base_url)
+client_embedding = LLMCon.make_async_client(BhrLgcGPTProcess.openai_keys)
+LLMCon.configure_fallback(client, BhrLgcGPTProcess.keys_by_provider, BhrLgcGPTProcess.model_small, BhrLgcGPTProcess.model_large)
+
+model_small = BhrLgcGPTProcess.model_small
+model_large = BhrLgcGPTProcess.model_large
+char_config = BhrLgcGPTProcess.char_config
+
+get_npc_descriptions = BhrLgcGPTProcess.get_npc_descriptions
+get_npc_id_mapping = BhrLgcGPTProcess.get_npc_id_mapping
+
+
+############################################
+# Model Call Driver
+############################################
+
+async def run_steps(steps):
+    try:
+        request = next(steps)
+        while True:
+            completion = await client.chat.completions.create(**request)
+            request = steps.send(completion)
+    except StopIteration as stop:
+        return stop.value
+
+
+############################################
+# Memory and Reflection Related Functions
+############################################
+
+async def get_embedding(text, model="text-embedding-3-small"):
+    # The cache may query MySQL, which would block the event loop
+    embedding = await asyncio.to_thread(LLMCache.embedding_cache.lookup, text, model)
+    if embedding is None:
+        response = await client_embedding.embeddings.create(input = LLMCache.normalize_text(text), model=model)
+        embedding = response.data[0].embedding
+        await asyncio.to_thread(LLMCache.embedding_cache.store, text, model, embedding)
+    return embedding
+
+async def get_importance(mem_single_str):
+    key = LLMCache.text_key(mem_single_str, "importance:" + model_large)
+    importance = LLMCache.importance_cache.get(key)
+    if importance is None:
+        importance = await run_steps(BhrLgcGPTProcess.get_importance_steps(mem_single_str))
+        LLMCache.importance_cache.put(key, importance)
+    return importance
+
+async def get_importance_batch(mem_strs):
+    return await run_steps(BhrLgcGPTProcess.get_importance_batch_steps(mem_strs))
+
+async def condenseMemoriesAndReflections(npc_name, npc_description, npc_context, recent_schedule_str, memories_str, reflections_str):
+    return await run_steps(BhrLgcGPTProcess.condenseMemoriesAndReflections_steps(npc_name, npc_description, npc_context, recent_schedule_str, memories_str, reflections_str))
+
+async def updateCondensedContext(prior_condensed_str, new_memories_str, new_reflection_str, npcId, max_words=200):
+    return await run_steps(BhrLgcGPTProcess.updateCondensedContext_steps(prior_condensed_str, new_memories_str, new_reflection_str, npcId, max_words))
+
+async def needDeepTalk(memories, reflections, npc_context, npc_action, npcId):
+    return await run_steps(BhrLgcGPTProcess.needDeepTalk_steps(memories, reflections, npc_context, npc_action, npcId))
+
+async def generate_reflection_new(memories_str, reflections_str, java_input_str, npcId):
+    return await run_steps(BhrLgcGPTProcess.generate_reflection_new_steps(memories_str, reflections_str, java_input_str, npcId))
+
+
+############################################
+# Scheduling Related Functions
+############################################
+
+async def onlyMostRecentSchedule(npc_context, schedule_str):
+    return await run_steps(BhrLgcGPTProcess.onlyMostRecentSchedule_steps(npc_context, schedule_str))
+
+async def generate_schedule(current_schedule, memories, reflections, npc_context, npcId):
+    return await run_steps(BhrLgcGPTProcess.generate_schedule_steps(current_schedule, memories, reflections, npc_context, npcId))
+
+async def need_new_schedule(current_schedule, memories, reflections, npc_context, npcId):
+    return await run_steps(BhrLgcGPTProcess.need_new_schedule_steps(current_schedule, memories, reflections, npc_context, npcId))
+
+
+############################################
+# Action Decision Functions
+############################################
+
+async def processInputGiveWhatToDo(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction = ''):
+    return await run_steps(BhrLgcGPTProcess.processInputGiveWhatToDo_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction))
+
+get_decision_mode = BhrLgcGPTProcess.get_decision_mode
+get_talk_mode = BhrLgcGPTProcess.get_talk_mode
+
+async def decideNextActionFused(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction = ''):
+    return await run_steps(BhrLgcGPTProcess.decideNextActionFused_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, special_instruction))
+
+async def talkToSomeone(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, special_instruction = '', max_tokens=20):
+    return await run_steps(BhrLgcGPTProcess.talkToSomeone_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC, special_instruction, max_tokens))
+
+async def shoudConversationEnd(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, things_you_say = None, special_instruction = ''):
+    return await run_steps(BhrLgcGPTProcess.shoudConversationEnd_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC, things_you_say, special_instruction))
+
+async def talkTurn(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC = None, special_instruction = ''):
+    return await run_steps(BhrLgcGPTProcess.talkTurn_steps(memories_str, reflections_str, schedule_str, npc_context, npcId, isFinding, targetNPC, special_instruction))
+
+
+############################################
+# Content Generation Functions
+############################################
+
+async def generateTheme(memories, reflections, npc_context, npc_action, npcId, special_instruction=''):
+    return await run_steps(BhrLgcGPTProcess.generateTheme_steps(memories, reflections, npc_context, npc_action, npcId, special_instruction))
+
+async def generate_new_Announcement(memories, reflections, theme, npcId):
+    return await run_steps(BhrLgcGPTProcess.generate_new_Announcement_steps(memories, reflections, theme, npcId))
+
+async def generateMultipleSentencesForAction(memories, reflections, npc_context, npc_action, npcId, special_instruction=''):
+    return await run_steps(BhrLgcGPTProcess.generateMultipleSentencesForAction_steps(memories, reflections, npc_context, npc_action, npcId, special_instruction))
+
+
+############################################
+# Instruction Translation Functions
+############################################
+
+async def isTheInstructionFindingSomeone(instruction_in_human, words_to_say, npcId):
+    return await run_steps(BhrLgcGPTProcess.isTheInstructionFindingSomeone_steps(instruction_in_human, words_to_say, npcId))
+
+async def humanInstToJava_action_127(instruction_in_human, words_to_say, npcId):
+    return await run_steps(BhrLgcGPTProcess.humanInstToJava_action_127_steps(instruction_in_human, words_to_say, npcId))
+
+async def humanInstToJava_action_other(instruction_in_human, words_to_say, npcId):
+    return await run_steps(BhrLgcGPTProcess.humanInstToJava_action_other_steps(instruction_in_human, words_to_say, npcId))
+
+async def humanInstToJava_action(instruction_in_human, words_to_say, npcId):
+    return await run_steps(BhrLgcGPTProcess.humanInstToJava_action_steps(instruction_in_human, words_to_say, npcId))
+
+async def humanInstToJava_talk(instruction_in_human, words_to_say, npcId, target_npc_id):
+    return await run_steps(BhrLgcGPTProcess.humanInstToJava_talk_steps(instruction_in_human, words_to_say, npcId, target_npc_id))
@@ -0,0 +1,227 @@
+import json
+
+# Schemas and local validation of the instructions sent to the Java side.
+# The translation calls (humanInstToJava_*) ask the model for JSON output,
+# constrained by a JSON schema per kind of action where the provider supports
+# it (JSON mode elsewhere). The answer is then checked and repaired here:
+# numbers given as strings, a mood outside the list or a speak line given as a
+# string are fixed locally instead of costing another model call. Only an
+# answer that cannot be repaired raises InstructionError.
+
+MOODS = ["happy", "sad", "curious", "anger", "none"]
+FIND_ACTION_ID = 127
+TALK_ACTION_ID = 118
+# Used when the model gives no usable duration
+DEFAULT_DURATION_MS = 60000
+
+
+class InstructionError(ValueError):
+    pass
+
+
+def npc_id_or_none(value):
+    # npc ids read from the Java side may come as strings
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+def _own_id(npcId):
+    own_id = npc_id_or_none(npcId)
+    return npcId if own_id is None else own_id
+
+def _id_property(ids):
+    return {"type": "integer", "enum": list(ids)} if ids else {"type": "integer"}
+
+def _object(properties):
+    # Strict schemas need every property listed as required and no other property
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+def instruction_schema(npcId, action_ids, data_properties, with_speak=True):
+    """
+    JSON schema of one instruction of npcId, with actionId one of action_ids.
+    """
+    properties = {
+        "npcId": _id_property([_own_id(npcId)]),
+        "actionId": _id_property(action_ids),
+        "data": _object(data_properties),
+    }
+    if with_speak:
+        properties["durationTime"] = {"type": "integer"}
+        properties["speak"] = {"type": "array", "items": {"type": "string"}}
+    properties["mood"] = {"type": "string", "enum": MOODS}
+    return _object(properties)
+
+def find_schema(npcId, npc_ids):
+    return instruction_schema(npcId, [FIND_ACTION_ID], {"npcId": _id_property(npc_ids)})
+
+def action_schema(npcId, action_ids):
+    return instruction_schema(npcId, action_ids, {"oid": {"type": "string"}})
+
+def talk_schema(npcId, npc_ids):
+    return instruction_schema(
+        npcId,
+        [TALK_ACTION_ID],
+        {
+            "npcId": _id_property(npc_ids),
+            "content": {"type": "string"},
+            "endingTalk": {"type": "integer", "enum": [0, 1]},
+        },
+        with_speak=False,
+    )
+
+def decision_schema(npcId, action_ids, npc_ids):
+    """
+    JSON schema of the fused decision: the instruction in words, then the instruction
+    itself, whose data is the target npcId for action 127 and the oid otherwise.
+    """
+    properties = {"instruction": {"type": "string"}}
+    properties.update(instruction_schema(npcId, action_ids, {"oid": {"type": "string"}})["properties"])
+    properties["data"] = {"anyOf": [_object({"oid": {"type": "string"}}), _object({"npcId": _id_property(npc_ids)})]}
+    return _object(properties)
+
+def response_format(name, schema):
+    """
+    response_format of a chat call constrained by schema. LLMCon turns it into plain
+    JSON mode for providers without JSON schema support.
+    """
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+############################################
+# Parsing and Repair
+############################################
+
+def parse_json_object(text):
+    """
+    Returns the JSON object in a model answer, ignoring ``` fences or text around it.
+    """
+    text = (text or "").strip()
+    try:
+        value = json.loads(text)
+    except ValueError:
+        start, end = text.find("{"), text.rfind("}")
+        if start < 0 or end <= start:
+            raise InstructionError(f"No JSON object in the answer: {text[:200]!r}")
+        try:
+            value = json.loads(text[start:end + 1])
+        except ValueError as e:
+            raise InstructionError(f"Invalid JSON in the answer: {e}")
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        # One instruction at a time
+        value = value[0]
+    if not isinstance(value, dict):
+        raise InstructionError(f"The answer is not a JSON object: {text[:200]!r}")
+    return value
+
+def _int(value, field):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        raise InstructionError(f"{field} is not an integer: {value!r}")
+
+def _mood(value):
+    mood = str(value or "none").strip().lower()
+    return mood if mood in MOODS else "none"
+
+def _speak(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value] if value.strip() else []
+    return [str(line) for line in value if str(line).strip()]
+
+def _duration(value):
+    try:
+        duration = int(float(str(value).strip()))
+    except (TypeError, ValueError):
+        return DEFAULT_DURATION_MS
+    return duration if duration > 0 else DEFAULT_DURATION_MS
+
+def _data(instruction):
+    data = instruction.get("data")
+    if not isinstance(data, dict):
+        raise InstructionError(f"data is not an object: {data!r}")
+    return data
+
+def _target_npc(data, npc_ids, target_npc_id=None):
+    if npc_id_or_none(target_npc_id) is not None:
+        return npc_id_or_none(target_npc_id)
+    target = _int(data.get("npcId"), "data.npcId")
+    if target not in npc_ids:
+        raise InstructionError(f"Unknown target npcId {target}")
+    return target
+
+
+def validate_find(instruction, npcId, npc_ids):
+    data = _data(instruction)
+    return {
+        "npcId": _own_id(npcId),
+        "actionId": FIND_ACTION_ID,
+        "data": {"npcId": _target_npc(data, npc_ids)},
+        "durationTime": _duration(instruction.get("durationTime")),
+        "speak": _speak(instruction.get("speak")),
+        "mood": _mood(instruction.get("mood")),
+    }
+
+def validate_action(instruction, npcId, available_actions):
+    """
+    available_actions: the availableActions of the NPC in char_config.yaml
+    """
+    locations = {action['actionId']: action.get('location', '') for action in available_actions}
+    action_id = _int(instruction.get("actionId"), "actionId")
+    if action_id not in locations or action_id == FIND_ACTION_ID:
+        raise InstructionError(f"actionId {action_id} is not an available action")
+
+    oid = str(_data(instruction).get("oid") or "").strip()
+    location = locations[action_id]
+    fixed_locations = {loc for loc in locations.values() if loc and '<' not in loc}
+    if location and '<' not in location and oid not in fixed_locations:
+        # The action has a fixed place, use it rather than an invented oid
+        oid = location
+    if not oid:
+        raise InstructionError(f"No oid for actionId {action_id}")
+
+    return {
+        "npcId": _own_id(npcId),
+        "actionId": action_id,
+        "data": {"oid": oid},
+        "durationTime": _duration(instruction.get("durationTime")),
+        "speak": _speak(instruction.get("speak")),
+        "mood": _mood(instruction.get("mood")),
+    }
+
+def validate_decision(instruction, npcId, available_actions, npc_ids):
+    """
+    Checks the instruction of a fused decision with validate_find or validate_action.
+    """
+    action_id = _int(instruction.get("actionId"), "actionId")
+    if action_id == FIND_ACTION_ID:
+        if not any(action['actionId'] == FIND_ACTION_ID for action in available_actions):
+            raise InstructionError(f"actionId {action_id} is not an available action")
+        return validate_find(instruction, npcId, npc_ids)
+    return validate_action(instruction, npcId, available_actions)
+
+def validate_talk(instruction, npcId, npc_ids, target_npc_id=None, words_to_say=''):
+    data = _data(instruction)
+    content = str(data.get("content") or "").strip() or str(words_to_say or "").strip()
+    if not content:
+        raise InstructionError("No content to say")
+    ending = data.get("endingTalk", 0)
+    if isinstance(ending, str):
+        ending = 1 if ending.strip().lower() in ("1", "true", "yes") else 0
+    return {
+        "npcId": _own_id(npcId),
+        "actionId": TALK_ACTION_ID,
+        "data": {
+            "npcId": _target_npc(data, npc_ids, target_npc_id),
+            "content": content,
+            "endingTalk": 1 if ending else 0,
+        },
+        "mood": _mood(instruction.get("mood")),
+    }
@@ -15,6 +15,9 @@ import pickle
 
 import BhrLgcGPTProcess
 import BhrLgcManualProcess
+from BhrLgcToMemStre import DEFAULT_IMPORTANCE
+
+from LLMConnect import LLMRetry
 
 # memstre_db_connection = DBCon.establish_sql_connection()
 
@@ -54,14 +57,10 @@ def InstImportancetoReflectionTracer(input_from_java, instruction, words_to_say)
     insert_npcId = input_from_java[2]
     insert_time = input_from_java[1]
 
-    while True:
-        try:
-            # Attempt to get the importance and convert it to an integer
-            insert_importance = int(BhrLgcGPTProcess.get_importance(output_str))
-            # Break the loop if no exception occurs
-            break
-        except Exception as e:
-            print(f"Error occurred: {e}. Retrying...")
+    insert_importance = LLMRetry.retry_call(
+        lambda: int(BhrLgcGPTProcess.get_importance(output_str)),
+        name='importance', attempts=2, default=DEFAULT_IMPORTANCE,
+    )
         
     output = BhrDBReflectionTracer.retrieve_entry(ReflectionTracer_db_conection, insert_npcId)
 
@@ -495,4 +495,27 @@ def talkingInstruction(npcId, words):
     }
     result = json.dumps(instruction, indent=4)
     print("Method: talkingInstruction | Description: Generates JSON instruction for NPC to talk | Result:", result, "\n")
-    return result
\ No newline at end of file
+    return result
+
+def talkTurnInstruction(npcId, target_npc_id, content, ending_talk, mood):
+    """
+    Build the actionId 118 instruction for one conversation turn, without a model call.
+    npcId: the talking NPC
+    target_npc_id: the NPC receiving the talk message
+    content: what the NPC says
+    ending_talk: 1 if the NPC ends the conversation with this turn, 0 otherwise
+    mood: one of happy, sad, curious, anger, none
+    Returns a dict, the caller adds the requestId and serializes it.
+    """
+    instruction = {
+        "npcId": npcId,
+        "actionId": 118,
+        "data": {
+            "npcId": target_npc_id,
+            "content": content,
+            "endingTalk": 1 if ending_talk else 0
+        },
+        "mood": mood
+    }
+    print("Method: talkTurnInstruction | Description: Builds JSON instruction for one talk turn | Result:", instruction, "\n")
+    return instruction
@@ -0,0 +1,442 @@
+import sys
+import os
+import json
+import time
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Add the base directory (one level up from the current directory)
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(base_dir)
+
+from DBConnect import BhrDBMemStre
+
+try:
+    from BhrLgcMemIndex import to_seconds, SYNC_OVERLAP_SECONDS
+except ImportError:
+    # Imported as BhrCtrl.BhrLgcMemANN from the other controllers
+    from BhrCtrl.BhrLgcMemIndex import to_seconds, SYNC_OVERLAP_SECONDS
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Approximate nearest-neighbour index of the whole memory stream of each NPC.
+# The memory index (BhrLgcMemIndex) only holds the most recent memories, so
+# older relevant ones are never retrieved. Here every memory of an NPC goes in
+# an HNSW graph (hnswlib) over the unit-length embeddings: a query finds the
+# most similar memories of the whole history without scanning it. Those
+# candidates and the most recent memories are then scored exactly by the
+# MemoryRetriever (recency, importance, similarity) and the best k are kept.
+# Each NPC's index is built from behavior_memeory_stream on first use (in pages),
+# updated by every BhrDBMemStre.insert_into_table of this process, and saved
+# to index_dir. The full index is only written when it is loaded; the memories
+# inserted after that are appended to a log next to it by a background thread,
+# so an insert never rewrites the history nor holds up the queries. On the next
+# start the index is loaded, the log replayed into it and the whole saved
+# again, and only the memories written since are read from the database. Like
+# the memory index, that catch-up re-reads the last sync_overlap_seconds of
+# [MemoryIndex] before the newest memory, as rows of the same time can commit
+# in any order; rows already in the index are matched by their primary key.
+# hnswlib is in requirements.txt; without it the embeddings are kept in a flat
+# float32 matrix and scanned, which still reads nothing from the database on
+# the request path.
+# Settings come from the optional [MemoryANN] section of config.ini:
+#   enabled = true
+#   index_dir = BhrCtrl/memory_ann   relative to the project directory
+#   candidates = 100                 nearest neighbours scored per query
+#   recent_candidates = 100          most recent memories scored per query
+#   ef = 128                         HNSW search breadth (>= candidates)
+#   m = 16                           HNSW links per node
+#   ef_construction = 200            HNSW build breadth
+
+config = configparser.ConfigParser()
+config.read(os.path.join(base_dir, 'config.ini'))
+
+ENABLED = config.getboolean('MemoryANN', 'enabled', fallback=True)
+INDEX_DIR = os.path.join(base_dir, config.get('MemoryANN', 'index_dir', fallback=os.path.join('BhrCtrl', 'memory_ann')))
+CANDIDATES = config.getint('MemoryANN', 'candidates', fallback=100)
+RECENT_CANDIDATES = config.getint('MemoryANN', 'recent_candidates', fallback=100)
+EF = config.getint('MemoryANN', 'ef', fallback=128)
+M = config.getint('MemoryANN', 'm', fallback=16)
+EF_CONSTRUCTION = config.getint('MemoryANN', 'ef_construction', fallback=200)
+PAGE_SIZE = 1000
+
+# Appends the inserted memories to the logs, in insertion order
+log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="MemoryANN")
+
+
+def unit_vector(embedding):
+    vector = np.asarray(embedding, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class HnswVectors:
+    """
+    Unit vectors by label in an hnswlib graph (inner product, i.e. cosine similarity).
+    """
+    suffix = '.hnsw'
+
+    def __init__(self, dimension, capacity=1024):
+        self.dimension = dimension
+        self.index = hnswlib.Index(space='ip', dim=dimension)
+        self.index.init_index(max_elements=capacity, ef_construction=EF_CONSTRUCTION, M=M)
+        self.index.set_ef(max(EF, CANDIDATES))
+
+    def add(self, labels, vectors):
+        needed = self.index.get_current_count() + len(labels)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+        self.index.add_items(vectors, labels)
+
+    def nearest(self, query, n):
+        n = min(n, self.index.get_current_count())
+        if not n:
+            return np.zeros(0, dtype=np.int64)
+        labels, distances = self.index.knn_query(query, k=n)
+        return labels[0].astype(np.int64)
+
+    def get(self, labels):
+        return np.asarray(self.index.get_items(labels), dtype=np.float32)
+
+    def count(self):
+        return self.index.get_current_count()
+
+    def save(self, path):
+        self.index.save_index(path)
+
+    @classmethod
+    def load(cls, path, dimension):
+        vectors = cls.__new__(cls)
+        vectors.dimension = dimension
+        vectors.index = hnswlib.Index(space='ip', dim=dimension)
+        vectors.index.load_index(path)
+        vectors.index.set_ef(max(EF, CANDIDATES))
+        return vectors
+
+
+class FlatVectors:
+    """
+    Unit vectors by label in a float32 matrix, searched exhaustively (no hnswlib).
+    """
+    suffix = '.npy'
+
+    def __init__(self, dimension, capacity=1024):
+        self.dimension = dimension
+        self.matrix = np.zeros((capacity, dimension), dtype=np.float32)
+        self.size = 0
+
+    def add(self, labels, vectors):
+        needed = int(max(labels)) + 1
+        if needed > len(self.matrix):
+            grown = np.zeros((max(needed, 2 * len(self.matrix)), self.dimension), dtype=np.float32)
+            grown[:self.size] = self.matrix[:self.size]
+            self.matrix = grown
+        self.matrix[labels] = vectors
+        self.size = max(self.size, needed)
+
+    def nearest(self, query, n):
+        similarity = self.matrix[:self.size] @ query
+        if self.size > n:
+            return np.argpartition(-similarity, n - 1)[:n]
+        return np.arange(self.size)
+
+    def get(self, labels):
+        return self.matrix[labels]
+
+    def count(self):
+        return self.size
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            np.save(file, self.matrix[:self.size])
+
+    @classmethod
+    def load(cls, path, dimension):
+        vectors = cls.__new__(cls)
+        vectors.dimension = dimension
+        vectors.matrix = np.load(path)
+        vectors.size = len(vectors.matrix)
+        return vectors
+
+
+Vectors = HnswVectors if hnswlib is not None else FlatVectors
+
+
+class MemoryHistory:
+    """
+    All the memories of one NPC: an ANN index of their embeddings, and their times,
+    importances and contents by label (labels are given in insertion order).
+    """
+
+    def __init__(self, npcId):
+        self.npcId = npcId
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.synced_at = 0.0
+        self.vectors = None  # Vectors, created with the first memory
+        self.times = np.zeros(1024, dtype=np.float64)
+        self.importances = np.zeros(1024, dtype=np.float32)
+        self.instructions = []
+        self.contents = []
+        self.labels = {}  # (time, isInstruction) -> label, as the primary key of the table
+        self.latest = None  # (time, isInstruction) of the last memory in the table order
+
+    @property
+    def size(self):
+        return len(self.contents)
+
+    def add_batch(self, memories):
+        """
+        memories: (time, isInstruction, content, importance, embedding) tuples.
+        Returns how many were not in the index yet. Called with the lock held.
+        """
+        new_labels, new_vectors = [], []
+        added = 0
+        for memory_time, isInstruction, content, importance, embedding in memories:
+            vector = unit_vector(embedding)
+            if self.vectors is None:
+                self.vectors = Vectors(len(vector))
+            elif len(vector) != self.vectors.dimension:
+                print(f"Method: MemoryHistory.add | npcId: {self.npcId} | Skipped an embedding of dimension "
+                      f"{len(vector)} instead of {self.vectors.dimension}")
+                continue
+            stamp = pd.Timestamp(memory_time)
+            key = (to_seconds(stamp), int(isInstruction))
+            label = self.labels.get(key)
+            if label is not None and self.contents[label] == content and self.importances[label] == np.float32(importance):
+                # Read again by an overlapping catch-up
+                continue
+            if label is None:
+                added += 1
+                label = self.size
+                self.labels[key] = label
+                if label == len(self.times):
+                    self.times = np.concatenate([self.times, np.zeros_like(self.times)])
+                    self.importances = np.concatenate([self.importances, np.zeros_like(self.importances)])
+                self.contents.append(content)
+                self.instructions.append(int(isInstruction))
+            self.times[label] = key[0]
+            self.importances[label] = importance
+            self.contents[label] = content
+            new_labels.append(label)
+            new_vectors.append(vector)
+            if self.latest is None or (stamp, key[1]) > self.latest:
+                self.latest = (stamp, key[1])
+        if new_labels:
+            self.vectors.add(np.asarray(new_labels, dtype=np.int64), np.stack(new_vectors))
+        return added
+
+    def add_rows(self, rows_df):
+        return self.add_batch(
+            (row.Time, row.isInstruction, row.Content, row.Importance, row.Embedding)
+            for row in rows_df.itertuples(index=False)
+        )
+
+    def query(self, retriever, query_embedding, current_time, k):
+        """
+        Contents and scores of the k most relevant memories before current_time, most recent first,
+        among the nearest neighbours of the query and the most recent memories.
+        retriever: a BhrLgcMemRetriever.MemoryRetriever
+        """
+        now = to_seconds(current_time)
+        with self.lock:
+            if not self.size:
+                return [], []
+            times = self.times[:self.size]
+            before = np.flatnonzero(times < now)
+            if len(before) > RECENT_CANDIDATES:
+                before = before[np.argpartition(-times[before], RECENT_CANDIDATES - 1)[:RECENT_CANDIDATES]]
+            nearest = self.vectors.nearest(unit_vector(query_embedding), CANDIDATES)
+            nearest = nearest[times[nearest] < now]
+            rows = np.union1d(nearest, before)
+            if not len(rows):
+                return [], []
+            ages = now - times[rows]
+            scores = retriever.scores(query_embedding, ages, self.importances[rows], self.vectors.get(rows))
+            best = retriever.top_k(scores, ages, k)
+            return [self.contents[rows[i]] for i in best], scores[best].tolist()
+
+    def paths(self, index_dir):
+        # Saved index, its metadata, and the log of the memories inserted since (metadata lines, vectors)
+        name = os.path.join(index_dir, f"npc_{self.npcId}")
+        return name + Vectors.suffix, name + '.json', name + '.log.jsonl', name + '.log.f32'
+
+    def save(self, index_dir):
+        """
+        Writes the whole index and clears the log. Called with the lock held, when the index is loaded.
+        The metadata is written after the vectors: an index whose count does not match it is rebuilt
+        from the database on load. Log records already in the index are skipped when replayed.
+        """
+        if self.vectors is None:
+            return
+        os.makedirs(index_dir, exist_ok=True)
+        vectors_path, meta_path, log_path, log_vectors_path = self.paths(index_dir)
+        self.vectors.save(vectors_path + '.tmp')
+        os.replace(vectors_path + '.tmp', vectors_path)
+        meta = {
+            'dimension': self.vectors.dimension,
+            'count': self.size,
+            'times': self.times[:self.size].tolist(),
+            'importances': self.importances[:self.size].tolist(),
+            'instructions': self.instructions,
+            'contents': self.contents,
+            'latest': [str(self.latest[0]), self.latest[1]] if self.latest else None,
+        }
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(meta, file)
+        os.replace(meta_path + '.tmp', meta_path)
+        for path in (log_path, log_vectors_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def append_log(self, index_dir, memory_time, isInstruction, content, importance, vector):
+        # Runs in the log thread. The vector is written first: a record without its vector is not replayed
+        os.makedirs(index_dir, exist_ok=True)
+        _, _, log_path, log_vectors_path = self.paths(index_dir)
+        with open(log_vectors_path, 'ab') as file:
+            file.write(np.asarray(vector, dtype='<f4').tobytes())
+        record = {'time': str(pd.Timestamp(memory_time)), 'isInstruction': int(isInstruction),
+                  'content': content, 'importance': float(importance), 'dimension': len(vector)}
+        with open(log_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(record) + "\n")
+
+    def replay_log(self, index_dir):
+        """
+        Adds the memories of the log to the index, returns how many were new. Called with the lock held.
+        """
+        _, _, log_path, log_vectors_path = self.paths(index_dir)
+        if not (os.path.exists(log_path) and os.path.exists(log_vectors_path)):
+            return 0
+        memories = []
+        vectors = np.fromfile(log_vectors_path, dtype='<f4')
+        offset = 0
+        with open(log_path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # Cut short while being written
+                end = offset + record['dimension']
+                if end > len(vectors):
+                    break
+                memories.append((pd.Timestamp(record['time']), record['isInstruction'], record['content'],
+                                 record['importance'], vectors[offset:end]))
+                offset = end
+        return self.add_batch(memories)
+
+    def load(self, index_dir):
+        """
+        Loads the saved index of the NPC, returns False when there is none or it is unusable.
+        Called with the lock held.
+        """
+        vectors_path, meta_path, _, _ = self.paths(index_dir)
+        if not (os.path.exists(vectors_path) and os.path.exists(meta_path)):
+            return False
+        try:
+            with open(meta_path, encoding='utf-8') as file:
+                meta = json.load(file)
+            vectors = Vectors.load(vectors_path, meta['dimension'])
+            if vectors.count() != meta['count']:
+                raise ValueError(f"{vectors.count()} vectors for {meta['count']} memories")
+        except Exception as e:
+            print(f"Method: MemoryHistory.load | npcId: {self.npcId} | Rebuilding the index: {e}")
+            return False
+        count = meta['count']
+        capacity = max(1024, count)
+        self.vectors = vectors
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.times[:count] = meta['times']
+        self.importances = np.zeros(capacity, dtype=np.float32)
+        self.importances[:count] = meta['importances']
+        self.instructions = list(meta['instructions'])
+        self.contents = list(meta['contents'])
+        self.labels = {(self.times[label], self.instructions[label]): label for label in range(count)}
+        self.latest = (pd.Timestamp(meta['latest'][0]), meta['latest'][1]) if meta['latest'] else None
+        return True
+
+
+class MemoryANN:
+    """
+    npcId -> MemoryHistory, kept up to date by the inserts of BhrDBMemStre.
+    sync_seconds: catch-up interval with the database, 0 when this process writes all the memories
+    persist: save the indexes to index_dir (only in the process that writes the memories, the others only load them)
+    """
+
+    def __init__(self, index_dir=INDEX_DIR, sync_seconds=0, persist=True):
+        self.index_dir = index_dir
+        self.sync_seconds = sync_seconds
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.histories = {}
+        BhrDBMemStre.insert_listeners.append(self.on_insert)
+
+    def catch_up(self, connection, history):
+        # Reads the memories from shortly before the newest one of the index, page by page.
+        # Returns how many were new. Called with the lock held
+        added = 0
+        if history.latest is None:
+            after_time, after_isInstruction = None, -1
+        else:
+            after_time, after_isInstruction = history.latest[0] - pd.Timedelta(seconds=SYNC_OVERLAP_SECONDS), -1
+        while True:
+            page = BhrDBMemStre.retrieve_entries_page(
+                connection, history.npcId,
+                after_time.to_pydatetime() if after_time is not None else None, after_isInstruction, PAGE_SIZE
+            )
+            added += history.add_rows(page)
+            if len(page) < PAGE_SIZE:
+                return added
+            last = page.iloc[-1]
+            after_time, after_isInstruction = pd.Timestamp(last['Time']), int(last['isInstruction'])
+
+    def history(self, connection, npcId):
+        """
+        The memory history of the NPC, loaded from index_dir or built from the database on first use.
+        """
+        with self.lock:
+            history = self.histories.setdefault(str(npcId), MemoryHistory(str(npcId)))
+        with history.lock:
+            if not history.loaded:
+                loaded = history.load(self.index_dir)
+                replayed = history.replay_log(self.index_dir)
+                added = self.catch_up(connection, history)
+                history.loaded = True
+                history.synced_at = time.monotonic()
+                if self.persist and (replayed or added or not loaded):
+                    try:
+                        history.save(self.index_dir)
+                    except Exception as e:
+                        print(f"Method: MemoryANN.history | npcId: {npcId} | Could not save the index: {e}")
+                source = "Loaded from disk" if loaded else "Built"
+                print(f"Method: MemoryANN.history | npcId: {npcId} | {source}: {history.size} memories, "
+                      f"{replayed} from the log, {added} new from the database ({Vectors.__name__})")
+            elif self.sync_seconds and time.monotonic() - history.synced_at > self.sync_seconds:
+                self.catch_up(connection, history)
+                history.synced_at = time.monotonic()
+        return history
+
+    def on_insert(self, npcID, memory_time, isInstruction, content, importance, embedding):
+        # NPCs not loaded yet will read the new memory from the database
+        with self.lock:
+            history = self.histories.get(str(npcID))
+        if history is None:
+            return
+        with history.lock:
+            if not history.loaded:
+                return
+            history.add_batch([(memory_time, isInstruction, content, importance, embedding)])
+        if self.persist:
+            log_executor.submit(self._append_log, history, memory_time, isInstruction, content, importance, unit_vector(embedding))
+
+    def _append_log(self, history, memory_time, isInstruction, content, importance, vector):
+        try:
+            history.append_log(self.index_dir, memory_time, isInstruction, content, importance, vector)
+        except Exception as e:
+            print(f"Method: MemoryANN.on_insert | npcId: {history.npcId} | Could not log the memory: {e}")
@@ -0,0 +1,165 @@
+import sys
+import os
+import time
+import threading
+import configparser
+
+import numpy as np
+import pandas as pd
+
+# Add the base directory (one level up from the current directory)
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(base_dir)
+
+from DBConnect import BhrDBMemStre
+
+# Warm in-process index of the memory streams.
+# Each NPC gets a ring buffer of its most recent memories: unit-length float32
+# embeddings, times, importances and contents. It is loaded from
+# behavior_memeory_stream on the NPC's first request, then appended to by every
+# BhrDBMemStre.insert_into_table of this process, so retrieving memories needs
+# no query and no unpickling. The database stays the durable store.
+# A process that does not write the memories itself (the comment reply
+# controller) catches up on the rows written since its last look every
+# sync_seconds. It re-reads the last sync_overlap_seconds before the newest
+# memory it has, since rows of the same time (an input and an instruction
+# memory) are written in parallel and can commit in any order; the rows it
+# already has are matched by their primary key and not added twice.
+# Settings come from the optional [MemoryIndex] section of config.ini:
+#   enabled = true
+#   capacity = 300        memories kept per NPC, as the LIMIT of the database retrieval
+#   sync_seconds = 5      catch-up interval of the processes that only read
+#   sync_overlap_seconds = 60
+
+config = configparser.ConfigParser()
+config.read(os.path.join(base_dir, 'config.ini'))
+
+ENABLED = config.getboolean('MemoryIndex', 'enabled', fallback=True)
+CAPACITY = config.getint('MemoryIndex', 'capacity', fallback=300)
+SYNC_SECONDS = config.getfloat('MemoryIndex', 'sync_seconds', fallback=5)
+SYNC_OVERLAP_SECONDS = config.getfloat('MemoryIndex', 'sync_overlap_seconds', fallback=60)
+
+
+def to_seconds(value):
+    return pd.Timestamp(value).value / 1e9
+
+
+class MemoryRing:
+    """
+    The most recent memories of one NPC, the oldest added is replaced once it is full.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.synced_at = 0.0
+        self.embeddings = None  # (capacity, dimension) float32, allocated with the first memory
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.importances = np.zeros(capacity, dtype=np.float32)
+        self.contents = [None] * capacity
+        self.keys = [None] * capacity
+        self.slots = {}  # (time, isInstruction) -> slot, as the primary key of the table
+        self.next_slot = 0
+        self.size = 0
+        self.latest = None  # time of the most recent memory
+
+    def add(self, memory_time, isInstruction, content, importance, embedding):
+        # Called with the lock held
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        if self.embeddings is None:
+            self.embeddings = np.zeros((self.capacity, len(vector)), dtype=np.float32)
+        elif len(vector) != self.embeddings.shape[1]:
+            print(f"Method: MemoryRing.add | Skipped an embedding of dimension {len(vector)} instead of {self.embeddings.shape[1]}")
+            return
+        seconds = to_seconds(memory_time)
+        key = (seconds, int(isInstruction))
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.next_slot
+            if self.keys[slot] is not None:
+                del self.slots[self.keys[slot]]
+            self.keys[slot] = key
+            self.slots[key] = slot
+            self.next_slot = (slot + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+        norm = np.linalg.norm(vector)
+        self.embeddings[slot] = vector / norm if norm else vector
+        self.times[slot] = seconds
+        self.importances[slot] = importance
+        self.contents[slot] = content
+        if self.latest is None or pd.Timestamp(memory_time) > self.latest:
+            self.latest = pd.Timestamp(memory_time)
+
+    def add_rows(self, rows_df):
+        for row in rows_df.sort_values(by='Time').itertuples(index=False):
+            self.add(row.Time, row.isInstruction, row.Content, row.Importance, row.Embedding)
+
+    def query(self, retriever, query_embedding, current_time, k):
+        """
+        Contents and scores of the k most relevant memories before current_time, most recent first.
+        retriever: a BhrLgcMemRetriever.MemoryRetriever
+        """
+        now = to_seconds(current_time)
+        with self.lock:
+            if not self.size:
+                return [], []
+            times = self.times[:self.size]
+            before = times < now
+            if before.all():
+                ages = now - times
+                importances = self.importances[:self.size]
+                embeddings = self.embeddings[:self.size]
+                rows = np.arange(self.size)
+            else:
+                rows = np.flatnonzero(before)
+                if not len(rows):
+                    return [], []
+                ages = now - times[rows]
+                importances = self.importances[rows]
+                embeddings = self.embeddings[rows]
+            scores = retriever.scores(query_embedding, ages, importances, embeddings)
+            best = retriever.top_k(scores, ages, k)
+            return [self.contents[rows[i]] for i in best], scores[best].tolist()
+
+
+class MemoryIndex:
+    """
+    npcId -> MemoryRing, kept up to date by the inserts of BhrDBMemStre.
+    sync_seconds: catch-up interval with the database, 0 when this process writes all the memories
+    """
+
+    def __init__(self, capacity=CAPACITY, sync_seconds=0):
+        self.capacity = capacity
+        self.sync_seconds = sync_seconds
+        self.lock = threading.Lock()
+        self.rings = {}
+        BhrDBMemStre.insert_listeners.append(self.on_insert)
+
+    def ring(self, connection, npcId, current_time):
+        """
+        The memory ring of the NPC, loaded from the database on first use.
+        """
+        with self.lock:
+            ring = self.rings.setdefault(str(npcId), MemoryRing(self.capacity))
+        with ring.lock:
+            if not ring.loaded:
+                ring.add_rows(BhrDBMemStre.retrieve_most_recent_entries(connection, npcId, current_time, self.capacity))
+                ring.loaded = True
+                ring.synced_at = time.monotonic()
+                print(f"Method: MemoryIndex.ring | npcId: {npcId} | Loaded {ring.size} memories")
+            elif self.sync_seconds and time.monotonic() - ring.synced_at > self.sync_seconds and ring.latest is not None:
+                since = ring.latest - pd.Timedelta(seconds=SYNC_OVERLAP_SECONDS)
+                ring.add_rows(BhrDBMemStre.retrieve_entries_after_time(connection, npcId, since.to_pydatetime(), self.capacity))
+                ring.synced_at = time.monotonic()
+        return ring
+
+    def on_insert(self, npcID, memory_time, isInstruction, content, importance, embedding):
+        # NPCs not loaded yet will read the new memory from the database
+        with self.lock:
+            ring = self.rings.get(str(npcID))
+        if ring is None:
+            return
+        with ring.lock:
+            if ring.loaded:
+                ring.add(memory_time, isInstruction, content, importance, embedding)
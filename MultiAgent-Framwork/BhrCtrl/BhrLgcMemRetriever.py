@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+# Memory retrieval scoring.
+# Memories are ranked by
+#   a_recency * recency + a_importance * importance + a_similarity * cosine similarity
+# with recency = exp(decay_rate * (memory time - current time in seconds)).
+# The embeddings of all the candidate memories are stacked in one float32 matrix
+# with unit rows, so the similarities are a single matrix-vector product, the
+# three scores are computed for all memories at once, and the top k are picked
+# with argpartition instead of sorting every memory.
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def stack_embeddings(embeddings):
+    """
+    float32 matrix of the embeddings (one row each), rows scaled to unit length.
+    """
+    matrix = np.asarray(list(embeddings), dtype=np.float32)
+    if matrix.ndim != 2:
+        matrix = matrix.reshape(len(matrix), -1)
+    return normalize_rows(matrix)
+
+def seconds_since(times, current_time):
+    """
+    Seconds from each time to current_time (positive for times before it).
+    """
+    times = pd.to_datetime(pd.Series(times)).to_numpy(dtype='datetime64[ns]')
+    now = pd.Timestamp(current_time).to_datetime64()
+    return (now - times) / np.timedelta64(1, 's')
+
+
+class MemoryRetriever:
+    """
+    Ranks the memories of an NPC for a query embedding.
+    hourly_decay: optional extra factor exp(-hourly_decay * hours since the memory) on the recency
+    """
+
+    def __init__(self, a_recency=0.2, a_importance=0.2, a_similarity=0.6, decay_rate=0.001, hourly_decay=0.0):
+        self.a_recency = a_recency
+        self.a_importance = a_importance
+        self.a_similarity = a_similarity
+        self.decay_rate = decay_rate
+        self.hourly_decay = hourly_decay
+
+    def scores(self, query_embedding, ages, importances, embeddings):
+        """
+        Retrieval score of each memory.
+        ages: seconds since each memory, importances: importance of each memory,
+        embeddings: unit-row float32 matrix (stack_embeddings)
+        """
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        query_norm = np.linalg.norm(query)
+        similarity = embeddings @ (query / query_norm if query_norm else query)
+        recency = np.exp(-self.decay_rate * ages)
+        if self.hourly_decay:
+            recency = recency * np.exp(-self.hourly_decay * ages / 3600)
+        return (
+            self.a_recency * recency
+            + self.a_importance * np.asarray(importances, dtype=np.float32)
+            + self.a_similarity * similarity
+        )
+
+    def top_k(self, scores, ages, k):
+        """
+        Indices of the k best scores, most recent memory first.
+        """
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(scores))
+        return best[np.argsort(ages[best], kind='stable')]
+
+    def rank(self, rows_df, query_embedding, current_time, k):
+        """
+        The k most relevant rows of a memory stream DataFrame (Time, Importance and Embedding
+        columns), most recent first, with their score in a retrieval_score column.
+        """
+        if rows_df is None or rows_df.empty:
+            return rows_df
+        ages = seconds_since(rows_df['Time'], current_time)
+        scores = self.scores(
+            query_embedding, ages, rows_df['Importance'].to_numpy(), stack_embeddings(rows_df['Embedding'])
+        )
+        best = self.top_k(scores, ages, k)
+        ranked = rows_df.iloc[best].copy()
+        ranked['retrieval_score'] = scores[best]
+        return ranked
@@ -16,6 +16,12 @@ from DBConnect import BhrDBReflection
 from DBConnect import BhrDBSchedule
 import BhrCtrl.BhrLgcToMemStre as BhrLgcToMemStre
 import BhrCtrl.BhrLgcProcessOnce as BhrLgcProcessOnce
+from LLMConnect import LLMCon
+from LLMConnect import LLMRateLimit
+from LLMConnect import LLMHedge
+from LLMConnect import LLMBreaker
+from LLMConnect import LLMRetry
+from LLMConnect import LLMPrompt
 
 def clear_printout_folder():
     printout_folder = os.path.join(base_dir, 'BhrCtrl', 'printout')
@@ -107,4 +113,11 @@ with ThreadPoolExecutor(max_workers=num_workers) as executor:
                 print(f"Exception in worker: {e}")
         
         n += num_workers
+        LLMCon.print_pool_stats()
+        LLMRateLimit.print_limiter_stats()
+        LLMHedge.print_hedge_stats()
+        LLMBreaker.print_breaker_stats()
+        LLMRetry.print_retry_stats()
+        LLMPrompt.print_budget_stats()
+        LLMPrompt.print_cache_stats()
         time.sleep(2)
\ No newline at end of file
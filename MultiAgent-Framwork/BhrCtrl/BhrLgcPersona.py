@@ -0,0 +1,85 @@
+import threading
+
+# Static prompt blocks of each NPC.
+# Providers reuse the longest prompt prefix they have already processed (OpenAI
+# from 1024 tokens, DeepSeek by blocks of 64 tokens), so the prompts of
+# BhrLgcGPTProcess start with what never changes for an NPC -- who it is, the
+# other characters, its actions, its way of speaking, the answer format -- and
+# end with what changes on every call (time, schedule, memories, reflections).
+# The blocks are compiled once when char_config.yaml is loaded, and each
+# prompt's static prefix is built once per NPC on first use.
+
+FIND_ACTION_ID = 127
+
+
+def _speech_field(speech, key):
+    # The YAML block indicator ('>') can be part of the string
+    return speech.get(key, '').lstrip('> ').strip()
+
+
+class Persona:
+    """
+    Static blocks of one NPC, from its entry in char_config.yaml.
+    town: the characters it knows (get_npc_descriptions), npc_id_mapping: "npcId : Name" lines
+    """
+
+    def __init__(self, npc, town, npc_id_mapping):
+        self.npcId = npc['npcId']
+        self.name = npc['name']
+        self.description = npc['description']
+        self.town = town
+        self.npc_id_mapping = npc_id_mapping
+        self.example_schedule = npc.get('schedule', [])
+
+        actions = npc.get('availableActions', [])
+        self.available_actions = actions
+        self.action_ids = [action['actionId'] for action in actions if action['actionId'] != FIND_ACTION_ID]
+        # Action lists in the formats used by the different prompts
+        self.decision_actions = "".join(
+            f"- **{action['actionName']}**: {action['description']} (location: {action['location']})\n"
+            for action in actions
+        )
+        self.fused_actions = "\n".join(
+            f"- {action['actionId']} : {action['actionName']}, {action['description']} (oid: {action['location']})"
+            for action in actions
+        )
+        self.all_actions = "\n".join(
+            f"- {action['actionId']} : {action['actionName']}, {action['description']}." for action in actions
+        )
+        self.find_actions = "\n".join(
+            f"- {action['actionId']} : {action['actionName']}, {action['description']}."
+            for action in actions if action['actionId'] == FIND_ACTION_ID
+        )
+        self.other_actions = "".join(
+            f"- {action['actionId']} : {action['actionName']}, {action['description']}.\n"
+            for action in actions if action['actionId'] != FIND_ACTION_ID
+        )
+        self.locations = "".join(f"{action['location']}," for action in actions)
+
+        speech = npc.get('announcements') or {}
+        self.format_instructions = _speech_field(speech, 'Format')
+        self.tone_instructions = _speech_field(speech, 'Tone')
+        self.talk_examples = _speech_field(speech, 'Talk')
+
+        self.lock = threading.Lock()
+        self.prefixes = {}
+
+    def prefix(self, name, build):
+        """
+        Static prefix of the prompt name, built by build() on first use.
+        """
+        with self.lock:
+            if name not in self.prefixes:
+                self.prefixes[name] = build()
+            return self.prefixes[name]
+
+
+def compile_personas(char_config, town_of, npc_id_mapping):
+    """
+    Returns npcId -> Persona for every NPC of char_config.
+    town_of: npcId -> characters that NPC knows
+    """
+    return {
+        npc['npcId']: Persona(npc, town_of(npc['npcId']), npc_id_mapping)
+        for npc in char_config.get('npcCharacters', [])
+    }
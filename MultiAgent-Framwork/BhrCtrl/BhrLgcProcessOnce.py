@@ -1,14 +1,12 @@
 import sys
 import os
-import pandas as pd
-import numpy as np
 import json
-import re
 import pickle
 import hashlib
 import configparser
 import yaml
 import traceback
+import time
 
 # Add the base directory (one level up from the current directory)
 base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -25,6 +23,16 @@ from DBConnect import BhrDBSchedule
 import BhrLgcGPTProcess
 import BhrLgcManualProcess
 import BhrLgcToMemStre
+import BhrLgcTaskGraph
+import BhrLgcInstSchema
+import BhrLgcCondensedContext
+import BhrLgcMemRetriever
+import BhrLgcMemIndex
+import BhrLgcMemANN
+from LLMConnect import LLMRateLimit
+from LLMConnect import LLMHedge
+from LLMConnect import LLMRetry
+from LLMConnect import LLMPrompt
 
 config = configparser.ConfigParser()
 # Adjust path to look for config.ini in AImodule regardless of the current directory
@@ -32,6 +40,13 @@ base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 config_path = os.path.join(base_dir, 'config.ini')
 config.read(config_path)
 
+# Weights of recency, importance and similarity of the relevant memories
+memory_retriever = BhrLgcMemRetriever.MemoryRetriever(a_recency=0.2, a_importance=0.2, a_similarity=0.6, decay_rate=0.001)
+# Memories of each NPC kept in memory, this process writes them all
+memory_index = BhrLgcMemIndex.MemoryIndex(sync_seconds=0)
+# Whole memory history of each NPC, searched by nearest neighbours, saved to disk by this process
+memory_ann = BhrLgcMemANN.MemoryANN(sync_seconds=0, persist=True)
+
 yaml_path = os.path.join(base_dir, 'char_config.yaml')
 
 # Load the YAML file
@@ -40,6 +55,90 @@ with open(yaml_path, 'r', encoding='utf-8' ) as file:
     print("YAML content loaded successfully.")
 
 
+def decideNextAction(memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, special_instruction):
+    """
+    Decides the next action of an idle NPC using the decision mode configured for it
+    (`decisionMode` in char_config.yaml), and prints the latency for comparing the modes.
+    Returns (instruction_in_human, words_to_say, instruction_json). instruction_json is
+    None in chain mode, where the instruction is translated to JSON afterwards.
+    """
+    mode = BhrLgcGPTProcess.get_decision_mode(npcId)
+    start_time = time.time()
+    instruction_json = None
+
+    if mode == "fused":
+        try:
+            instruction_in_human, words_to_say, instruction_json = BhrLgcGPTProcess.decideNextActionFused(
+                memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, special_instruction
+            )
+        except Exception as e:
+            print(f"Fused decision failed: {e}. Falling back to the multi-call chain.")
+            mode = "chain"
+
+    if mode == "chain":
+        instruction_in_human = BhrLgcGPTProcess.processInputGiveWhatToDo(
+            memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, special_instruction
+        )
+        if BhrLgcGPTProcess.needDeepTalk(
+            memories_str, prior_reflection_str, inputInHumanString, instruction_in_human, npcId
+        ):
+            theme_for_generation = BhrLgcGPTProcess.generateTheme(
+                memories_str, prior_reflection_str, inputInHumanString, instruction_in_human, npcId
+            )
+            words_to_say = BhrLgcGPTProcess.generate_new_Announcement(
+                memories_str, prior_reflection_str, theme_for_generation, npcId
+            )
+        else:
+            words_to_say = BhrLgcGPTProcess.generateMultipleSentencesForAction(
+                memories_str, prior_reflection_str, cur_schedule_str, instruction_in_human, npcId
+            )
+
+    print(f"Decision mode: {mode} | npcId: {npcId} | Decision time: {time.time() - start_time:.2f}s")
+    return instruction_in_human, words_to_say, instruction_json
+
+
+def talkNextTurn(memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, isFinding, target_name, target_npc_id, inner_voice):
+    """
+    Produces the next sentence of a conversation using the talk mode configured for the NPC
+    (`talkMode` in char_config.yaml), and prints the latency for comparing the modes.
+    Returns (instruction_in_human, instruction_json). instruction_json is None in chain mode,
+    where the sentence is translated to JSON afterwards by humanInstToJava_talk.
+    """
+    mode = BhrLgcGPTProcess.get_talk_mode(npcId)
+    if target_npc_id is None:
+        # The local JSON needs the target npcId, let the translator look it up
+        mode = "chain"
+    start_time = time.time()
+    instruction_json = None
+
+    if mode == "fused":
+        try:
+            with LLMRateLimit.priority(LLMRateLimit.PRIORITY_HIGH), LLMHedge.deadline(LLMHedge.TALK_DEADLINE):
+                content, ending_talk, mood = BhrLgcGPTProcess.talkTurn(
+                    memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, isFinding, target_name, inner_voice
+                )
+            instruction_json = BhrLgcManualProcess.talkTurnInstruction(npcId, target_npc_id, content, ending_talk, mood)
+            npc_name = next((npc['name'] for npc in char_config['npcCharacters'] if npc['npcId'] == npcId), npcId)
+            instruction_in_human = f'{npc_name} is feeling {mood}, and talking to {target_name}, "{content}". '
+            instruction_in_human += "End the conversation" if ending_talk else "Continue Conversation"
+        except Exception as e:
+            print(f"Fused talk turn failed: {e}. Falling back to the multi-call chain.")
+            mode = "chain"
+
+    if mode == "chain":
+        with LLMRateLimit.priority(LLMRateLimit.PRIORITY_HIGH), LLMHedge.deadline(LLMHedge.TALK_DEADLINE):
+            instruction_in_human = BhrLgcGPTProcess.talkToSomeone(
+                memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, isFinding, target_name, inner_voice
+            )
+            shouldConversationEnd = BhrLgcGPTProcess.shoudConversationEnd(
+                memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, isFinding, target_name, instruction_in_human
+            )
+        instruction_in_human +=  ". " + shouldConversationEnd
+
+    print(f"Talk mode: {mode} | npcId: {npcId} | Talk turn time: {time.time() - start_time:.2f}s")
+    return instruction_in_human, instruction_json
+
+
 def processOneInputGiveOneInstruction():
     """
     Process one input from the Java buffer and generate one instruction for the NPC.
@@ -84,44 +183,42 @@ def processOneInputGiveOneInstruction():
         # Parse NPC info for next action
         inputInHumanString = BhrLgcManualProcess.parse_npc_info_for_nextaction(java_json)
 
-        # Get relevant memories
-        BufferRowEmbedding = BhrLgcGPTProcess.get_embedding(inputInHumanString)
-        db_conn = DBCon.check_and_reconnect(db_conn)
-        rows_df = BhrDBMemStre.retrieve_most_recent_entries(db_conn, npcId, curTime)
-
-        if rows_df is not None:
-            rows_df['Time'] = pd.to_datetime(rows_df['Time'])
-            rows_df['TimeDifference'] = (rows_df['Time'] - pd.to_datetime(curTime)).dt.total_seconds()
-            decay_rate = 0.001
-            rows_df['recency'] = np.exp(decay_rate * rows_df['TimeDifference'])
-
-            def cosine_similarity(vec1, vec2):
-                dot_product = np.dot(vec1, vec2)
-                norm_vec1 = np.linalg.norm(vec1)
-                norm_vec2 = np.linalg.norm(vec2)
-                return dot_product / (norm_vec1 * norm_vec2)
-
-            rows_df['cosine_similarity'] = rows_df['Embedding'].apply(
-                lambda x: cosine_similarity(BufferRowEmbedding, np.array(x))
-            )
-
-            # Adjusting weights for retrieval score
-            a_recency = 0.2
-            a_importance = 0.2
-            a_similarity = 0.6
+        # Read memories, reflection and schedule from the database while the input is being embedded.
+        # With the memory index, the memories are only read on the NPC's first request
+        def read_stored_context():
+            nonlocal db_conn
+            db_conn = DBCon.check_and_reconnect(db_conn)
+            if BhrLgcMemANN.ENABLED:
+                stored_memories = memory_ann.history(db_conn, npcId)
+            elif BhrLgcMemIndex.ENABLED:
+                stored_memories = memory_index.ring(db_conn, npcId, curTime)
+            else:
+                stored_memories = BhrDBMemStre.retrieve_most_recent_entries(db_conn, npcId, curTime)
+            db_conn = DBCon.check_and_reconnect(db_conn)
+            prior_reflection = BhrDBReflection.retrieve_last_entry_before_time(db_conn, npcId, curTime)
+            db_conn = DBCon.check_and_reconnect(db_conn)
+            cur_schedule = BhrDBSchedule.retrieve_latest_schedule(db_conn, npcId)
+            return stored_memories, prior_reflection, cur_schedule
+
+        stored_context = BhrLgcTaskGraph.run_task_graph({
+            'input_embedding': (lambda: BhrLgcGPTProcess.get_embedding(inputInHumanString), []),
+            'stored_context': (read_stored_context, []),
+            'condensed_context': (lambda: BhrLgcCondensedContext.store.get(npcId), []),
+        })
+        BufferRowEmbedding = stored_context['input_embedding']
+        stored_memories, prior_reflection, cur_schedule = stored_context['stored_context']
+        condensed_context_str = stored_context['condensed_context']
 
-            rows_df['retrieval_score'] = (
-                a_recency * rows_df['recency'] +
-                a_importance * rows_df['Importance'] +
-                a_similarity * rows_df['cosine_similarity']
+        # Get relevant memories
+        # Keeps the scores, so prompts over their token budget drop the least relevant memories first
+        if BhrLgcMemANN.ENABLED or BhrLgcMemIndex.ENABLED:
+            contents, scores = stored_memories.query(memory_retriever, BufferRowEmbedding, curTime, k=30)
+            memories_str = LLMPrompt.RankedText([str(content) for content in contents], scores) if contents else 'No memory yet'
+        elif stored_memories is not None and not stored_memories.empty:
+            rows_df_ranked = memory_retriever.rank(stored_memories, BufferRowEmbedding, curTime, k=30)
+            memories_str = LLMPrompt.RankedText(
+                rows_df_ranked['Content'].astype(str).tolist(), rows_df_ranked['retrieval_score'].tolist()
             )
-
-            rows_df_ranked = rows_df.sort_values(
-                by=['retrieval_score', 'Time'], ascending=[False, False]
-            ).head(30)
-            rows_df_ranked = rows_df_ranked.sort_values(by='Time', ascending=False)
-            paragraph = "\n".join(rows_df_ranked['Content'].astype(str).tolist())
-            memories_str = paragraph
         else:
             memories_str = 'No memory yet'
 
@@ -132,9 +229,7 @@ def processOneInputGiveOneInstruction():
         print(memories_str)
         print()
 
-        # Retrieve latest reflection
-        db_conn = DBCon.check_and_reconnect(db_conn)
-        prior_reflection = BhrDBReflection.retrieve_last_entry_before_time(db_conn, npcId, curTime)
+        # Latest reflection
         if prior_reflection is not None:
             prior_reflection_str = str(prior_reflection[2])
         else:
@@ -144,9 +239,13 @@ def processOneInputGiveOneInstruction():
         print(prior_reflection_str)
         print()
 
-        # Retrieve latest Schedule
-        db_conn = DBCon.check_and_reconnect(db_conn)
-        cur_schedule = BhrDBSchedule.retrieve_latest_schedule(db_conn, npcId)
+        # Decisions and talk turns use the condensed context and the most relevant memories
+        # once the NPC has one; the schedule and the reflections below keep the raw ones
+        decision_memories_str, decision_reflection_str = BhrLgcCondensedContext.decision_context(
+            memories_str, prior_reflection_str, condensed_context_str
+        )
+
+        # Latest Schedule
         if cur_schedule is not None:
             cur_schedule_str = str(cur_schedule['schedule'])
         else:
@@ -167,6 +266,8 @@ def processOneInputGiveOneInstruction():
 
         is_talk_instruction = False
         talkInst_target_npcid = None
+        # Set when the action JSON was already produced by a fused decision or talk turn
+        fused_instruction_json = None
 
     
         npcId_to_Name = {npc['npcId']: npc['name'] for npc in char_config.get('npcCharacters', [])}
@@ -180,22 +281,9 @@ def processOneInputGiveOneInstruction():
             if target_sleeping or target_talking:
                 # Target is not available for conversation
                 print('Target is sleeping or talking, choose another action')
-                instruction_in_human = BhrLgcGPTProcess.processInputGiveWhatToDo(
-                    memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, "Your next action can't be go find him to talk again, the target is not available" + " " + inner_voice
+                instruction_in_human, words_to_say, fused_instruction_json = decideNextAction(
+                    decision_memories_str, decision_reflection_str, cur_schedule_str, inputInHumanString, npcId, "Your next action can't be go find him to talk again, the target is not available" + " " + inner_voice
                 )
-                if BhrLgcGPTProcess.needDeepTalk(
-                    memories_str, prior_reflection_str, inputInHumanString, instruction_in_human, npcId
-                ):
-                    theme_for_generation = BhrLgcGPTProcess.generateTheme(
-                        memories_str, prior_reflection_str, inputInHumanString, instruction_in_human, npcId
-                    )
-                    words_to_say = BhrLgcGPTProcess.generate_new_Announcement(
-                        memories_str, prior_reflection_str, theme_for_generation, npcId
-                    )
-                else:
-                    words_to_say = BhrLgcGPTProcess.generateMultipleSentencesForAction(
-                        memories_str, prior_reflection_str, cur_schedule_str, instruction_in_human, npcId
-                    )
                 target_name = sleep_target_name if sleep_target_name else (talk_target_name if talk_target_name else 'Unknown')
                 instruction_in_human += f" I went to the {target_name} but he is not available, going to do something else now."
                 is_talk_instruction = False
@@ -203,13 +291,9 @@ def processOneInputGiveOneInstruction():
                 print('Start Talking to the person')
                 FindTalktargetNPCName= npcId_to_Name[FindTalktargetNPCId]
                 talkInst_target_npcid = FindTalktargetNPCId
-                instruction_in_human = BhrLgcGPTProcess.talkToSomeone(
-                    memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, is_findingToTalk, FindTalktargetNPCName, inner_voice
+                instruction_in_human, fused_instruction_json = talkNextTurn(
+                    decision_memories_str, decision_reflection_str, cur_schedule_str, inputInHumanString, npcId, is_findingToTalk, FindTalktargetNPCName, talkInst_target_npcid, inner_voice
                 )
-                shouldConversationEnd = BhrLgcGPTProcess.shoudConversationEnd(
-                    memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, is_findingToTalk, FindTalktargetNPCName, instruction_in_human
-                )
-                instruction_in_human +=  ". " + shouldConversationEnd
                 words_to_say = ''
                 is_talk_instruction = True
 
@@ -220,35 +304,18 @@ def processOneInputGiveOneInstruction():
             if not shop_target_present: # Shop owner will have status sale, if he is not talking, so this also indicate that shop owner is not talking
                 # Shop owner not present
                 print('Shop owner not present, choose another action')
-                instruction_in_human = BhrLgcGPTProcess.processInputGiveWhatToDo(
-                    memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, "Your next action can't be buying, the shop owner is not present" + " " + inner_voice
+                instruction_in_human, words_to_say, fused_instruction_json = decideNextAction(
+                    decision_memories_str, decision_reflection_str, cur_schedule_str, inputInHumanString, npcId, "Your next action can't be buying, the shop owner is not present" + " " + inner_voice
                 )
-                if BhrLgcGPTProcess.needDeepTalk(
-                    memories_str, prior_reflection_str, inputInHumanString, instruction_in_human, npcId
-                ):
-                    theme_for_generation = BhrLgcGPTProcess.generateTheme(
-                        memories_str, prior_reflection_str, inputInHumanString, instruction_in_human, npcId
-                    )
-                    words_to_say = BhrLgcGPTProcess.generate_new_Announcement(
-                        memories_str, prior_reflection_str, theme_for_generation, npcId
-                    )
-                else:
-                    words_to_say = BhrLgcGPTProcess.generateMultipleSentencesForAction(
-                        memories_str, prior_reflection_str, cur_schedule_str, instruction_in_human, npcId
-                    )
                 instruction_in_human += f" I went to {shopowner_target_name}'s store to buy but he is not there, purchase failed, doing something else now."
                 is_talk_instruction = False
             else:
                 print('Start Talking to the shop owner')
                 shopownerNPCname = npcId_to_Name[shopownerNPCId]
                 talkInst_target_npcid = shopownerNPCId
-                instruction_in_human = BhrLgcGPTProcess.talkToSomeone(
-                    memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, is_findingToTalk, shopownerNPCname, inner_voice
+                instruction_in_human, fused_instruction_json = talkNextTurn(
+                    decision_memories_str, decision_reflection_str, cur_schedule_str, inputInHumanString, npcId, is_findingToTalk, shopownerNPCname, talkInst_target_npcid, inner_voice
                 )
-                shouldConversationEnd = BhrLgcGPTProcess.shoudConversationEnd(
-                    memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, is_findingToTalk, shopownerNPCname, instruction_in_human
-                )
-                instruction_in_human +=  ". " + shouldConversationEnd
                 words_to_say = ''
                 is_talk_instruction = True
 
@@ -256,66 +323,47 @@ def processOneInputGiveOneInstruction():
             # NPC currently talking
             talk_target_name, talk_target_npcid =  BhrLgcManualProcess.parse_current_converstation(java_json)
             talkInst_target_npcid = talk_target_npcid
-            instruction_in_human = BhrLgcGPTProcess.talkToSomeone(
-                memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, is_findingToTalk, talk_target_name, inner_voice
+            instruction_in_human, fused_instruction_json = talkNextTurn(
+                decision_memories_str, decision_reflection_str, cur_schedule_str, inputInHumanString, npcId, is_findingToTalk, talk_target_name, talkInst_target_npcid, inner_voice
             )
-            shouldConversationEnd = BhrLgcGPTProcess.shoudConversationEnd(
-                    memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, is_findingToTalk, talk_target_name, instruction_in_human
-                )
-            instruction_in_human +=  ". " + shouldConversationEnd
             words_to_say = ''
             is_talk_instruction = True
 
         elif is_idling and (not is_talking): 
             # NPC is idling, decide next action
             print('Is idling, decide next action')
-            instruction_in_human = BhrLgcGPTProcess.processInputGiveWhatToDo(
-                memories_str, prior_reflection_str, cur_schedule_str, inputInHumanString, npcId, inner_voice
+            instruction_in_human, words_to_say, fused_instruction_json = decideNextAction(
+                decision_memories_str, decision_reflection_str, cur_schedule_str, inputInHumanString, npcId, inner_voice
             )
-            if BhrLgcGPTProcess.needDeepTalk(
-                memories_str, prior_reflection_str, inputInHumanString, instruction_in_human, npcId
-            ):
-                theme_for_generation = BhrLgcGPTProcess.generateTheme(
-                    memories_str, prior_reflection_str, inputInHumanString, instruction_in_human, npcId
-                )
-                words_to_say = BhrLgcGPTProcess.generate_new_Announcement(
-                    memories_str, prior_reflection_str, theme_for_generation, npcId
-                )
-            else:
-                words_to_say = BhrLgcGPTProcess.generateMultipleSentencesForAction(
-                    memories_str, prior_reflection_str, cur_schedule_str, instruction_in_human, npcId
-                )
             is_talk_instruction = False
 
         # Generate final instruction JSON
         instruction_to_give = None
-        if instruction_in_human != '':
-            retry = 0
-            while retry < 3:
-                try:
-                    if is_talk_instruction:
-                        instruction_to_give = BhrLgcGPTProcess.humanInstToJava_talk(
-                            instruction_in_human, words_to_say, npcId, talkInst_target_npcid
-                        )
-                    else:
-                        instruction_to_give = BhrLgcGPTProcess.humanInstToJava_action(
-                            instruction_in_human, words_to_say, npcId
-                        )
-                    match = re.search(r'```json\n(.*?)\n```', instruction_to_give, re.DOTALL)
-                    if match:
-                        instruction_to_give = match.group(1)
-                    else:
-                        instruction_to_give = instruction_to_give.replace('```json', '').replace('```', '')
-                    instruction_json = json.loads(instruction_to_give)
-                    instruction_json['requestId'] = request_id
-                    # Re-serialize the JSON after adding requestId
-                    instruction_to_give = json.dumps(instruction_json)
-                    break
-                except Exception as e:
-                    print(f"Error occurred: {e}. Retrying...")
-                    retry += 1
-                    if retry == 3:
-                        return 0
+        if fused_instruction_json is not None:
+            instruction_json = fused_instruction_json
+            instruction_json['requestId'] = request_id
+            instruction_to_give = json.dumps(instruction_json)
+        elif instruction_in_human != '':
+            # The translation comes back as schema-constrained JSON, checked and repaired
+            # locally, so a new call is only made when the answer can't be repaired
+            def translate_instruction():
+                if is_talk_instruction:
+                    return BhrLgcGPTProcess.humanInstToJava_talk(
+                        instruction_in_human, words_to_say, npcId, talkInst_target_npcid
+                    )
+                return BhrLgcGPTProcess.humanInstToJava_action(
+                    instruction_in_human, words_to_say, npcId
+                )
+
+            instruction_json = LLMRetry.retry_call(
+                translate_instruction, name='instruction_translation', attempts=2,
+                retry_on=(BhrLgcInstSchema.InstructionError,), default=None,
+            )
+            if instruction_json is None:
+                return 0
+            instruction_json['requestId'] = request_id
+            # Re-serialize the JSON after adding requestId
+            instruction_to_give = json.dumps(instruction_json)
 
         if instruction_to_give is not None:
             print('Instruction to give:')
@@ -332,57 +380,105 @@ def processOneInputGiveOneInstruction():
 
         # If we produced an instruction
         if instruction_to_give is not None:
-            # Check if a new schedule is needed
-            if BhrLgcGPTProcess.need_new_schedule(cur_schedule_str, memories_str, prior_reflection_str, inputInHumanString, npcId):
-                cur_schedule_str = BhrLgcGPTProcess.generate_schedule(
-                    cur_schedule_str, memories_str, prior_reflection_str, inputInHumanString, npcId
-                )
-                db_conn = DBCon.check_and_reconnect(db_conn)
-                BhrDBSchedule.insert_into_table(db_conn, npcId, curTime, cur_schedule_str)
-
-            print('Current Schedule:')
-            print(cur_schedule)
-            print()
-
+            # The follow-up work is run as a dependency graph: the schedule update
+            # and the importance scoring are independent of each other, the memory
+            # writes and the tracer reuse the scores, and only the reflection check
+            # has to wait for the tracer.
             data = json.loads(java_json)
             npcs = data.get('npcs', [])
-            if len(npcs) > 0:
-                npc = npcs[0]
-                talk_info = npc.get('talk', {})
-                is_talking = talk_info.get('isTalking', False)
+            is_talking = len(npcs) > 0 and npcs[0].get('talk', {}).get('isTalking', False)
+            input_for_mem = BhrLgcManualProcess.parse_npc_info_formemory(java_json) if is_talking else None
+
+            def update_schedule():
+                # Check if a new schedule is needed
+                new_schedule_str = cur_schedule_str
+                if BhrLgcGPTProcess.need_new_schedule(cur_schedule_str, memories_str, prior_reflection_str, inputInHumanString, npcId):
+                    new_schedule_str = BhrLgcGPTProcess.generate_schedule(
+                        cur_schedule_str, memories_str, prior_reflection_str, inputInHumanString, npcId
+                    )
+                    schedule_db_conn = DBCon.establish_sql_connection()
+                    BhrDBSchedule.insert_into_table(schedule_db_conn, npcId, curTime, new_schedule_str)
+                    DBCon.close_sql_connection(schedule_db_conn)
+
+                print('Current Schedule:')
+                print(new_schedule_str)
+                print()
+                return new_schedule_str
+
+            # All memories of this request are scored in one call, and each score is
+            # shared by the memory stream and the reflection tracer
+            def rate_memories():
                 if is_talking:
-                    input_for_mem = BhrLgcManualProcess.parse_npc_info_formemory(java_json)
-                    BhrLgcToMemStre.InputToMemStreDB(input_from_java, input_for_mem)
-                    BhrLgcToMemStre.InstImportancetoReflectionTracer(input_from_java, input_for_mem)
+                    input_importance, instruction_importance = BhrLgcGPTProcess.get_importance_batch([input_for_mem, instruction_in_human])
+                    return int(input_importance), int(instruction_importance)
+                return None, int(BhrLgcGPTProcess.get_importance(instruction_in_human))
+
+            def score_memories():
+                default_importance = BhrLgcToMemStre.DEFAULT_IMPORTANCE
+                return LLMRetry.retry_call(
+                    rate_memories, name='importance', attempts=2,
+                    default=(default_importance if is_talking else None, default_importance),
+                )
 
-            # Insert instruction to Memory Stream
-            BhrLgcToMemStre.InstToMemStreDB(input_from_java, "At "+str(curTime) + " ," + instruction_in_human)
-            BhrLgcToMemStre.InstImportancetoReflectionTracer(input_from_java, instruction_in_human)
+            def write_input_memory(importances):
+                if is_talking:
+                    BhrLgcToMemStre.InputToMemStreDB(input_from_java, input_for_mem, importances[0])
+                    BhrLgcCondensedContext.store.note_memory(npcId, curTime, input_for_mem)
+
+            def write_instruction_memory(importances):
+                # Insert instruction to Memory Stream
+                instruction_memory = "At "+str(curTime) + " ," + instruction_in_human
+                BhrLgcToMemStre.InstToMemStreDB(input_from_java, instruction_memory, importances[1])
+                BhrLgcCondensedContext.store.note_memory(npcId, curTime, instruction_memory)
+
+            def update_reflection_tracer(importances):
+                # Both updates read-modify-write the same tracer row, so they stay sequential
+                input_importance, instruction_importance = importances
+                if is_talking:
+                    BhrLgcToMemStre.InstImportancetoReflectionTracer(input_from_java, input_for_mem, input_importance)
+                BhrLgcToMemStre.InstImportancetoReflectionTracer(input_from_java, instruction_in_human, instruction_importance)
 
-            # Check reflection importance
-            db_conn = DBCon.check_and_reconnect(db_conn)
-            output = BhrDBReflectionTracer.retrieve_entry(db_conn, npcId)
-            if output:
-                output_importance, output_starttime, output_endtime = output[0], output[1], output[2]
-                if output_importance > 100:
-                    # Time for reflection
-                    db_conn = DBCon.check_and_reconnect(db_conn)
-                    memories = BhrDBMemStre.retrieve_entries_between_time(db_conn, npcId, output_starttime, output_endtime)
-                    db_conn = DBCon.check_and_reconnect(db_conn)
-                    prior_reflection = BhrDBReflection.retrieve_last_entry_before_time(db_conn, npcId, output_endtime)
-                    if prior_reflection is not None:
-                        prior_reflection_str = prior_reflection[2]
-                    else:
-                        prior_reflection_str = 'No prior reflections'
-                    memories_str = str(memories['Content']) if memories is not None else 'No prior memories'
-
-                    new_reflection = BhrLgcGPTProcess.generate_reflection_new(prior_reflection_str, memories_str, inputInHumanString, npcId)
-                    print("New Reflection: ", new_reflection)
-                    db_conn = DBCon.check_and_reconnect(db_conn)
-                    BhrDBReflection.insert_into_table(db_conn, npcId, curTime, new_reflection)
-                    # Reset the importance tracer
-                    db_conn = DBCon.check_and_reconnect(db_conn)
-                    BhrDBReflectionTracer.insert_into_table(db_conn, npcId, 0, curTime, curTime)
+            def check_reflection(tracer_done, input_memory_done, instruction_memory_done):
+                # Check reflection importance
+                reflection_db_conn = DBCon.establish_sql_connection()
+                try:
+                    output = BhrDBReflectionTracer.retrieve_entry(reflection_db_conn, npcId)
+                    if output:
+                        output_importance, output_starttime, output_endtime = output[0], output[1], output[2]
+                        if output_importance > 100:
+                            # Time for reflection
+                            reflection_db_conn = DBCon.check_and_reconnect(reflection_db_conn)
+                            memories = BhrDBMemStre.retrieve_entries_between_time(reflection_db_conn, npcId, output_starttime, output_endtime)
+                            reflection_db_conn = DBCon.check_and_reconnect(reflection_db_conn)
+                            prior_reflection = BhrDBReflection.retrieve_last_entry_before_time(reflection_db_conn, npcId, output_endtime)
+                            if prior_reflection is not None:
+                                reflection_prior_str = prior_reflection[2]
+                            else:
+                                reflection_prior_str = 'No prior reflections'
+                            reflection_memories_str = str(memories['Content']) if memories is not None else 'No prior memories'
+
+                            new_reflection = BhrLgcGPTProcess.generate_reflection_new(reflection_prior_str, reflection_memories_str, inputInHumanString, npcId)
+                            print("New Reflection: ", new_reflection)
+                            reflection_db_conn = DBCon.check_and_reconnect(reflection_db_conn)
+                            BhrDBReflection.insert_into_table(reflection_db_conn, npcId, curTime, new_reflection)
+                            BhrLgcCondensedContext.store.note_reflection(npcId, curTime, new_reflection)
+                            # Reset the importance tracer
+                            reflection_db_conn = DBCon.check_and_reconnect(reflection_db_conn)
+                            BhrDBReflectionTracer.insert_into_table(reflection_db_conn, npcId, 0, curTime, curTime)
+                finally:
+                    if reflection_db_conn and DBCon.is_connected(reflection_db_conn):
+                        DBCon.close_sql_connection(reflection_db_conn)
+
+            # Nothing here is waited on by the game, so it yields the provider quota to decisions and talk turns
+            with LLMRateLimit.priority(LLMRateLimit.PRIORITY_LOW):
+                BhrLgcTaskGraph.run_task_graph({
+                    'schedule': (update_schedule, []),
+                    'importance': (score_memories, []),
+                    'input_memory': (write_input_memory, ['importance']),
+                    'instruction_memory': (write_instruction_memory, ['importance']),
+                    'reflection_tracer': (update_reflection_tracer, ['importance']),
+                    'reflection': (check_reflection, ['reflection_tracer', 'input_memory', 'instruction_memory']),
+                })
 
         db_conn = DBCon.check_and_reconnect(db_conn)
         BhrDBJavaBuffer.mark_entry_as_fullyprocessed(db_conn, request_id)
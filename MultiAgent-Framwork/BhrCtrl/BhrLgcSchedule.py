@@ -0,0 +1,186 @@
+import re
+from bisect import bisect_right
+from datetime import datetime
+from functools import lru_cache
+
+# Local schedule lookups.
+# Schedules are stored as "HH:MM-HH:MM Action: details" items, either one per
+# line (char_config.yaml) or folded into one line (YAML ">" blocks, DB rows).
+# Parsing a schedule text once gives a time-indexed list of slots, so picking
+# the current and next slots for a world time does not need a model call.
+# The parse is only trusted when the whole text is in that format: a line
+# that does not start with a slot, a time in an item outside of its slot, or
+# a time written with AM/PM (e.g. an item "8:00 AM - 9:00 AM") makes it give
+# up, and the caller asks the model instead. Times inside an item's slot (e.g.
+# "13:30-13:45" in a 13:00-14:00 meeting) stay in its description.
+
+SLOT_PATTERN = re.compile(r'(\d{1,2}):(\d{2})\s*[-–~]\s*(\d{1,2}):(\d{2})')
+TIME_PATTERN = re.compile(r'(?<!\d)(\d{1,2}):(\d{2})(?!\d)(\s*[AaPp]\.?[Mm]\b)?')
+# What may come before a slot at the start of a line: list markers, markdown, "1."
+ITEM_PREFIX_PATTERN = re.compile(r'^[\s*#>|•-]*(?:\d+[.)])?[\s*#>|•-]*$')
+MARKUP_CHARACTERS = " \t\r*#>|•-`"
+WORLD_TIME_PATTERN = re.compile(r'Now is (\d{4}-\d{2}-\d{2} \d{2}:\d{2}(?::\d{2})?)')
+
+MINUTES_PER_DAY = 24 * 60
+# A schedule text with fewer slots than this is treated as free text
+MIN_SLOTS = 2
+
+
+class Schedule:
+    """
+    A parsed day schedule.
+    slots: list of (start_minute, end_minute, text) in the written order,
+           minutes are counted from 00:00, an end of 00:00 means midnight.
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        # Sorted slot starts for bisect, as (start_minute, slot index)
+        self.starts = sorted((start, i) for i, (start, end, text) in enumerate(slots))
+        self.start_minutes = [start for start, i in self.starts]
+
+    def _contains(self, slot, minute):
+        start, end, text = slot
+        length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+        return (minute - start) % MINUTES_PER_DAY < length
+
+    def slots_at(self, minute, next_n=2):
+        """
+        Returns (current slot or None, list of the next next_n slots by start time) for a minute
+        of the day. Slots wrap around midnight, so 23:30-00:00 is followed by 00:00-00:30.
+        """
+        minute = minute % MINUTES_PER_DAY
+        count = len(self.starts)
+        position = bisect_right(self.start_minutes, minute)
+        # The slot starting at or before the minute, wrapping to the last one before 00:00
+        candidate_position = (position - 1) % count
+
+        current = None
+        if self._contains(self.slots[self.starts[candidate_position][1]], minute):
+            current = self.starts[candidate_position][1]
+            first_next = candidate_position + 1
+        else:
+            # In a gap between two slots, the next one is the first starting after the minute
+            first_next = position
+
+        upcoming_count = min(next_n, count - (1 if current is not None else 0))
+        upcoming = [self.slots[self.starts[(first_next + i) % count][1]] for i in range(upcoming_count)]
+        return (self.slots[current] if current is not None else None), upcoming
+
+
+def _format_slot(slot):
+    start, end, text = slot
+    return f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d} {text}"
+
+
+def _minutes(hour, minute):
+    return (int(hour) * 60 + int(minute)) % MINUTES_PER_DAY
+
+def _in_slot(start, end, minute):
+    # Within the slot, its end included
+    length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+    return (minute - start) % MINUTES_PER_DAY <= length
+
+
+@lru_cache(maxsize=256)
+def parse_schedule(schedule_str):
+    """
+    Parses a schedule text into a Schedule, or returns None when the text is not
+    entirely a list of time slots. Results are cached by text, since the same
+    schedule is looked up on every request of an NPC until it is regenerated.
+    """
+    if not schedule_str:
+        return None
+    text = str(schedule_str)
+    lines = [line for line in text.splitlines() if line.strip(MARKUP_CHARACTERS)]
+    one_line = len(lines) <= 1
+
+    # Slots starting a line are items. Within a line, a slot is a new item of a folded
+    # schedule unless it starts inside the previous item, then it is part of its description
+    items = []
+    item_lines = {}  # Start of a line -> the item starting it
+    for match in SLOT_PATTERN.finditer(text):
+        line_start = text.rfind("\n", 0, match.start()) + 1
+        if ITEM_PREFIX_PATTERN.match(text[line_start:match.start()]):
+            item_lines[line_start] = match
+        elif not items or not one_line:
+            continue
+        else:
+            previous = items[-1].groups()
+            previous_end = _minutes(*previous[2:])
+            start = _minutes(*match.groups()[:2])
+            if start != previous_end and _in_slot(_minutes(*previous[:2]), previous_end, start):
+                continue
+        items.append(match)
+    if len(items) < MIN_SLOTS:
+        return None
+
+    # Every line from the first item on must be an item
+    first_line = text.rfind("\n", 0, items[0].start()) + 1
+    position = first_line
+    for line in text[first_line:].split("\n"):
+        if line.strip(MARKUP_CHARACTERS) and position not in item_lines:
+            return None
+        position += len(line) + 1
+
+    slots = []
+    for i, match in enumerate(items):
+        start_hour, start_minute, end_hour, end_minute = (int(group) for group in match.groups())
+        if start_hour > 24 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+            return None
+        start = _minutes(start_hour, start_minute)
+        end = _minutes(end_hour, end_minute)
+        if i + 1 == len(items):
+            description_end = len(text)
+        else:
+            next_item = items[i + 1]
+            # Up to the list marker of the next item when it starts a line
+            next_line = text.rfind("\n", 0, next_item.start()) + 1
+            description_end = next_line if item_lines.get(next_line) is next_item else next_item.start()
+        # Drop markdown and list markers around the item
+        description = text[match.end():description_end].strip(" \t\r\n*-:|")
+        description = re.sub(r'\s+', ' ', description).strip(" *-")
+        if start == end or not description:
+            return None
+        # A time outside of the slot is an item this parser did not recognize
+        for time_match in TIME_PATTERN.finditer(description):
+            hour, minute = int(time_match.group(1)), int(time_match.group(2))
+            if time_match.group(3) or hour > 24 or minute > 59 or not _in_slot(start, end, _minutes(hour, minute)):
+                return None
+        slots.append((start, end, description))
+    return Schedule(slots)
+
+
+def parse_world_time(npc_context):
+    """
+    Extracts the world time from the "Now is YYYY-mm-dd HH:MM:SS" line of the NPC context.
+    Returns a datetime, or None if it is missing.
+    """
+    match = WORLD_TIME_PATTERN.search(str(npc_context))
+    if not match:
+        return None
+    value = match.group(1)
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S' if value.count(':') == 2 else '%Y-%m-%d %H:%M')
+    except ValueError:
+        return None
+
+
+def recent_schedule_slice(npc_context, schedule_str, next_n=2):
+    """
+    Returns the current and the next next_n schedule items for the world time in npc_context,
+    as text for prompts. Returns None when the schedule or the world time can't be parsed,
+    the caller then falls back to onlyMostRecentSchedule.
+    """
+    schedule = parse_schedule(str(schedule_str))
+    world_time = parse_world_time(npc_context)
+    if schedule is None or world_time is None:
+        return None
+
+    current, upcoming = schedule.slots_at(world_time.hour * 60 + world_time.minute, next_n)
+    lines = []
+    if current is not None:
+        lines.append("Now: " + _format_slot(current))
+    for slot in upcoming:
+        lines.append("Next: " + _format_slot(slot))
+    return "\n".join(lines)
@@ -16,44 +16,48 @@ import pickle
 import BhrLgcGPTProcess
 import BhrLgcManualProcess
 
+from LLMConnect import LLMRetry
+
 # memstre_db_connection = DBCon.establish_sql_connection()
 
-def InstToMemStreDB(input_from_java, memeory_input_str):
+# Importance stored when the model could not rate a memory, rather than retrying forever
+DEFAULT_IMPORTANCE = 3
+
+def score_importance(memory_str):
+    # The call layer already retried transient errors, so one more attempt is enough here
+    return LLMRetry.retry_call(
+        lambda: int(BhrLgcGPTProcess.get_importance(memory_str)),
+        name='importance', attempts=2, default=DEFAULT_IMPORTANCE,
+    )
+
+def InstToMemStreDB(input_from_java, memeory_input_str, importance=None):
     # output_str = BhrLgcGPTProcess.InstructionToHumanString(instruction)
     output_str = memeory_input_str
     insert_npcId = input_from_java[2]
     insert_time = input_from_java[1]
     
     insert_content = output_str
-    while True:
-        try:
-            # Attempt to get the importance value
-            insert_importance = int(BhrLgcGPTProcess.get_importance(output_str))
-            break  # Exit the loop if successful
-        except (ValueError, TypeError):
-            # Handle cases where the result is not convertible to an integer
-            print("Importance is not an integer. Retrying...")
+    # The importance may already have been scored by the caller
+    insert_importance = importance
+    if insert_importance is None:
+        insert_importance = score_importance(output_str)
     insert_embedding = BhrLgcGPTProcess.get_embedding(output_str)
     insert_isInstruction = 1
 
     BhrDBMemStre.insert_into_table(DBCon.establish_sql_connection(), insert_npcId, insert_time, insert_isInstruction, insert_content, insert_importance, insert_embedding)
     return 0
 
-def InputToMemStreDB(input_from_java, memeory_input_str):
+def InputToMemStreDB(input_from_java, memeory_input_str, importance=None):
     # output_str = BhrLgcGPTProcess.InstructionToHumanString(instruction)
     output_str = memeory_input_str
     insert_npcId = input_from_java[2]
     insert_time = input_from_java[1]
     
     insert_content = output_str
-    while True:
-        try:
-            # Attempt to get the importance value
-            insert_importance = int(BhrLgcGPTProcess.get_importance(output_str))
-            break  # Exit the loop if successful
-        except (ValueError, TypeError):
-            # Handle cases where the result is not convertible to an integer
-            print("Importance is not an integer. Retrying...")
+    # The importance may already have been scored by the caller
+    insert_importance = importance
+    if insert_importance is None:
+        insert_importance = score_importance(output_str)
     insert_embedding = BhrLgcGPTProcess.get_embedding(output_str)
     insert_isInstruction = 0
 
@@ -63,7 +67,7 @@ def InputToMemStreDB(input_from_java, memeory_input_str):
 
 
 # 
-def InstImportancetoReflectionTracer(input_from_java, words_to_say):
+def InstImportancetoReflectionTracer(input_from_java, words_to_say, importance=None):
     ReflectionTracer_db_conection = DBCon.establish_sql_connection()
     if not BhrDBReflectionTracer.table_exists(ReflectionTracer_db_conection):
         BhrDBReflectionTracer.create_table(ReflectionTracer_db_conection)
@@ -73,15 +77,11 @@ def InstImportancetoReflectionTracer(input_from_java, words_to_say):
     insert_npcId = input_from_java[2]
     insert_time = input_from_java[1]
 
-    while True:
-        try:
-            # Attempt to get the importance and convert it to an integer
-            insert_importance = int(BhrLgcGPTProcess.get_importance(output_str))
-            # Break the loop if no exception occurs
-            break
-        except Exception as e:
-            print(f"Error occurred: {e}. Retrying...")
-        
+    # The importance may already have been scored by the caller
+    insert_importance = importance
+    if insert_importance is None:
+        insert_importance = score_importance(output_str)
+
     output = BhrDBReflectionTracer.retrieve_entry(ReflectionTracer_db_conection, insert_npcId)
 
     if output is None:
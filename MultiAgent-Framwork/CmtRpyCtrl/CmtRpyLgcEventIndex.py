@@ -0,0 +1,80 @@
+import os
+import threading
+import yaml
+import numpy as np
+
+# Precomputed embeddings of the key events in keyEvent.yaml.
+# The intro of every event is embedded once when the file is loaded (and again
+# only when the file changes), and kept per NPC as a row-normalized float32
+# matrix, so ranking the events of an NPC for a comment is one matrix-vector
+# product instead of one embedding request and one cosine per event.
+
+
+class EventIndex:
+    """
+    event_path: path of keyEvent.yaml
+    get_embeddings: function embedding a list of texts, e.g. CmtRpyLgcGPTProcess.get_embeddings
+    """
+
+    def __init__(self, event_path, get_embeddings):
+        self.event_path = event_path
+        self.get_embeddings = get_embeddings
+        self.lock = threading.Lock()
+        self.loaded_mtime = None
+        # npcId -> (list of event dicts, float32 matrix with one normalized row per event)
+        self.events_by_npc = {}
+
+    def _reload_if_changed(self):
+        mtime = os.path.getmtime(self.event_path)
+        with self.lock:
+            if mtime == self.loaded_mtime:
+                return
+
+            with open(self.event_path, 'r', encoding='utf-8') as file:
+                event_config = yaml.safe_load(file) or {}
+
+            events_by_npc = {}
+            intros = []
+            for entry in event_config.get('npcEvents', []):
+                events = []
+                for ev in entry.get('events', []) or []:
+                    details = ev.get('details') or []
+                    if isinstance(details, str):
+                        details = [details]
+                    events.append({'id': ev.get('id'), 'intro': str(ev.get('intro', '')), 'details': [str(d) for d in details]})
+                events_by_npc[entry.get('npcId')] = events
+                intros.extend(ev['intro'] for ev in events)
+
+            # All intros of all NPCs in one embedding call
+            embeddings = iter(self.get_embeddings(intros) if intros else [])
+            for npcId, events in events_by_npc.items():
+                if events:
+                    matrix = np.array([next(embeddings) for _ in events], dtype=np.float32)
+                    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                    matrix /= np.where(norms == 0, 1, norms)
+                else:
+                    matrix = np.zeros((0, 0), dtype=np.float32)
+                events_by_npc[npcId] = (events, matrix)
+
+            self.events_by_npc = events_by_npc
+            self.loaded_mtime = mtime
+            print(f"Method: EventIndex | Loaded {len(intros)} event embeddings for {len(events_by_npc)} NPCs from {self.event_path}")
+
+    def relevant_events(self, npcId, query_embedding, threshold=0.3, top_k=3):
+        """
+        Returns up to top_k (event, similarity) pairs of the NPC with a cosine similarity
+        above threshold to query_embedding, most similar first.
+        """
+        self._reload_if_changed()
+        events, matrix = self.events_by_npc.get(npcId, ([], None))
+        if not events:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            return []
+        similarities = matrix @ (query / query_norm)
+
+        order = np.argsort(-similarities)[:top_k]
+        return [(events[i], float(similarities[i])) for i in order if similarities[i] > threshold]
@@ -6,7 +6,10 @@ import os
 import yaml
 import random
 
-from openai import OpenAI
+from LLMConnect import LLMCon
+from LLMConnect import LLMKeyPool
+from LLMConnect import LLMCache
+from LLMConnect import LLMEmbBatch
 
 print("Current working directory:", os.getcwd())
 
@@ -25,24 +28,25 @@ print("Config sections found:", config.sections())
 
 if 'OpenAI' not in config:
     print("Error: 'OpenAI' section not found in config.ini")
-openai_key = config['OpenAI']['chatgpt_key']
-deepseek_key=config['OpenAI']['deepseek_key']
+# Every provider can have several keys (deepseek_key, deepseek_key2, ... or deepseek_keys = a, b)
+openai_keys = LLMKeyPool.keys_from_config(config['OpenAI'], 'chatgpt_key')
+deepseek_keys = LLMKeyPool.keys_from_config(config['OpenAI'], 'deepseek_key')
 
-google_key=config['OpenAI']['google_key']
+google_keys = LLMKeyPool.keys_from_config(config['OpenAI'], 'google_key')
 
 is_chatgpt = config['OpenAI'].getboolean('useChatGPT', fallback=True)
 is_google = config['OpenAI'].getboolean('useGoogle', fallback=False)
 if is_chatgpt:
     print("Using ChatGPT API")
-    client = OpenAI(api_key=openai_key)
-    client_embedding = OpenAI(api_key=openai_key)
+    client = LLMCon.make_client(openai_keys)
+    client_embedding = LLMCon.make_client(openai_keys)
     model_small = "gpt-4o-mini"
     model_large = "gpt-4o"
 elif is_google:
     print("Using Google API")
     # client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=deepseek_key) 
-    client = OpenAI(base_url="https://generativelanguage.googleapis.com/v1beta/openai/", api_key=google_key) 
-    client_embedding = OpenAI(api_key=openai_key)
+    client = LLMCon.make_client(google_keys, "https://generativelanguage.googleapis.com/v1beta/openai/")
+    client_embedding = LLMCon.make_client(openai_keys)
 
     # model_small = "deepseek/deepseek-r1-distill-llama-70b"
     # model_large = "deepseek/deepseek-r1-distill-llama-70b"
@@ -51,14 +55,25 @@ elif is_google:
 else:
     print("Using DeepSeek API")
     # client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=deepseek_key) 
-    client = OpenAI(base_url="https://api.deepseek.com", api_key=deepseek_key) 
-    client_embedding = OpenAI(api_key=openai_key)
+    client = LLMCon.make_client(deepseek_keys, "https://api.deepseek.com")
+    client_embedding = LLMCon.make_client(openai_keys)
 
     # model_small = "deepseek/deepseek-r1-distill-llama-70b"
     # model_large = "deepseek/deepseek-r1-distill-llama-70b"
     model_small = "deepseek-chat"
     model_large = "deepseek-chat"
 
+# Slow or failing chat calls are raced against the [Hedge] fallback provider, if configured
+keys_by_provider = {'openai': openai_keys, 'google': google_keys, 'deepseek': deepseek_keys}
+LLMCon.configure_fallback(client, keys_by_provider, model_small, model_large)
+
+def create_embeddings(texts, model):
+    response = client_embedding.embeddings.create(input = texts, model=model)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+# Concurrent get_embedding calls from all worker threads share batched requests
+embedding_batcher = LLMEmbBatch.EmbeddingBatcher(create_embeddings)
+
 yaml_path = os.path.join(base_dir, 'char_config.yaml')
 
 # Load the YAML file
@@ -122,8 +137,16 @@ def replyToComment(hisAnn, comment, npcId, special_instruction=''):
 
 
 def get_embedding(text, model="text-embedding-3-small"):
-   text = str(text.replace("\n", " "))
-   return client_embedding.embeddings.create(input = [text], model=model).data[0].embedding
+   # Served from the shared embedding cache, misses are batched with the other threads' texts
+   return LLMCache.embedding_cache.get_or_create(
+       text, model, lambda input_text: embedding_batcher.embed(input_text, model)
+   )
+
+def get_embeddings(texts, model="text-embedding-3-small"):
+   # Embeds a list of texts, with at most one request for all the cache misses
+   return LLMCache.embedding_cache.get_or_create_many(
+       texts, model, lambda input_texts: embedding_batcher.embed_many(input_texts, model)
+   )
 
 
 
@@ -2,7 +2,6 @@ import sys
 import os
 
 import pandas as pd
-import numpy as np
 import json
 import re
 import pickle
@@ -10,7 +9,6 @@ import hashlib
 import configparser
 import yaml
 import traceback
-import ast
 
 # Add the base directory (one level up from AnnCtrl)
 base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -24,6 +22,9 @@ from DBConnect import CmtRpyDBMemStre
 
 
 from BhrCtrl import BhrLgcGPTProcess
+from BhrCtrl import BhrLgcMemRetriever
+from BhrCtrl import BhrLgcMemIndex
+from BhrCtrl import BhrLgcMemANN
   
 from DBConnect import BhrDBMemStre
 from DBConnect import BhrDBReflection
@@ -31,6 +32,7 @@ from DBConnect import BhrDBSchedule
 
 
 import CmtRpyLgcGPTProcess
+import CmtRpyLgcEventIndex
 # import CmtRpyManualProcess
 # import CmtRpyInstToMemStre
 # import CmtRpyInputToMemStre
@@ -50,11 +52,19 @@ with open(yaml_path, 'r', encoding='utf-8' ) as file:
     print("Config YAML content loaded successfully.")
 
 
+# Memories favour recent and relevant ones; the extra hourly factor keeps the scores of the
+# previous per-row code, where it grew with the age of the memory
+memory_retriever = BhrLgcMemRetriever.MemoryRetriever(a_recency=0.3, a_importance=0.2, a_similarity=0.5, decay_rate=0.001, hourly_decay=-0.1)
+# Behavior memories are written by the behavior controller, the index catches up with the database
+memory_index = BhrLgcMemIndex.MemoryIndex(sync_seconds=BhrLgcMemIndex.SYNC_SECONDS)
+# Whole memory history, searched by nearest neighbours; the behavior controller saves the indexes
+memory_ann = BhrLgcMemANN.MemoryANN(sync_seconds=BhrLgcMemIndex.SYNC_SECONDS, persist=False)
+# Prior conversation with the sender
+conversation_retriever = BhrLgcMemRetriever.MemoryRetriever(a_recency=0.2, a_importance=0.2, a_similarity=0.6, decay_rate=0.001)
+
 event_path = os.path.join(base_dir, 'keyEvent.yaml')
-# Load the YAML file
-with open(event_path, 'r', encoding='utf-8' ) as file:
-    event_config = yaml.safe_load(file)
-    print("Event YAML content loaded successfully.")
+# Event intros are embedded once per load of the YAML file, and again only when it changes
+event_index = CmtRpyLgcEventIndex.EventIndex(event_path, CmtRpyLgcGPTProcess.get_embeddings)
 
 
 
@@ -96,10 +106,11 @@ def choiceOneToReply():
     # Prepare data for DataFrame
     data = []
     requestIdtoMark = []
-    for comment in all_comments:
+    # Embed all pending comments together, in one request for the ones not cached yet
+    comment_embeddings = CmtRpyLgcGPTProcess.get_embeddings([comment[5] for comment in all_comments])
+    for comment, embedding in zip(all_comments, comment_embeddings):
         requestId_fromdb, time_fromdb, npcId_fromdb, msgId_fromdb, senderId_fromdb, content_fromdb, isProcessed_fromdb, sname_fromdb, isBeingProcessed_fromdb, privateMsg_fromdb = comment
         requestIdtoMark.append(requestId_fromdb)
-        embedding = CmtRpyLgcGPTProcess.get_embedding(content_fromdb)
         # Deserialize the embedding back to a list
         data.append([requestId_fromdb, time_fromdb, npcId_fromdb, msgId_fromdb, senderId_fromdb, content_fromdb, embedding, sname_fromdb, isBeingProcessed_fromdb, privateMsg_fromdb])
 
@@ -114,46 +125,17 @@ def choiceOneToReply():
     commet_to_reply = comment_row_reply['content']
     # Convert the pandas Series to a string
     
-    npc_events_entry = next((item for item in event_config.get('npcEvents', []) if item.get('npcId') == npcId), None)
-    print(npc_events_entry)
-    if npc_events_entry:
-        events_list = npc_events_entry.get('events', [])
-        events_data = []
-        for ev in events_list:
-            ev_id = ev.get('id')
-            ev_intro = ev.get('intro')
-            ev_detail = str(ev.get('details'))
-            ev_embedding = CmtRpyLgcGPTProcess.get_embedding(ev_intro)
-            events_data.append([ev_id, ev_intro, ev_detail, ev_embedding])
-        events_df = pd.DataFrame(events_data, columns=['eventId', 'intro', 'detail', 'embedding'])
-    else:
-        events_df = pd.DataFrame(columns=['eventId', 'intro', 'detail', 'embedding'])
-
     comment_str = str(commet_to_reply)
     comment_embedding = CmtRpyLgcGPTProcess.get_embedding(comment_str)
 
-    def cosine_similarity(vec1, vec2):
-        dot_product = np.dot(vec1, vec2)
-        norm1 = np.linalg.norm(vec1)
-        norm2 = np.linalg.norm(vec2)
-        return dot_product / (norm1 * norm2)
-
-    events_df['similary'] = events_df['embedding'].apply(lambda emb: cosine_similarity(emb, comment_embedding))
-
     threshold = 0.3
-    selected_event = (
-        events_df[events_df['similary'] > threshold]
-        .sort_values(by='similary', ascending=False)
-        .head(3)
-    )
+    selected_event = event_index.relevant_events(npcId, comment_embedding, threshold=threshold, top_k=3)
     paragraphs = []
-    for _, row in selected_event.iterrows():
-        # Parse the stringified list of details back into a Python list
-        details_list = ast.literal_eval(row['detail'])
+    for event, similarity in selected_event:
         # Join all detail items into a single string
-        details_text = " ".join(details_list)
+        details_text = " ".join(event['details'])
         # Form the paragraph: intro followed by details
-        paragraph = f"{row['intro']} {details_text}"
+        paragraph = f"{event['intro']} {details_text}"
         paragraphs.append(paragraph)
 
 
@@ -165,43 +147,20 @@ def choiceOneToReply():
     info_for_reply = ''
     # Get memeory stream 
     BufferRowEmbedding = BhrLgcGPTProcess.get_embedding(commet_to_reply)
-    rows_df = BhrDBMemStre.retrieve_most_recent_entries(db_conn, npcId, time_fromdb)
-    if rows_df is not None:
-        rows_df['Time'] = pd.to_datetime(rows_df['Time'])
-        rows_df['TimeDifference'] = (rows_df['Time'] - pd.to_datetime(time_fromdb)).dt.total_seconds()
-        decay_rate = 0.001 
-        rows_df['recency'] = np.exp(decay_rate * rows_df['TimeDifference'])
-
-        def cosine_similarity(vec1, vec2):
-            dot_product = np.dot(vec1, vec2)
-            norm_vec1 = np.linalg.norm(vec1)
-            norm_vec2 = np.linalg.norm(vec2)
-            return dot_product / (norm_vec1 * norm_vec2)
-
-        rows_df['cosine_similarity'] = rows_df['Embedding'].apply(lambda x: cosine_similarity(BufferRowEmbedding, np.array(x)))
-
-        # Adjust weights to prioritize recent and relevant memories
-        a_recency = 0.3  # Increased from 0.2 to give more weight to recent interactions
-        a_importance = 0.2  # Keep importance weight the same
-        a_similarity = 0.5  # Slightly decreased from 0.6 to balance with increased recency
-
-        # Add time decay factor for more granular recency weighting
-        time_diff_hours = rows_df['TimeDifference'] / 3600  # Convert seconds to hours
-        time_decay = np.exp(-0.1 * time_diff_hours)  # Exponential decay over time
-        
-        rows_df['retrieval_score'] = (
-            a_recency * (rows_df['recency'] * time_decay) +
-            a_importance * rows_df['Importance'] + 
-            a_similarity * rows_df['cosine_similarity']
-        )
-
-        # Increase the number of retrieved memories for better context
-        rows_df_ranked = rows_df.sort_values(by=['retrieval_score', 'Time'], ascending=[False, False]).head(25)
-        rows_df_ranked = rows_df_ranked.sort_values(by='Time', ascending=False)
-        paragraph = " ".join(rows_df_ranked['Content'].astype(str).tolist())
-        memories_str = paragraph
+    if BhrLgcMemANN.ENABLED:
+        contents, scores = memory_ann.history(db_conn, npcId).query(memory_retriever, BufferRowEmbedding, time_fromdb, k=25)
+        memories_str = " ".join(str(content) for content in contents) if contents else 'No memory yet'
+    elif BhrLgcMemIndex.ENABLED:
+        contents, scores = memory_index.ring(db_conn, npcId, time_fromdb).query(memory_retriever, BufferRowEmbedding, time_fromdb, k=25)
+        memories_str = " ".join(str(content) for content in contents) if contents else 'No memory yet'
     else:
-        memories_str = 'No memory yet'
+        rows_df = BhrDBMemStre.retrieve_most_recent_entries(db_conn, npcId, time_fromdb)
+        if rows_df is not None and not rows_df.empty:
+            rows_df_ranked = memory_retriever.rank(rows_df, BufferRowEmbedding, time_fromdb, k=25)
+            paragraph = " ".join(rows_df_ranked['Content'].astype(str).tolist())
+            memories_str = paragraph
+        else:
+            memories_str = 'No memory yet'
     info_for_reply += f'This is your prior memeories: {memories_str}\n\n'
 
     # Get reflect 
@@ -229,32 +188,8 @@ def choiceOneToReply():
 
     db_conn = DBCon.check_and_reconnect(db_conn)
     conv_rows_df = CmtRpyDBMemStre.retrieve_most_recent_entries(db_conn, npcId, time_fromdb, sender_name)
-    if conv_rows_df is not None:
-        conv_rows_df['Time'] = pd.to_datetime(conv_rows_df['Time'])
-        conv_rows_df['TimeDifference'] = (conv_rows_df['Time'] - pd.to_datetime(time_fromdb)).dt.total_seconds()
-        decay_rate = 0.001 
-        conv_rows_df['recency'] = np.exp(decay_rate * conv_rows_df['TimeDifference'])
-
-        def cosine_similarity(vec1, vec2):
-            dot_product = np.dot(vec1, vec2)
-            norm_vec1 = np.linalg.norm(vec1)
-            norm_vec2 = np.linalg.norm(vec2)
-            return dot_product / (norm_vec1 * norm_vec2)
-
-        conv_rows_df['cosine_similarity'] = conv_rows_df['Embedding'].apply(lambda x: cosine_similarity(BufferRowEmbedding, np.array(x)))
-
-        a_recency = 0.2  # Adjust the weight for recency as needed
-        a_importance = 0.2  # Adjust the weight for importance as needed
-        a_similarity = 0.6  # Adjust the weight for similarity as needed
-
-        conv_rows_df['retrieval_score'] = (
-            a_recency * conv_rows_df['recency'] +
-            a_importance * conv_rows_df['Importance'] + 
-            a_similarity * conv_rows_df['cosine_similarity']
-        )
-
-        conv_rows_df_ranked = conv_rows_df.sort_values(by=['retrieval_score', 'Time'], ascending=[False, False]).head(20)
-        conv_rows_df_ranked = conv_rows_df_ranked.sort_values(by='Time', ascending=False)
+    if conv_rows_df is not None and not conv_rows_df.empty:
+        conv_rows_df_ranked = conversation_retriever.rank(conv_rows_df, BufferRowEmbedding, time_fromdb, k=20)
         paragraph = " ".join(conv_rows_df_ranked['Content'].astype(str).tolist())
         prior_conversation = paragraph
     else:
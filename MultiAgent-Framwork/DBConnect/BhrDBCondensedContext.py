@@ -0,0 +1,86 @@
+# Rolling condensed context of each NPC, kept next to its reflection stream and
+# rewritten by BhrLgcCondensedContext when new memories or reflections land.
+
+def check_connection(connection):
+    if connection.is_connected():
+        print("Connection is still active.")
+    else:
+        print("Connection is not active. Reconnecting...")
+        connection.reconnect(attempts=3, delay=5)
+        if connection.is_connected():
+            print("Reconnection successful.")
+        else:
+            print("Reconnection failed.")
+
+def create_table(connection):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")  # Use the AITown database
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS behavior_condensed_context (
+        npcID VARCHAR(255) NOT NULL,
+        Time DATETIME NOT NULL,
+        Content LONGTEXT,
+        PRIMARY KEY (npcID)
+    )
+    """
+    cursor.execute(create_table_query)
+    print("Table 'behavior_condensed_context' checked/created successfully.")
+
+def table_exists(connection):
+    db_name = 'AITown'
+    table_name = 'behavior_condensed_context'
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        SELECT TABLE_NAME
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = '{db_name}' AND TABLE_NAME = '{table_name}'
+    """)
+    result = cursor.fetchone()
+    if result:
+        print(f"Table '{table_name}' exists in database '{db_name}'.")
+        return True
+    else:
+        print(f"Table '{table_name}' does not exist in database '{db_name}'.")
+        return False
+
+def insert_into_table(connection, npcID, time, content):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    insert_query = """
+    INSERT INTO behavior_condensed_context (npcID, Time, Content)
+    VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE Time = VALUES(Time), Content = VALUES(Content)
+    """
+    cursor.execute(insert_query, (npcID, time, content))
+    connection.commit()
+    print(f"Data inserted successfully: npcID={npcID}, time={time}, content length={len(content)}")
+
+def retrieve_entry(connection, npcID):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    select_query = "SELECT Time, Content FROM behavior_condensed_context WHERE npcID = %s"
+    cursor.execute(select_query, (npcID,))
+    result = cursor.fetchone()
+    if result:
+        time, content = result
+        print(f"Retrieved condensed context: npcID={npcID}, time={time}, content length={len(content)}")
+        return time, content
+    else:
+        print(f"No condensed context found for npcID={npcID}")
+        return None
+
+def delete_entry(connection, npcID):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    delete_query = "DELETE FROM behavior_condensed_context WHERE npcID = %s"
+    cursor.execute(delete_query, (npcID,))
+    connection.commit()
+    print(f"Condensed context of npcID={npcID} has been deleted successfully.")
+
+def delete_all_content(connection):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    delete_query = "DELETE FROM behavior_condensed_context"
+    cursor.execute(delete_query)
+    connection.commit()
+    print("All content in the 'behavior_condensed_context' table has been deleted successfully.")
@@ -1,7 +1,7 @@
 import json
 import mysql.connector
 from mysql.connector import Error
-import pickle  # To serialize and deserialize Python objects (like the embedding list)
+from DBConnect import DBEmbCodec  # Binary embeddings, see DBEmbCodec
 import pandas as pd
 
 import configparser
@@ -91,10 +91,14 @@ def table_exists(connection):
         print(f"Table '{table_name}' does not exist in database '{db_name}'.")
         return False
 
+# Called as listener(npcID, time, isInstruction, content, importance, embedding) after each
+# insert, e.g. to keep the in-memory index of BhrLgcMemIndex up to date
+insert_listeners = []
+
 def insert_into_table(connection, npcID, time, isInstruction, content, importance, embedding):
     cursor = connection.cursor()
     cursor.execute("USE AITown")
-    embedding_blob = pickle.dumps(embedding)
+    embedding_blob = DBEmbCodec.encode_embedding(embedding)
     insert_query = """
     INSERT INTO behavior_memeory_stream (npcID, Time, isInstruction, Content, Importance, Embedding)
     VALUES (%s, %s, %s, %s, %s, %s)
@@ -103,6 +107,8 @@ def insert_into_table(connection, npcID, time, isInstruction, content, importanc
     cursor.execute(insert_query, (npcID, time, isInstruction, content, importance, embedding_blob))
     connection.commit()
     print(f"Data inserted successfully: npcID={npcID}, time={time}, isInstruction={isInstruction}, content length={len(content)}, importance={importance}")
+    for listener in insert_listeners:
+        listener(npcID, time, isInstruction, content, importance, embedding)
 
 def retrieve_entry(connection, npcID, time, isInstruction):
     cursor = connection.cursor()
@@ -112,7 +118,7 @@ def retrieve_entry(connection, npcID, time, isInstruction):
     result = cursor.fetchone()
     if result:
         content, importance, embedding_blob = result
-        embedding = pickle.loads(embedding_blob)
+        embedding = DBEmbCodec.decode_embedding(embedding_blob)
         print(f"Retrieved entry: content={content}, importance={importance}, embedding length={len(embedding)}")
         return content, importance, embedding
     else:
@@ -151,8 +157,7 @@ def retrieve_most_recent_entries(connection, npcID, before_time, limit=300):
     data = []
     for result in results:
         npcID, time, isInstruction, content, importance, embedding_blob = result
-        # embedding = pickle.loads(embedding_blob)
-        embedding = pickle.loads(embedding_blob)
+        embedding = DBEmbCodec.decode_embedding(embedding_blob)
         data.append([npcID, time, isInstruction, content, importance, embedding])
 
     columns = ['npcID', 'Time', 'isInstruction', 'Content', 'Importance', 'Embedding']
@@ -161,6 +166,58 @@ def retrieve_most_recent_entries(connection, npcID, before_time, limit=300):
     print(f"Retrieved {len(df)} entries for npcID={npcID} before time={before_time}")
     return df
 
+def retrieve_entries_after_time(connection, npcID, after_time, limit=300):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    select_query = """
+    SELECT npcID, Time, isInstruction, Content, Importance, Embedding
+    FROM behavior_memeory_stream
+    WHERE npcID = %s AND Time > %s
+    ORDER BY Time ASC
+    LIMIT %s
+    """
+    cursor.execute(select_query, (npcID, after_time, limit))
+    results = cursor.fetchall()
+
+    data = []
+    for result in results:
+        npcID, time, isInstruction, content, importance, embedding_blob = result
+        embedding = DBEmbCodec.decode_embedding(embedding_blob)
+        data.append([npcID, time, isInstruction, content, importance, embedding])
+
+    columns = ['npcID', 'Time', 'isInstruction', 'Content', 'Importance', 'Embedding']
+    df = pd.DataFrame(data, columns=columns)
+
+    print(f"Retrieved {len(df)} entries for npcID={npcID} after time={after_time}")
+    return df
+
+def retrieve_entries_page(connection, npcID, after_time=None, after_isInstruction=-1, limit=1000):
+    # Pages through the whole memory stream of an NPC in (Time, isInstruction) order,
+    # starting after the last row of the previous page (or from the first row)
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    select_query = """
+    SELECT npcID, Time, isInstruction, Content, Importance, Embedding
+    FROM behavior_memeory_stream
+    WHERE npcID = %s AND (Time, isInstruction) > (%s, %s)
+    ORDER BY Time ASC, isInstruction ASC
+    LIMIT %s
+    """
+    cursor.execute(select_query, (npcID, after_time or '1000-01-01 00:00:00', after_isInstruction, limit))
+    results = cursor.fetchall()
+
+    data = []
+    for result in results:
+        npcID, time, isInstruction, content, importance, embedding_blob = result
+        embedding = DBEmbCodec.decode_embedding(embedding_blob)
+        data.append([npcID, time, isInstruction, content, importance, embedding])
+
+    columns = ['npcID', 'Time', 'isInstruction', 'Content', 'Importance', 'Embedding']
+    df = pd.DataFrame(data, columns=columns)
+
+    print(f"Retrieved {len(df)} entries for npcID={npcID} after time={after_time}")
+    return df
+
 def retrieve_entries_between_time(connection, npcID, start_time, end_time, limit=300):
     cursor = connection.cursor()
     cursor.execute("USE AITown")
@@ -177,7 +234,7 @@ def retrieve_entries_between_time(connection, npcID, start_time, end_time, limit
     data = []
     for result in results:
         npcID, time, isInstruction, content, importance, embedding_blob = result
-        embedding = pickle.loads(embedding_blob)
+        embedding = DBEmbCodec.decode_embedding(embedding_blob)
         data.append([npcID, time, isInstruction, content, importance, embedding])
 
     columns = ['npcID', 'Time', 'isInstruction', 'Content', 'Importance', 'Embedding']
@@ -1,7 +1,7 @@
 import json
 import mysql.connector
 from mysql.connector import Error
-import pickle  # To serialize and deserialize Python objects (like the embedding list)
+from DBConnect import DBEmbCodec  # Binary embeddings, see DBEmbCodec
 import pandas as pd
 
 import configparser
@@ -96,7 +96,7 @@ def table_exists(connection):
 def insert_into_table(connection, npcID, time, isInstruction, content, importance, embedding, sname):
     cursor = connection.cursor()
     cursor.execute("USE AITown")
-    embedding_blob = pickle.dumps(embedding)
+    embedding_blob = DBEmbCodec.encode_embedding(embedding)
     insert_query = """
     INSERT INTO comment_reply_memeory_stream (npcID, Time, isInstruction, Content, Importance, Embedding, sname)
     VALUES (%s, %s, %s, %s, %s, %s, %s)
@@ -114,7 +114,7 @@ def retrieve_entry(connection, npcID, time, isInstruction):
     result = cursor.fetchone()
     if result:
         content, importance, embedding_blob, sname = result
-        embedding = pickle.loads(embedding_blob)
+        embedding = DBEmbCodec.decode_embedding(embedding_blob)
         print(f"Retrieved entry: content={content}, importance={importance}, embedding length={len(embedding)}, sname={sname}")
         return content, importance, embedding, sname
     else:
@@ -153,7 +153,7 @@ def retrieve_most_recent_entries(connection, npcID, before_time, sname, limit=30
     data = []
     for result in results:
         npcID, time, isInstruction, content, importance, embedding_blob, sname = result
-        embedding = pickle.loads(embedding_blob)
+        embedding = DBEmbCodec.decode_embedding(embedding_blob)
         data.append([npcID, time, isInstruction, content, importance, embedding, sname])
 
     columns = ['npcID', 'Time', 'isInstruction', 'Content', 'Importance', 'Embedding', 'sname']
@@ -178,7 +178,7 @@ def retrieve_entries_between_time(connection, npcID, start_time, end_time, limit
     data = []
     for result in results:
         npcID, time, isInstruction, content, importance, embedding_blob, sname = result
-        embedding = pickle.loads(embedding_blob)
+        embedding = DBEmbCodec.decode_embedding(embedding_blob)
         data.append([npcID, time, isInstruction, content, importance, embedding, sname])
 
     columns = ['npcID', 'Time', 'isInstruction', 'Content', 'Importance', 'Embedding', 'sname']
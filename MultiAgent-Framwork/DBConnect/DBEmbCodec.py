@@ -0,0 +1,186 @@
+import pickle  # Rows written before the binary format hold pickled lists
+import threading
+import zlib
+import configparser
+import os
+
+import numpy as np
+
+# Binary format of the embeddings of the memory stream tables.
+# An embedding is stored as a 4-byte tag followed by little-endian values:
+#   float32    b'EF32' + float32 values                 6 KB for 1536 dimensions, read back without a copy
+#   float16    b'EF16' + float16 values                 half of that, for a small loss of precision
+#   int8       b'EI08' + float32 scale + int8 values    a quarter, each vector scaled by its largest value
+#   pca        b'EP32' + model id + float32 values      projection on the first pca components
+#   pca_int8   b'EP08' + model id + scale + int8 values the projection, scaled to int8
+# instead of a pickled list of Python floats (about 29 KB, and a Python object
+# per value to build on every read). Pickled rows are still read, as float32
+# arrays, until DBEmbMigrate converts them.
+# Every format is decoded to a float32 vector of the original dimension (the
+# PCA ones are reconstructed from their projection), and the query embedding is
+# never quantized: retrieval scores the float32 query against the decoded
+# vectors, so the compression only costs the error of the stored side.
+# DBEmbEval measures that error as the recall@k of each format against the
+# exact float32 scores, and fits the PCA model (mean and components, saved to
+# pca_path; its id is stored in the rows so they are never decoded with another one).
+# The format of the new rows comes from the optional [MemoryStream] section of config.ini:
+#   embedding_format = float32     or float16, int8, pca, pca_int8
+#   pca_path = DBConnect/embedding_pca.npz
+
+config = configparser.ConfigParser()
+# Adjust the path to locate config.ini one level above this file's directory
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.ini')
+config.read(config_path)
+
+FORMATS = {
+    'float32': b'EF32',
+    'float16': b'EF16',
+    'int8': b'EI08',
+    'pca': b'EP32',
+    'pca_int8': b'EP08',
+}
+PCA_FORMATS = ('pca', 'pca_int8')
+TAG_SIZE = 4
+FLOAT32 = np.dtype('<f4')
+FLOAT16 = np.dtype('<f2')
+MODEL_ID = np.dtype('<u4')
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+PCA_PATH = os.path.join(base_dir, config.get('MemoryStream', 'pca_path', fallback=os.path.join('DBConnect', 'embedding_pca.npz')))
+
+
+############################################
+# PCA Model
+############################################
+
+class PcaModel:
+    """
+    Projection of the embeddings on their first principal components.
+    mean: (dimension,) float32, components: (reduced dimension, dimension) float32 with orthonormal rows
+    """
+
+    def __init__(self, mean, components):
+        self.mean = np.ascontiguousarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.model_id = zlib.crc32(self.mean.tobytes() + self.components.tobytes())
+
+    def project(self, vector):
+        return self.components @ (vector - self.mean)
+
+    def reconstruct(self, projection):
+        return projection @ self.components + self.mean
+
+def fit_pca(embeddings, dimension):
+    """
+    PcaModel of the first dimension components of the embeddings (one per row).
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    mean = matrix.mean(axis=0)
+    _, _, components = np.linalg.svd(matrix - mean, full_matrices=False)
+    return PcaModel(mean, components[:dimension])
+
+def save_pca(model, path=PCA_PATH):
+    with open(path, 'wb') as file:
+        np.savez(file, mean=model.mean, components=model.components)
+
+pca_lock = threading.Lock()
+pca_models = {}  # path -> PcaModel
+
+def load_pca(path=PCA_PATH):
+    """
+    The PcaModel saved at path, None when there is none.
+    """
+    with pca_lock:
+        if path not in pca_models:
+            if not os.path.exists(path):
+                return None
+            with np.load(path) as saved:
+                pca_models[path] = PcaModel(saved['mean'], saved['components'])
+        return pca_models[path]
+
+
+############################################
+# Encoding
+############################################
+
+def quantize(vector):
+    """
+    Symmetric int8 codes of a vector and their float32 scale.
+    """
+    largest = float(np.abs(vector).max()) if len(vector) else 0.0
+    scale = largest / 127 if largest else 1.0
+    return np.rint(vector / scale).astype(np.int8), scale
+
+def blob_format(blob):
+    """
+    Format name of a stored embedding, 'pickle' for the rows written before the binary format.
+    """
+    tag = bytes(blob[:TAG_SIZE])
+    for name, format_tag in FORMATS.items():
+        if tag == format_tag:
+            return name
+    return 'pickle'
+
+def encode_embedding(embedding, embedding_format=None, pca_model=None):
+    """
+    Tagged little-endian bytes of an embedding (list or array), in embedding_format
+    (EMBEDDING_FORMAT by default). The PCA formats use pca_model, or the one at PCA_PATH.
+    """
+    embedding_format = embedding_format or EMBEDDING_FORMAT
+    tag = FORMATS[embedding_format]
+    vector = np.asarray(embedding, dtype=np.float32).ravel()
+    if embedding_format == 'float32':
+        return tag + vector.astype(FLOAT32).tobytes()
+    if embedding_format == 'float16':
+        return tag + vector.astype(FLOAT16).tobytes()
+    header = tag
+    if embedding_format in PCA_FORMATS:
+        pca_model = pca_model or load_pca()
+        if pca_model is None:
+            raise ValueError(f"No PCA model at {PCA_PATH}, fit one with DBEmbEval --save-pca")
+        header += np.array(pca_model.model_id, dtype=MODEL_ID).tobytes()
+        vector = pca_model.project(vector)
+        if embedding_format == 'pca':
+            return header + vector.astype(FLOAT32).tobytes()
+    codes, scale = quantize(vector)
+    return header + np.array(scale, dtype=FLOAT32).tobytes() + codes.tobytes()
+
+def decode_embedding(blob, pca_model=None):
+    """
+    float32 array of a stored embedding. A float32 blob is viewed in place with
+    np.frombuffer (read-only when the driver returns bytes); the others are
+    dequantized, and the PCA ones reconstructed with pca_model or the one at PCA_PATH.
+    """
+    embedding_format = blob_format(blob)
+    if embedding_format == 'pickle':
+        return np.asarray(pickle.loads(blob), dtype=np.float32)
+    if embedding_format == 'float32':
+        vector = np.frombuffer(blob, dtype=FLOAT32, offset=TAG_SIZE)
+        return vector if FLOAT32.isnative else vector.astype(np.float32)
+    if embedding_format == 'float16':
+        return np.frombuffer(blob, dtype=FLOAT16, offset=TAG_SIZE).astype(np.float32)
+
+    offset = TAG_SIZE
+    if embedding_format in PCA_FORMATS:
+        model_id = int(np.frombuffer(blob, dtype=MODEL_ID, count=1, offset=offset)[0])
+        offset += MODEL_ID.itemsize
+        pca_model = pca_model or load_pca()
+        if pca_model is None or pca_model.model_id != model_id:
+            raise ValueError(f"Embedding projected with PCA model {model_id:08x}, not the one at {PCA_PATH}")
+    if embedding_format == 'pca':
+        vector = np.frombuffer(blob, dtype=FLOAT32, offset=offset).astype(np.float32)
+    else:
+        scale = np.frombuffer(blob, dtype=FLOAT32, count=1, offset=offset)[0]
+        vector = np.frombuffer(blob, dtype=np.int8, offset=offset + FLOAT32.itemsize).astype(np.float32) * scale
+    if embedding_format in PCA_FORMATS:
+        return pca_model.reconstruct(vector)
+    return vector
+
+
+EMBEDDING_FORMAT = config.get('MemoryStream', 'embedding_format', fallback='float32').strip().lower()
+if EMBEDDING_FORMAT not in FORMATS:
+    print(f"Method: DBEmbCodec | Unknown embedding_format '{EMBEDDING_FORMAT}', using float32")
+    EMBEDDING_FORMAT = 'float32'
+elif EMBEDDING_FORMAT in PCA_FORMATS and load_pca() is None:
+    print(f"Method: DBEmbCodec | embedding_format '{EMBEDDING_FORMAT}' needs a PCA model at {PCA_PATH}, using float32")
+    EMBEDDING_FORMAT = 'float32'
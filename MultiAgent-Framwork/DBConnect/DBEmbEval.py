@@ -0,0 +1,150 @@
+import sys
+import os
+import argparse
+
+import numpy as np
+
+# Add the base directory (one level up from the current directory)
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(base_dir)
+
+from DBConnect import DBCon
+from DBConnect import DBEmbCodec
+
+# Recall@k of the compressed embedding formats of DBEmbCodec.
+# A sample of the memory stream embeddings still stored exactly (float32 or
+# pickled rows) is read, and some of them are used as queries against all the
+# others. For each format the stored vectors go through encode_embedding and
+# decode_embedding, the float32 query is scored against them (cosine
+# similarity, as in retrieval) and the top k are compared with the top k of the
+# exact float32 scores: recall@k is the share of the exact top k that is found.
+# Recency and importance are not affected by the format, so the recall of the
+# full retrieval score is at least as high.
+#   python DBConnect/DBEmbEval.py --k 10 30 --pca-dims 256 512
+#   python DBConnect/DBEmbEval.py --save-pca 256      fits and saves the PCA model used by the pca formats
+
+TABLES = ['behavior_memeory_stream', 'comment_reply_memeory_stream']
+
+
+def read_embeddings(connection, limit):
+    """
+    Exact (float32 or pickled) embeddings of the memory stream tables, the most recent first.
+    """
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    embeddings = []
+    skipped = 0
+    for table_name in TABLES:
+        cursor.execute(
+            "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = 'AITown' AND TABLE_NAME = %s",
+            (table_name,)
+        )
+        if cursor.fetchone() is None:
+            continue
+        cursor.execute(f"SELECT Embedding FROM {table_name} ORDER BY Time DESC LIMIT %s", (limit - len(embeddings),))
+        for (embedding_blob,) in cursor.fetchall():
+            if embedding_blob is None:
+                continue
+            if DBEmbCodec.blob_format(embedding_blob) not in ('float32', 'pickle'):
+                skipped += 1
+                continue
+            embeddings.append(DBEmbCodec.decode_embedding(embedding_blob))
+        if len(embeddings) >= limit:
+            break
+    if skipped:
+        print(f"Method: DBEmbEval | Skipped {skipped} rows already stored in a compressed format")
+    dimensions = {len(embedding) for embedding in embeddings}
+    if len(dimensions) > 1:
+        # Keep the most common dimension (e.g. after a change of embedding model)
+        dimension = max(dimensions, key=lambda d: sum(len(embedding) == d for embedding in embeddings))
+        embeddings = [embedding for embedding in embeddings if len(embedding) == dimension]
+    return np.asarray(embeddings, dtype=np.float32)
+
+def unit_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def top_k(scores, k):
+    # Indices of the k best scores of each row
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+def recall_at_k(exact_scores, approximate_scores, k):
+    exact = top_k(exact_scores, k)
+    approximate = top_k(approximate_scores, k)
+    found = [len(np.intersect1d(e, a, assume_unique=True)) for e, a in zip(exact, approximate)]
+    return float(np.mean(found)) / k
+
+def evaluate(embeddings, query_rows, formats, ks):
+    """
+    Returns format -> (bytes per embedding, {k: recall@k}).
+    formats: name -> (DBEmbCodec format, PcaModel or None)
+    """
+    corpus = unit_rows(embeddings)
+    queries = corpus[query_rows]
+    exact_scores = queries @ corpus.T
+    # A query is one of the stored memories: never count it as its own neighbour
+    exact_scores[np.arange(len(query_rows)), query_rows] = -np.inf
+
+    results = {}
+    for name, (embedding_format, pca_model) in formats.items():
+        blobs = [DBEmbCodec.encode_embedding(embedding, embedding_format, pca_model) for embedding in embeddings]
+        decoded = unit_rows(np.stack([DBEmbCodec.decode_embedding(blob, pca_model) for blob in blobs]))
+        approximate_scores = queries @ decoded.T
+        approximate_scores[np.arange(len(query_rows)), query_rows] = -np.inf
+        size = float(np.mean([len(blob) for blob in blobs]))
+        results[name] = (size, {k: recall_at_k(exact_scores, approximate_scores, k) for k in ks})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k of the compressed embedding formats against exact float32 scores.")
+    parser.add_argument('--limit', type=int, default=5000, help="embeddings read from the memory stream tables")
+    parser.add_argument('--queries', type=int, default=200, help="embeddings used as queries")
+    parser.add_argument('--k', type=int, nargs='+', default=[10, 30], help="recall@k to compute")
+    parser.add_argument('--pca-dims', type=int, nargs='*', default=[128, 256, 512], help="PCA dimensions to evaluate")
+    parser.add_argument('--save-pca', type=int, metavar='DIM', help=f"fit the PCA model of DIM dimensions and save it to {DBEmbCodec.PCA_PATH}")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    db_conn = DBCon.establish_sql_connection()
+    if db_conn is None:
+        return
+    try:
+        embeddings = read_embeddings(db_conn, args.limit)
+    finally:
+        if DBCon.is_connected(db_conn):
+            DBCon.close_sql_connection(db_conn)
+    if len(embeddings) <= max(args.k):
+        print(f"Method: DBEmbEval | Only {len(embeddings)} exact embeddings, not enough for recall@{max(args.k)}")
+        return
+    dimension = embeddings.shape[1]
+    print(f"Method: DBEmbEval | {len(embeddings)} embeddings of dimension {dimension}")
+
+    formats = {name: (name, None) for name in ('float32', 'float16', 'int8')}
+    for pca_dimension in args.pca_dims:
+        if pca_dimension >= min(dimension, len(embeddings)):
+            continue
+        pca_model = DBEmbCodec.fit_pca(embeddings, pca_dimension)
+        formats[f"pca {pca_dimension}"] = ('pca', pca_model)
+        formats[f"pca_int8 {pca_dimension}"] = ('pca_int8', pca_model)
+
+    rng = np.random.default_rng(args.seed)
+    query_rows = rng.choice(len(embeddings), size=min(args.queries, len(embeddings)), replace=False)
+    results = evaluate(embeddings, query_rows, formats, args.k)
+    for name, (size, recalls) in results.items():
+        recall_text = ", ".join(f"recall@{k}: {recall:.3f}" for k, recall in recalls.items())
+        print(f"Method: DBEmbEval | {name:<14} | {size:7.0f} bytes per embedding | {recall_text}")
+
+    if args.save_pca:
+        if os.path.exists(DBEmbCodec.PCA_PATH):
+            # Rows projected with the current model could not be decoded any more
+            print(f"Method: DBEmbEval | {DBEmbCodec.PCA_PATH} already exists, not replaced")
+            return
+        pca_model = DBEmbCodec.fit_pca(embeddings, args.save_pca)
+        DBEmbCodec.save_pca(pca_model, DBEmbCodec.PCA_PATH)
+        print(f"Method: DBEmbEval | Saved the PCA model of {args.save_pca} dimensions ({pca_model.model_id:08x}) to {DBEmbCodec.PCA_PATH}")
+
+
+if __name__ == '__main__':
+    main()
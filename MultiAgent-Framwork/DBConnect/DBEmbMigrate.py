@@ -0,0 +1,110 @@
+import sys
+import os
+import argparse
+
+# Add the base directory (one level up from the current directory)
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(base_dir)
+
+from DBConnect import DBCon
+from DBConnect import DBEmbCodec
+
+# Converts the embeddings of the memory stream tables to the binary format of
+# DBEmbCodec, in batches of rows committed one at a time, so it can be stopped
+# and run again: rows already in the target format are left as they are.
+#   python DBConnect/DBEmbMigrate.py                      pickled rows -> embedding_format of config.ini
+#   python DBConnect/DBEmbMigrate.py --format float16     every row -> float16
+#   python DBConnect/DBEmbMigrate.py --format int8        every row -> int8 (see DBEmbEval for the recall)
+#   python DBConnect/DBEmbMigrate.py --dry-run            only count the rows and bytes
+
+TABLES = ['behavior_memeory_stream', 'comment_reply_memeory_stream']
+KEY_COLUMNS = ['npcID', 'Time', 'isInstruction']  # Primary key of both tables
+
+
+def table_exists(connection, table_name):
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = 'AITown' AND TABLE_NAME = %s",
+        (table_name,)
+    )
+    return cursor.fetchone() is not None
+
+def migrate_table(connection, table_name, embedding_format, batch_size=500, dry_run=False):
+    """
+    Re-encodes the embeddings of table_name that are not in embedding_format.
+    Returns the counts of rows read and converted, and the Embedding bytes before and after.
+    """
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    select_query = f"""
+    SELECT npcID, Time, isInstruction, Embedding
+    FROM {table_name}
+    WHERE (npcID, Time, isInstruction) > (%s, %s, %s)
+    ORDER BY npcID, Time, isInstruction
+    LIMIT %s
+    """
+    update_query = f"UPDATE {table_name} SET Embedding = %s WHERE npcID = %s AND Time = %s AND isInstruction = %s"
+
+    stats = {'rows': 0, 'converted': 0, 'bytes_before': 0, 'bytes_after': 0}
+    last_key = ('', '1000-01-01 00:00:00', -1)
+    while True:
+        cursor.execute(select_query, (*last_key, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        updates = []
+        for npcID, time, isInstruction, embedding_blob in rows:
+            stats['rows'] += 1
+            if embedding_blob is None:
+                continue
+            if DBEmbCodec.blob_format(embedding_blob) == embedding_format:
+                stats['bytes_before'] += len(embedding_blob)
+                stats['bytes_after'] += len(embedding_blob)
+                continue
+            try:
+                new_blob = DBEmbCodec.encode_embedding(DBEmbCodec.decode_embedding(embedding_blob), embedding_format)
+            except Exception as e:
+                print(f"Method: DBEmbMigrate | {table_name} | Skipped npcID={npcID}, time={time}, isInstruction={isInstruction}: {e}")
+                continue
+            stats['bytes_before'] += len(embedding_blob)
+            stats['bytes_after'] += len(new_blob)
+            updates.append((new_blob, npcID, time, isInstruction))
+        if updates and not dry_run:
+            cursor.executemany(update_query, updates)
+            connection.commit()
+        stats['converted'] += len(updates)
+        last_key = rows[-1][:3]
+        print(f"Method: DBEmbMigrate | {table_name} | Rows read: {stats['rows']}, converted: {stats['converted']}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the memory stream embeddings to the binary format of DBEmbCodec.")
+    parser.add_argument('--format', choices=sorted(DBEmbCodec.FORMATS), default=DBEmbCodec.EMBEDDING_FORMAT,
+                        help="target format (default: embedding_format of config.ini)")
+    parser.add_argument('--batch-size', type=int, default=500, help="rows read and committed at a time")
+    parser.add_argument('--dry-run', action='store_true', help="count the rows to convert without writing them")
+    args = parser.parse_args()
+    if args.format in DBEmbCodec.PCA_FORMATS and DBEmbCodec.load_pca() is None:
+        print(f"Method: DBEmbMigrate | {args.format} needs a PCA model at {DBEmbCodec.PCA_PATH}, fit one with DBEmbEval --save-pca")
+        return
+
+    db_conn = DBCon.establish_sql_connection()
+    if db_conn is None:
+        return
+    try:
+        for table_name in TABLES:
+            if not table_exists(db_conn, table_name):
+                print(f"Method: DBEmbMigrate | {table_name} | Table does not exist, skipped")
+                continue
+            stats = migrate_table(db_conn, table_name, args.format, args.batch_size, args.dry_run)
+            action = "Would convert" if args.dry_run else "Converted"
+            print(f"Method: DBEmbMigrate | {table_name} | {action} {stats['converted']} of {stats['rows']} rows to {args.format}, "
+                  f"embeddings: {stats['bytes_before'] / 1e6:.1f} MB -> {stats['bytes_after'] / 1e6:.1f} MB")
+    finally:
+        if DBCon.is_connected(db_conn):
+            DBCon.close_sql_connection(db_conn)
+
+
+if __name__ == '__main__':
+    main()
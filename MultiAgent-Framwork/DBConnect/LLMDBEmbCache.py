@@ -0,0 +1,112 @@
+import pickle  # To serialize and deserialize Python objects (like the embedding list)
+
+
+def check_connection(connection):
+    if connection.is_connected():
+        print("Connection is still active.")
+    else:
+        print("Connection is not active. Reconnecting...")
+        connection.reconnect(attempts=3, delay=5)
+        if connection.is_connected():
+            print("Reconnection successful.")
+        else:
+            print("Reconnection failed.")
+
+def database_exists(connection):
+    db_name = 'AITown'
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA WHERE SCHEMA_NAME = '{db_name}'")
+    result = cursor.fetchone()
+    if result:
+        print(f"Database '{db_name}' exists.")
+        return True
+    else:
+        print(f"Database '{db_name}' does not exist.")
+        return False
+
+def create_table(connection):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")  # Use the AITown database
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS llm_embedding_cache (
+        cacheKey CHAR(64) NOT NULL,
+        model VARCHAR(255) NOT NULL,
+        Embedding MEDIUMBLOB,
+        created_Time DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (cacheKey)
+    )
+    """
+    cursor.execute(create_table_query)
+    print("Table 'llm_embedding_cache' checked/created successfully.")
+
+def delete_table(connection):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    delete_table_query = "DROP TABLE IF EXISTS llm_embedding_cache"
+    cursor.execute(delete_table_query)
+    connection.commit()
+    print("Table 'llm_embedding_cache' has been deleted successfully.")
+
+def table_exists(connection):
+    db_name = 'AITown'
+    table_name = 'llm_embedding_cache'
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        SELECT TABLE_NAME
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = '{db_name}' AND TABLE_NAME = '{table_name}'
+    """)
+    result = cursor.fetchone()
+    if result:
+        print(f"Table '{table_name}' exists in database '{db_name}'.")
+        return True
+    else:
+        print(f"Table '{table_name}' does not exist in database '{db_name}'.")
+        return False
+
+def insert_into_table(connection, cache_key, model, embedding):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    embedding_blob = pickle.dumps(embedding)
+    insert_query = """
+    INSERT INTO llm_embedding_cache (cacheKey, model, Embedding)
+    VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE Embedding = VALUES(Embedding)
+    """
+    cursor.execute(insert_query, (cache_key, model, embedding_blob))
+    connection.commit()
+    print(f"Data inserted successfully: cacheKey={cache_key}, model={model}, embedding length={len(embedding)}")
+
+def retrieve_entry(connection, cache_key):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    select_query = "SELECT Embedding FROM llm_embedding_cache WHERE cacheKey = %s"
+    cursor.execute(select_query, (cache_key,))
+    result = cursor.fetchone()
+    if result:
+        embedding = pickle.loads(result[0])
+        return embedding
+    else:
+        return None
+
+def retrieve_entries(connection, cache_keys):
+    """
+    Returns a dict cacheKey -> embedding for the keys found in the table.
+    """
+    if not cache_keys:
+        return {}
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    placeholders = ", ".join(["%s"] * len(cache_keys))
+    select_query = f"SELECT cacheKey, Embedding FROM llm_embedding_cache WHERE cacheKey IN ({placeholders})"
+    cursor.execute(select_query, tuple(cache_keys))
+    results = cursor.fetchall()
+    return {cache_key: pickle.loads(embedding_blob) for cache_key, embedding_blob in results}
+
+def delete_all_entries(connection):
+    cursor = connection.cursor()
+    cursor.execute("USE AITown")
+    delete_query = "DELETE FROM llm_embedding_cache"
+    cursor.execute(delete_query)
+    connection.commit()
+    print("All entries in the 'llm_embedding_cache' table have been deleted successfully.")
@@ -0,0 +1,145 @@
+import threading
+import time
+import configparser
+import os
+from collections import deque
+
+# Circuit breakers for the LLM call layer, one per (provider, model).
+# A breaker opens when too many of the recent calls failed (timeouts, connection
+# errors, 5xx) or were too slow. While open, calls fail at once with CircuitOpen
+# instead of waiting for a full timeout; a client with a fallback provider (see
+# LLMHedge) then sends them to the fallback right away. Once open_seconds have
+# passed, a few probe calls are let through (half open): if they succeed the
+# breaker closes, otherwise it opens again for twice as long.
+# Settings come from the optional [CircuitBreaker] section of config.ini:
+#   window = 20               recent calls considered
+#   min_calls = 5             calls needed in the window before it can open
+#   failure_rate = 50         percent of failed or slow calls that opens it
+#   slow_call_seconds = 30    a call taking longer counts as failed
+#   open_seconds = 30         first open period, doubled on each failed probe up to 300
+#   half_open_probes = 1      calls let through at once while half open
+
+config = configparser.ConfigParser()
+# Adjust the path to locate config.ini one level above this file's directory
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.ini')
+config.read(config_path)
+
+WINDOW = config.getint('CircuitBreaker', 'window', fallback=20)
+MIN_CALLS = config.getint('CircuitBreaker', 'min_calls', fallback=5)
+FAILURE_RATE = config.getfloat('CircuitBreaker', 'failure_rate', fallback=50) / 100.0
+SLOW_CALL_SECONDS = config.getfloat('CircuitBreaker', 'slow_call_seconds', fallback=30)
+OPEN_SECONDS = config.getfloat('CircuitBreaker', 'open_seconds', fallback=30)
+MAX_OPEN_SECONDS = 300.0
+HALF_OPEN_PROBES = config.getint('CircuitBreaker', 'half_open_probes', fallback=1)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=WINDOW)  # True for a failed or slow call
+        self.opened_until = 0.0
+        self.open_seconds = OPEN_SECONDS
+        self.probes_in_flight = 0
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.times_opened = 0
+
+    def _set_state(self, state, reason):
+        print(f"Method: CircuitBreaker | {self.name} | {self.state} -> {state}: {reason}")
+        self.state = state
+
+    def _open(self, reason):
+        self.opened_until = time.monotonic() + self.open_seconds
+        self.times_opened += 1
+        self._set_state(OPEN, f"{reason}, failing fast for {self.open_seconds:.0f}s")
+
+    def before_call(self):
+        """
+        Raises CircuitOpen if the call must not be sent. Returns True for a half-open
+        probe, which must be reported with after_call.
+        """
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() < self.opened_until:
+                    self.rejected += 1
+                    raise CircuitOpen(f"Circuit of {self.name} is open for another {self.opened_until - time.monotonic():.0f}s")
+                self._set_state(HALF_OPEN, "open period over, probing")
+            if self.state == HALF_OPEN:
+                if self.probes_in_flight >= HALF_OPEN_PROBES:
+                    self.rejected += 1
+                    raise CircuitOpen(f"Circuit of {self.name} is half open and already probing")
+                self.probes_in_flight += 1
+                return True
+            return False
+
+    def after_call(self, probe, failed, seconds):
+        """
+        failed: the call raised an error that says the provider is unhealthy
+        seconds: duration of the call; above SLOW_CALL_SECONDS it counts as failed
+        """
+        failed = failed or seconds > SLOW_CALL_SECONDS
+        with self.lock:
+            if probe:
+                self.probes_in_flight -= 1
+                if self.state != HALF_OPEN:
+                    return
+                if failed:
+                    self.open_seconds = min(MAX_OPEN_SECONDS, self.open_seconds * 2)
+                    self._open("probe failed")
+                elif self.probes_in_flight == 0:
+                    self.outcomes.clear()
+                    self.open_seconds = OPEN_SECONDS
+                    self._set_state(CLOSED, "probe succeeded")
+                return
+
+            self.outcomes.append(failed)
+            if self.state == CLOSED and len(self.outcomes) >= MIN_CALLS:
+                rate = sum(self.outcomes) / len(self.outcomes)
+                if rate >= FAILURE_RATE:
+                    self._open(f"{rate:.0%} of the last {len(self.outcomes)} calls failed or were slow")
+
+    def cancel(self, probe):
+        # The call was given up before it was sent
+        if probe:
+            with self.lock:
+                self.probes_in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'failure_rate': sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0,
+                'rejected': self.rejected,
+                'times_opened': self.times_opened,
+            }
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+def get_breaker(provider, model):
+    with breakers_lock:
+        breaker = breakers.get((provider, model))
+        if breaker is None:
+            breaker = CircuitBreaker(f"{provider}/{model}")
+            breakers[(provider, model)] = breaker
+        return breaker
+
+def breaker_stats():
+    with breakers_lock:
+        return {breaker.name: breaker.stats() for breaker in breakers.values()}
+
+def print_breaker_stats():
+    for name, stats in breaker_stats().items():
+        print(f"Method: LLMBreaker.breaker_stats | {name} | State: {stats['state']}, recent failure rate: {stats['failure_rate']:.0%}, "
+              f"rejected: {stats['rejected']}, times opened: {stats['times_opened']}")
@@ -0,0 +1,248 @@
+import hashlib
+import threading
+import time
+import configparser
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from DBConnect import DBCon
+from DBConnect import LLMDBEmbCache
+
+# Caches shared by every controller of one process.
+# Settings come from the optional [LLMCache] section of config.ini:
+#   embedding_cache_size = 4096      entries kept in memory
+#   persistent_embeddings = true     also keep embeddings in the llm_embedding_cache table
+#   database_retry_seconds = 30      pause after a database error, doubled on each failure in a row
+#   database_connections = 4         MySQL connections shared by the threads using the cache
+#   importance_cache_size = 2048     importance scores kept in memory
+
+config = configparser.ConfigParser()
+# Adjust the path to locate config.ini one level above this file's directory
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.ini')
+config.read(config_path)
+
+DATABASE_RETRY_SECONDS = config.getfloat('LLMCache', 'database_retry_seconds', fallback=30)
+MAX_DATABASE_RETRY_SECONDS = 600.0
+DATABASE_CONNECTIONS = config.getint('LLMCache', 'database_connections', fallback=4)
+
+
+def normalize_text(text):
+    """
+    Collapses newlines and repeated whitespace, so texts differing only in layout share one entry.
+    """
+    return " ".join(str(text).split())
+
+def text_key(text, namespace):
+    """
+    Content address of a result computed from a text: sha256 of the namespace
+    (e.g. the model) and the normalized text.
+    """
+    return hashlib.sha256(f"{namespace}\n{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+def embedding_key(text, model):
+    return text_key(text, model)
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache.
+    get_or_compute also makes concurrent callers asking for the same missing key
+    wait for a single computation instead of each computing it.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            future = self.in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.in_flight[key] = future
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except Exception as e:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+        self.put(key, value)
+        with self.lock:
+            self.in_flight.pop(key, None)
+        future.set_result(value)
+        return value
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache keyed by embedding_key(text, model):
+    an in-process LRU, backed by the llm_embedding_cache MySQL table so that
+    embeddings survive process restarts. If the database is not reachable the
+    cache works in memory only, and tries the database again after a growing pause.
+    """
+
+    def __init__(self, maxsize=4096, persistent=True, max_connections=DATABASE_CONNECTIONS):
+        self.memory = LRUCache(maxsize)
+        self.persistent = persistent
+        # A bounded pool of connections, each used by one thread at a time since
+        # mysql connections are not thread-safe
+        self.idle_connections = []
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.table_checked = False
+        self.state_lock = threading.Lock()
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def _connect(self, connection):
+        if connection is None:
+            connection = DBCon.establish_sql_connection()
+            if connection is None:
+                raise RuntimeError("no MySQL configuration")
+        else:
+            connection = DBCon.check_and_reconnect(connection)
+        if not self.table_checked:
+            with self.state_lock:
+                if not self.table_checked:
+                    if not LLMDBEmbCache.table_exists(connection):
+                        LLMDBEmbCache.create_table(connection)
+                    self.table_checked = True
+        return connection
+
+    def _db_call(self, function, *args):
+        if not self.persistent or time.monotonic() < self.retry_at:
+            return None
+        with self.connection_slots:
+            with self.state_lock:
+                connection = self.idle_connections.pop() if self.idle_connections else None
+            try:
+                connection = self._connect(connection)
+                result = function(connection, *args)
+            except Exception as e:
+                try:
+                    if connection is not None:
+                        connection.close()
+                except Exception:
+                    pass
+                with self.state_lock:
+                    self.failures += 1
+                    pause = min(MAX_DATABASE_RETRY_SECONDS, DATABASE_RETRY_SECONDS * 2 ** (self.failures - 1))
+                    self.retry_at = time.monotonic() + pause
+                print(f"Embedding cache database unavailable: {e}. Keeping embeddings in memory only for {pause:.0f}s.")
+                return None
+            with self.state_lock:
+                self.idle_connections.append(connection)
+                self.failures = 0
+            return result
+
+    def lookup(self, text, model):
+        """
+        Returns the cached embedding or None.
+        """
+        key = embedding_key(text, model)
+        embedding = self.memory.get(key)
+        if embedding is None:
+            embedding = self._db_call(LLMDBEmbCache.retrieve_entry, key)
+            if embedding is not None:
+                self.memory.put(key, embedding)
+        return embedding
+
+    def lookup_many(self, texts, model):
+        """
+        Returns a list with the cached embedding, or None, for each text.
+        The database is queried once for all texts missing in memory.
+        """
+        keys = [embedding_key(text, model) for text in texts]
+        embeddings = [self.memory.get(key) for key in keys]
+        missing = [key for key, embedding in zip(keys, embeddings) if embedding is None]
+        if missing:
+            found = self._db_call(LLMDBEmbCache.retrieve_entries, list(set(missing))) or {}
+            for i, key in enumerate(keys):
+                if embeddings[i] is None and key in found:
+                    embeddings[i] = found[key]
+                    self.memory.put(key, found[key])
+        return embeddings
+
+    def store(self, text, model, embedding):
+        key = embedding_key(text, model)
+        self.memory.put(key, embedding)
+        self._db_call(LLMDBEmbCache.insert_into_table, key, model, embedding)
+
+    def get_or_create(self, text, model, create):
+        """
+        Returns the embedding of text, calling create(normalized_text) only on a miss
+        in both tiers. Concurrent misses on the same text share one create call.
+        """
+        key = embedding_key(text, model)
+
+        def load_or_create():
+            embedding = self._db_call(LLMDBEmbCache.retrieve_entry, key)
+            if embedding is None:
+                embedding = create(normalize_text(text))
+                self._db_call(LLMDBEmbCache.insert_into_table, key, model, embedding)
+            return embedding
+
+        return self.memory.get_or_compute(key, load_or_create)
+
+    def get_or_create_many(self, texts, model, create_many):
+        """
+        Returns the embeddings of texts, in order. The texts missing in both tiers
+        are created with a single create_many(normalized_texts) call.
+        """
+        embeddings = self.lookup_many(texts, model)
+        missing = {}
+        for i, (text, embedding) in enumerate(zip(texts, embeddings)):
+            if embedding is None:
+                missing.setdefault(normalize_text(text), []).append(i)
+        if missing:
+            created = create_many(list(missing))
+            for (normalized, positions), embedding in zip(missing.items(), created):
+                for i in positions:
+                    embeddings[i] = embedding
+                self.store(normalized, model, embedding)
+        return embeddings
+
+
+embedding_cache = EmbeddingCache(
+    maxsize=config.getint('LLMCache', 'embedding_cache_size', fallback=4096),
+    persistent=config.getboolean('LLMCache', 'persistent_embeddings', fallback=True),
+)
+
+# Importance scores by text_key(text, "importance:" + model), so a memory scored for
+# the memory stream is not scored again for the reflection tracer
+importance_cache = LRUCache(config.getint('LLMCache', 'importance_cache_size', fallback=2048))
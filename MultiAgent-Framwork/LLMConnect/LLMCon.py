@@ -0,0 +1,435 @@
+import asyncio
+import threading
+import time
+import weakref
+import configparser
+import os
+
+import httpx
+from openai import OpenAI, AsyncOpenAI, RateLimitError, AuthenticationError, PermissionDeniedError
+from openai import APITimeoutError, APIConnectionError, InternalServerError
+
+from LLMConnect import LLMRateLimit
+from LLMConnect import LLMKeyPool
+from LLMConnect import LLMHedge
+from LLMConnect import LLMBreaker
+from LLMConnect import LLMRetry
+from LLMConnect import LLMPrompt
+
+# One keep-alive HTTP connection pool per process, shared by every OpenAI-compatible
+# client (chat and embeddings, all providers), instead of one default-sized pool
+# per client created by each controller at import time. The async clients share
+# one pool per event loop, since httpx async connections belong to the loop that
+# opened them (a process calling asyncio.run twice gets a new pool the second time).
+# The clients returned by make_client / make_async_client keep the OpenAI call
+# shape, and are the single call layer where rate limiting, API key balancing,
+# circuit breaking, retries, deadlines and hedging to a fallback provider are
+# applied. The OpenAI clients' own retries are turned off so that retries are
+# bounded by the deadline and counted in LLMRetry.
+# Settings come from the optional [HTTPPool] section of config.ini:
+#   max_connections = 100         connections open at once, over all hosts
+#   max_keepalive_connections = 40
+#   keepalive_expiry = 30         seconds an idle connection is kept
+#   http2 = true                  used when the h2 package is installed
+#   timeout = 60                  seconds per request
+
+config = configparser.ConfigParser()
+# Adjust the path to locate config.ini one level above this file's directory
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.ini')
+config.read(config_path)
+
+limits = httpx.Limits(
+    max_connections=config.getint('HTTPPool', 'max_connections', fallback=100),
+    max_keepalive_connections=config.getint('HTTPPool', 'max_keepalive_connections', fallback=40),
+    keepalive_expiry=config.getfloat('HTTPPool', 'keepalive_expiry', fallback=30),
+)
+timeout = httpx.Timeout(config.getfloat('HTTPPool', 'timeout', fallback=60), connect=10)
+
+use_http2 = config.getboolean('HTTPPool', 'http2', fallback=True)
+if use_http2:
+    try:
+        import h2  # noqa: F401  (httpx needs it for HTTP/2)
+    except ImportError:
+        print("HTTP/2 disabled: the h2 package is not installed")
+        use_http2 = False
+
+
+############################################
+# Pool Statistics
+############################################
+
+stats_lock = threading.Lock()
+pool_stats_counters = {
+    'requests': 0,
+    'new_connections': 0,
+    'tls_handshakes': 0,
+    'http2_requests': 0,
+}
+
+def _count(name):
+    with stats_lock:
+        pool_stats_counters[name] += 1
+
+def _trace(event_name, info):
+    # Called by httpcore for each step of a request
+    if event_name == 'connection.connect_tcp.complete':
+        _count('new_connections')
+    elif event_name == 'connection.start_tls.complete':
+        _count('tls_handshakes')
+    elif event_name == 'http2.send_request_headers.started':
+        _count('http2_requests')
+
+async def _async_trace(event_name, info):
+    _trace(event_name, info)
+
+def _on_request(request):
+    _count('requests')
+    request.extensions['trace'] = _trace
+
+async def _on_async_request(request):
+    _count('requests')
+    request.extensions['trace'] = _async_trace
+
+def pool_stats():
+    """
+    Returns the counters of the shared pool. Requests that did not open a new
+    connection reused a kept-alive one.
+    """
+    with stats_lock:
+        stats = dict(pool_stats_counters)
+    stats['reused_connections'] = max(0, stats['requests'] - stats['new_connections'])
+    return stats
+
+def print_pool_stats():
+    stats = pool_stats()
+    reuse_rate = stats['reused_connections'] / stats['requests'] if stats['requests'] else 0.0
+    print(f"Method: LLMCon.pool_stats | Requests: {stats['requests']}, new connections: {stats['new_connections']}, "
+          f"TLS handshakes: {stats['tls_handshakes']}, reused: {stats['reused_connections']} ({reuse_rate:.0%}), "
+          f"HTTP/2 requests: {stats['http2_requests']}")
+
+
+############################################
+# Shared Clients
+############################################
+
+http_client = httpx.Client(limits=limits, timeout=timeout, http2=use_http2, event_hooks={'request': [_on_request]})
+async_http_clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+async_http_clients_lock = threading.Lock()
+
+def get_async_http_client():
+    """
+    The shared async pool of the running event loop, created on its first use.
+    """
+    loop = asyncio.get_running_loop()
+    with async_http_clients_lock:
+        async_http_client = async_http_clients.get(loop)
+        if async_http_client is None:
+            async_http_client = httpx.AsyncClient(limits=limits, timeout=timeout, http2=use_http2, event_hooks={'request': [_on_async_request]})
+            async_http_clients[loop] = async_http_client
+        return async_http_client
+
+# Base url and (small, large) models of each provider, used for fallback clients
+PROVIDER_BASE_URLS = {
+    'openai': None,
+    'google': "https://generativelanguage.googleapis.com/v1beta/openai/",
+    'deepseek': "https://api.deepseek.com",
+}
+PROVIDER_MODELS = {
+    'openai': ("gpt-4o-mini", "gpt-4o"),
+    'google': ("gemini-2.5-flash", "gemini-2.5-flash"),
+    'deepseek': ("deepseek-chat", "deepseek-chat"),
+}
+
+def provider_name(base_url):
+    """
+    Name of the provider behind an OpenAI-compatible base url, used to key rate limits.
+    """
+    if not base_url:
+        return 'openai'
+    host = httpx.URL(base_url).host
+    for name in ('openai', 'google', 'deepseek', 'openrouter'):
+        if name in host:
+            return name
+    return host
+
+def _retry_after(error):
+    # Seconds asked by a 429 response, if any
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class _Endpoint:
+    # Gives the facades the `client.chat.completions.create` / `client.embeddings.create` shape
+    def __init__(self, create):
+        self.create = create
+
+
+# Providers accepting response_format json_schema, the others get JSON mode instead
+JSON_SCHEMA_PROVIDERS = {'openai'}
+
+def _for_provider(provider, request):
+    response_format = request.get('response_format')
+    if response_format and response_format.get('type') == 'json_schema' and provider not in JSON_SCHEMA_PROVIDERS:
+        return dict(request, response_format={"type": "json_object"})
+    return request
+
+def _send(client, endpoint, request):
+    if endpoint == 'chat':
+        return client.chat.completions.create(**request)
+    return client.embeddings.create(**request)
+
+def _provider_failure(error):
+    # Errors saying the provider is unhealthy, as opposed to a bad request or a rate limit
+    return isinstance(error, (APITimeoutError, APIConnectionError, InternalServerError))
+
+# Errors worth another attempt, possibly with another key
+TRANSIENT_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+def _report(key_pool, key_state, limiter, error=None):
+    # Key health bookkeeping; the limiter only pauses once no key is left
+    if isinstance(error, RateLimitError):
+        wait = key_pool.release(key_state, error, rate_limited=True, retry_after=_retry_after(error))
+        if wait:
+            limiter.pause(wait)
+    elif isinstance(error, (AuthenticationError, PermissionDeniedError)):
+        key_pool.release(key_state, error, auth_error=True)
+    else:
+        key_pool.release(key_state, error)
+
+
+class LLMClient:
+    """
+    Drop-in replacement of an OpenAI client for chat completions and embeddings.
+    Every call goes through the call layer of this module: the shared pool, the
+    rate limiter of its provider and model, and the provider's API key pool.
+    api_keys: one key, or a list of keys to balance the calls over
+    """
+
+    def __init__(self, api_keys, base_url=None):
+        self.provider = provider_name(base_url)
+        self.base_url = base_url
+        keys = [api_keys] if isinstance(api_keys, str) else list(api_keys)
+        self.key_pool = LLMKeyPool.get_pool(self.provider, keys)
+        self.clients = {key: OpenAI(base_url=base_url, api_key=key, http_client=http_client, max_retries=0) for key in keys}
+        self.fallback = None
+        self.fallback_models = {}
+        self.chat = _Endpoint(None)
+        self.chat.completions = _Endpoint(self.create_chat_completion)
+        self.embeddings = _Endpoint(self.create_embeddings)
+
+    def set_fallback(self, fallback, fallback_models):
+        """
+        fallback: client of another provider, raced against this one when a chat call is slow or fails
+        fallback_models: model of this client -> model to ask the fallback instead
+        """
+        self.fallback = fallback
+        self.fallback_models = fallback_models
+
+    def _call(self, endpoint, request):
+        # Fails fast while the provider's circuit is open
+        request = _for_provider(self.provider, request)
+        breaker = LLMBreaker.get_breaker(self.provider, request.get('model'))
+        probe = breaker.before_call()
+        limiter = LLMRateLimit.get_limiter(self.provider, request.get('model'), len(self.key_pool))
+        estimated_tokens = LLMRateLimit.estimate_tokens(request)
+        queued = time.monotonic()
+        try:
+            # Time queued for the limiter counts against the request's deadline
+            limiter.acquire(estimated_tokens, LLMRateLimit.current_priority.get(), timeout=request.get('timeout'))
+        except LLMRateLimit.LimiterTimeout as e:
+            breaker.cancel(probe)
+            raise LLMHedge.DeadlineExceeded(f"{self.provider}/{request.get('model')} queued for the rate limiter past its deadline") from e
+        except BaseException:
+            breaker.cancel(probe)
+            raise
+        if request.get('timeout') is not None:
+            request = dict(request, timeout=max(0.1, request['timeout'] - (time.monotonic() - queued)))
+        key_state = self.key_pool.acquire()
+        reported = False
+        used_tokens = None
+        start = time.monotonic()
+        try:
+            response = _send(self.clients[key_state.key], endpoint, request)
+        except Exception as e:
+            reported = True
+            breaker.after_call(probe, _provider_failure(e), time.monotonic() - start)
+            _report(self.key_pool, key_state, limiter, e)
+            raise
+        else:
+            reported = True
+            breaker.after_call(probe, False, time.monotonic() - start)
+            _report(self.key_pool, key_state, limiter)
+            used_tokens = getattr(getattr(response, 'usage', None), 'total_tokens', None)
+            if endpoint == 'chat':
+                LLMPrompt.record_usage(f"{self.provider}/{request.get('model')}", getattr(response, 'usage', None))
+            return response
+        finally:
+            if not reported:
+                # Cancelled, e.g. the losing request of a hedge: neither a success nor
+                # a failure of the provider or the key, but the probe slot must be freed
+                breaker.cancel(probe)
+                self.key_pool.cancel(key_state)
+            limiter.release(estimated_tokens, used_tokens)
+
+    def _call_with_retries(self, endpoint, request, remaining):
+        # Transient errors are retried as long as the deadline leaves time for it
+        deadline = time.monotonic() + remaining
+        return LLMRetry.retry_call(
+            lambda: self._call(endpoint, dict(request, timeout=max(0.1, deadline - time.monotonic()))),
+            name=f"{self.provider}/{request.get('model')}", retry_on=TRANSIENT_ERRORS, deadline=deadline,
+        )
+
+    def create_chat_completion(self, deadline=None, **request):
+        primary = lambda remaining: self._call_with_retries('chat', request, remaining)
+        fallback_model = self.fallback_models.get(request.get('model'))
+        if self.fallback is None or fallback_model is None:
+            return LLMHedge.hedged_call(f"{self.provider}/{request.get('model')}", primary, deadline_seconds=deadline)
+        alternate = lambda remaining: self.fallback._call_with_retries('chat', dict(request, model=fallback_model), remaining)
+        return LLMHedge.hedged_call(f"{self.provider}/{request.get('model')}", primary,
+                                    f"{self.fallback.provider}/{fallback_model}", alternate, deadline)
+
+    def create_embeddings(self, deadline=None, **request):
+        primary = lambda remaining: self._call_with_retries('embeddings', request, remaining)
+        return LLMHedge.hedged_call(f"{self.provider}/{request.get('model')}", primary, deadline_seconds=deadline)
+
+
+class AsyncLLMClient:
+    """
+    Async counterpart of LLMClient. Waiting for the rate limiter is an asyncio
+    wait, so the event loop keeps running and cancelled calls never hold a slot.
+    """
+
+    def __init__(self, api_keys, base_url=None):
+        self.provider = provider_name(base_url)
+        self.base_url = base_url
+        keys = [api_keys] if isinstance(api_keys, str) else list(api_keys)
+        self.key_pool = LLMKeyPool.get_pool(self.provider, keys)
+        self.keys = keys
+        self.clients = weakref.WeakKeyDictionary()  # event loop -> {key: AsyncOpenAI}
+        self.fallback = None
+        self.fallback_models = {}
+        self.chat = _Endpoint(None)
+        self.chat.completions = _Endpoint(self.create_chat_completion)
+        self.embeddings = _Endpoint(self.create_embeddings)
+
+    def set_fallback(self, fallback, fallback_models):
+        self.fallback = fallback
+        self.fallback_models = fallback_models
+
+    def _client(self, key):
+        # The OpenAI clients of the running loop, on top of its pool
+        loop = asyncio.get_running_loop()
+        with async_http_clients_lock:
+            clients = self.clients.get(loop)
+        if clients is None:
+            http = get_async_http_client()
+            clients = {client_key: AsyncOpenAI(base_url=self.base_url, api_key=client_key, http_client=http, max_retries=0) for client_key in self.keys}
+            with async_http_clients_lock:
+                clients = self.clients.setdefault(loop, clients)
+        return clients[key]
+
+    async def _call(self, endpoint, request):
+        # Fails fast while the provider's circuit is open
+        request = _for_provider(self.provider, request)
+        breaker = LLMBreaker.get_breaker(self.provider, request.get('model'))
+        probe = breaker.before_call()
+        limiter = LLMRateLimit.get_limiter(self.provider, request.get('model'), len(self.key_pool))
+        estimated_tokens = LLMRateLimit.estimate_tokens(request)
+        queued = time.monotonic()
+        try:
+            # Time queued for the limiter counts against the request's deadline
+            await limiter.async_acquire(estimated_tokens, LLMRateLimit.current_priority.get(), timeout=request.get('timeout'))
+        except LLMRateLimit.LimiterTimeout as e:
+            breaker.cancel(probe)
+            raise LLMHedge.DeadlineExceeded(f"{self.provider}/{request.get('model')} queued for the rate limiter past its deadline") from e
+        except BaseException:
+            breaker.cancel(probe)
+            raise
+        if request.get('timeout') is not None:
+            request = dict(request, timeout=max(0.1, request['timeout'] - (time.monotonic() - queued)))
+        key_state = self.key_pool.acquire()
+        reported = False
+        used_tokens = None
+        start = time.monotonic()
+        try:
+            response = await _send(self._client(key_state.key), endpoint, request)
+        except Exception as e:
+            reported = True
+            breaker.after_call(probe, _provider_failure(e), time.monotonic() - start)
+            _report(self.key_pool, key_state, limiter, e)
+            raise
+        else:
+            reported = True
+            breaker.after_call(probe, False, time.monotonic() - start)
+            _report(self.key_pool, key_state, limiter)
+            used_tokens = getattr(getattr(response, 'usage', None), 'total_tokens', None)
+            if endpoint == 'chat':
+                LLMPrompt.record_usage(f"{self.provider}/{request.get('model')}", getattr(response, 'usage', None))
+            return response
+        finally:
+            if not reported:
+                # Cancelled, e.g. the losing request of a hedge: neither a success nor
+                # a failure of the provider or the key, but the probe slot must be freed
+                breaker.cancel(probe)
+                self.key_pool.cancel(key_state)
+            limiter.release(estimated_tokens, used_tokens)
+
+    async def _call_with_retries(self, endpoint, request, remaining):
+        deadline = time.monotonic() + remaining
+        return await LLMRetry.async_retry_call(
+            lambda: self._call(endpoint, dict(request, timeout=max(0.1, deadline - time.monotonic()))),
+            name=f"{self.provider}/{request.get('model')}", retry_on=TRANSIENT_ERRORS, deadline=deadline,
+        )
+
+    async def create_chat_completion(self, deadline=None, **request):
+        primary = lambda remaining: self._call_with_retries('chat', request, remaining)
+        fallback_model = self.fallback_models.get(request.get('model'))
+        if self.fallback is None or fallback_model is None:
+            return await LLMHedge.async_hedged_call(f"{self.provider}/{request.get('model')}", primary, deadline_seconds=deadline)
+        alternate = lambda remaining: self.fallback._call_with_retries('chat', dict(request, model=fallback_model), remaining)
+        return await LLMHedge.async_hedged_call(f"{self.provider}/{request.get('model')}", primary,
+                                                f"{self.fallback.provider}/{fallback_model}", alternate, deadline)
+
+    async def create_embeddings(self, deadline=None, **request):
+        primary = lambda remaining: self._call_with_retries('embeddings', request, remaining)
+        return await LLMHedge.async_hedged_call(f"{self.provider}/{request.get('model')}", primary, deadline_seconds=deadline)
+
+
+def make_client(api_keys, base_url=None):
+    """
+    Returns a client with the OpenAI call shape, using the shared connection pool,
+    the rate limiter and the API key pool of the provider.
+    """
+    return LLMClient(api_keys, base_url)
+
+def make_async_client(api_keys, base_url=None):
+    """
+    Returns an async client with the AsyncOpenAI call shape, using the shared
+    connection pool, the rate limiter and the API key pool of the provider.
+    """
+    return AsyncLLMClient(api_keys, base_url)
+
+def configure_fallback(client, keys_by_provider, model_small, model_large):
+    """
+    Gives client the fallback provider of the [Hedge] section, if one is configured
+    and has keys. Its small and large models stand in for model_small and model_large.
+    keys_by_provider: provider name -> list of keys, e.g. {'openai': openai_keys, ...}
+    """
+    provider = LLMHedge.FALLBACK_PROVIDER
+    if not provider or provider == client.provider:
+        return
+    if provider not in PROVIDER_BASE_URLS or not keys_by_provider.get(provider):
+        print(f"Method: configure_fallback | No keys for fallback provider '{provider}', hedging disabled")
+        return
+    default_small, default_large = PROVIDER_MODELS[provider]
+    make = make_async_client if isinstance(client, AsyncLLMClient) else make_client
+    fallback = make(keys_by_provider[provider], PROVIDER_BASE_URLS[provider])
+    fallback_models = {
+        model_small: LLMHedge.FALLBACK_MODEL_SMALL or default_small,
+        model_large: LLMHedge.FALLBACK_MODEL_LARGE or default_large,
+    }
+    client.set_fallback(fallback, fallback_models)
+    print(f"Method: configure_fallback | {client.provider} calls hedged to {provider}: {fallback_models}")
@@ -0,0 +1,126 @@
+import queue
+import threading
+import time
+import configparser
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from openai import BadRequestError, UnprocessableEntityError
+
+# Micro-batching for the embeddings endpoint.
+# Worker threads call embed() as before, one text at a time; a background thread
+# gathers the texts arriving within a short window and sends them as one request
+# with a list input, then hands each caller its own embedding.
+# When the provider rejects a batch for its input (400, 422: e.g. a text over the
+# context length), it is split in halves and each half sent again, so the bad text
+# only fails its own callers. Any other error (rate limit, timeout, open circuit)
+# fails the whole batch at once rather than multiplying requests.
+# Settings come from the optional [EmbeddingBatch] section of config.ini:
+#   max_batch = 64        texts per request
+#   max_wait_ms = 10      how long the first text of a batch waits for others
+
+config = configparser.ConfigParser()
+# Adjust the path to locate config.ini one level above this file's directory
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.ini')
+config.read(config_path)
+
+MAX_BATCH = config.getint('EmbeddingBatch', 'max_batch', fallback=64)
+MAX_WAIT_MS = config.getint('EmbeddingBatch', 'max_wait_ms', fallback=10)
+
+# Errors caused by the texts of the request, worth sending the texts in smaller requests
+INPUT_ERRORS = (BadRequestError, UnprocessableEntityError)
+
+
+class EmbeddingBatcher:
+    """
+    create_batch(texts, model) must return the embeddings of texts, in the same order.
+    Identical texts in one window are sent once. A request rejected for its input is
+    split in halves down to single texts, and only the texts failing on their own get
+    the exception.
+    """
+
+    def __init__(self, create_batch, max_batch=MAX_BATCH, max_wait=MAX_WAIT_MS / 1000.0, max_requests=4):
+        self.create_batch = create_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.senders = ThreadPoolExecutor(max_workers=max_requests)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.texts_count = 0
+        self.requests_count = 0
+
+    def _ensure_thread(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._collect, name="EmbeddingBatcher", daemon=True)
+                self.thread.start()
+
+    def submit(self, text, model):
+        """
+        Queues one text and returns a Future resolving to its embedding.
+        """
+        future = Future()
+        self._ensure_thread()
+        self.pending.put((text, model, future))
+        return future
+
+    def embed(self, text, model):
+        return self.submit(text, model).result()
+
+    def embed_many(self, texts, model):
+        futures = [self.submit(text, model) for text in texts]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.senders.submit(self._send, batch)
+
+    def _embed_texts(self, texts, model):
+        """
+        Returns (embedding or exception per text, number of requests sent).
+        """
+        try:
+            embeddings = self.create_batch(texts, model)
+            if len(embeddings) != len(texts):
+                raise ValueError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+            return list(embeddings), 1
+        except Exception as e:
+            if len(texts) == 1 or not isinstance(e, INPUT_ERRORS):
+                return [e] * len(texts), 1
+            print(f"Method: EmbeddingBatcher | Request of {len(texts)} texts failed, sending it in two halves: {e}")
+        middle = len(texts) // 2
+        first, first_requests = self._embed_texts(texts[:middle], model)
+        second, second_requests = self._embed_texts(texts[middle:], model)
+        return first + second, 1 + first_requests + second_requests
+
+    def _send(self, batch):
+        by_model = {}
+        for text, model, future in batch:
+            by_model.setdefault(model, {}).setdefault(text, []).append(future)
+
+        for model, futures_by_text in by_model.items():
+            texts = list(futures_by_text)
+            results, requests = self._embed_texts(texts, model)
+            for text, result in zip(texts, results):
+                for future in futures_by_text[text]:
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+            callers = sum(len(futures) for futures in futures_by_text.values())
+            with self.lock:
+                self.texts_count += callers
+                self.requests_count += requests
+            print(f"Method: EmbeddingBatcher | Sent {len(texts)} texts for {callers} callers in {requests} request(s) | Total: {self.texts_count} texts in {self.requests_count} requests")
@@ -0,0 +1,230 @@
+import asyncio
+import threading
+import time
+import configparser
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+# Deadline-bounded and hedged LLM calls.
+# Every chat call gets a deadline, passed down as the HTTP timeout so a stalled
+# provider can't hold a worker thread past it. If the call has not answered
+# when the provider's usual latency (a percentile of the recent calls) has
+# passed, or if it fails, the same request is sent to the fallback provider and
+# model. The first answer wins; the other call is cancelled (async) or left to
+# end at its own deadline (threads).
+# Settings come from the optional [Hedge] section of config.ini:
+#   deadline = 45             seconds per call, under the 76 s worker timeout
+#   hedge_percentile = 95     latency percentile after which the hedge is sent
+#   hedge_after = 10          seconds, used until enough latencies are known
+#   talk_deadline = 20        seconds per call of a talk turn, which viewers wait for
+#   fallback_provider =       openai, google or deepseek; empty disables hedging
+#   fallback_model_small =    defaults to the provider's usual small model
+#   fallback_model_large =    defaults to the provider's usual large model
+
+config = configparser.ConfigParser()
+# Adjust the path to locate config.ini one level above this file's directory
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.ini')
+config.read(config_path)
+
+DEFAULT_DEADLINE = config.getfloat('Hedge', 'deadline', fallback=45)
+HEDGE_PERCENTILE = config.getfloat('Hedge', 'hedge_percentile', fallback=95)
+HEDGE_AFTER = config.getfloat('Hedge', 'hedge_after', fallback=10)
+TALK_DEADLINE = config.getfloat('Hedge', 'talk_deadline', fallback=20)
+FALLBACK_PROVIDER = config.get('Hedge', 'fallback_provider', fallback='').strip().lower()
+FALLBACK_MODEL_SMALL = config.get('Hedge', 'fallback_model_small', fallback='').strip()
+FALLBACK_MODEL_LARGE = config.get('Hedge', 'fallback_model_large', fallback='').strip()
+MIN_SAMPLES = 20
+WINDOW = 200
+
+# Deadline of the calls made in the current context, None for DEFAULT_DEADLINE
+current_deadline = ContextVar('llm_deadline', default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Runs the LLM calls made inside the block with a tighter (or looser) deadline.
+    """
+    token = current_deadline.set(seconds)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+############################################
+# Latency Tracking
+############################################
+
+latencies = {}
+latencies_lock = threading.Lock()
+hedge_counters = {'calls': 0, 'hedged': 0, 'fallback_wins': 0, 'deadline_exceeded': 0}
+
+def _count(name):
+    with latencies_lock:
+        hedge_counters[name] += 1
+
+def record_latency(name, seconds):
+    with latencies_lock:
+        latencies.setdefault(name, deque(maxlen=WINDOW)).append(seconds)
+
+def hedge_delay(name):
+    """
+    Seconds to wait for `name` (a provider/model) before hedging: the configured
+    percentile of its recent latencies, or HEDGE_AFTER while there are too few.
+    """
+    with latencies_lock:
+        samples = sorted(latencies.get(name, ()))
+    if len(samples) < MIN_SAMPLES:
+        return HEDGE_AFTER
+    index = min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100.0))
+    return samples[index]
+
+def hedge_stats():
+    with latencies_lock:
+        stats = dict(hedge_counters)
+        stats['p50'] = {}
+        for name, samples in latencies.items():
+            ordered = sorted(samples)
+            stats['p50'][name] = ordered[len(ordered) // 2]
+    return stats
+
+def print_hedge_stats():
+    stats = hedge_stats()
+    latency_text = ", ".join(f"{name} p50 {p50:.2f}s" for name, p50 in stats['p50'].items())
+    print(f"Method: LLMHedge.hedge_stats | Hedged calls: {stats['calls']}, hedges sent: {stats['hedged']}, "
+          f"won by the fallback: {stats['fallback_wins']}, deadline exceeded: {stats['deadline_exceeded']} | {latency_text}")
+
+def _timed(name, call, remaining):
+    start = time.monotonic()
+    result = call(remaining)
+    record_latency(name, time.monotonic() - start)
+    return result
+
+
+############################################
+# Hedged Calls
+############################################
+
+executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="LLMHedge")
+
+def hedged_call(primary_name, primary, alternate_name=None, alternate=None, deadline_seconds=None):
+    """
+    primary(remaining_seconds) / alternate(remaining_seconds): send the request with
+    that timeout and return the response. Without an alternate, this is only a
+    deadline-bounded call.
+    """
+    deadline_seconds = deadline_seconds or current_deadline.get() or DEFAULT_DEADLINE
+    start = time.monotonic()
+    if alternate is None:
+        return _timed(primary_name, primary, deadline_seconds)
+
+    _count('calls')
+    futures = {executor.submit(copy_context().run, _timed, primary_name, primary, deadline_seconds): primary_name}
+    hedged = False
+    last_error = None
+    delay = hedge_delay(primary_name)
+
+    while futures:
+        remaining = deadline_seconds - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        timeout = remaining if hedged else min(remaining, max(0.0, delay - (time.monotonic() - start)))
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            name = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Method: hedged_call | {name} failed: {e}")
+                last_error = e
+                continue
+            if name == alternate_name:
+                _count('fallback_wins')
+            if hedged:
+                print(f"Method: hedged_call | {name} answered first after {time.monotonic() - start:.2f}s")
+            return result
+
+        if not hedged and (not futures or time.monotonic() - start >= delay):
+            # The primary is slower than usual, or failed: race the fallback against it
+            hedged = True
+            _count('hedged')
+            remaining = deadline_seconds - (time.monotonic() - start)
+            print(f"Method: hedged_call | No answer from {primary_name} after {time.monotonic() - start:.2f}s, sending to {alternate_name}")
+            futures[executor.submit(copy_context().run, _timed, alternate_name, alternate, remaining)] = alternate_name
+
+    if last_error is not None and not futures:
+        raise last_error
+    _count('deadline_exceeded')
+    raise DeadlineExceeded(f"No answer from {primary_name} or {alternate_name} within {deadline_seconds:.1f}s")
+
+
+async def _async_timed(name, call, remaining):
+    start = time.monotonic()
+    result = await call(remaining)
+    record_latency(name, time.monotonic() - start)
+    return result
+
+async def async_hedged_call(primary_name, primary, alternate_name=None, alternate=None, deadline_seconds=None):
+    """
+    Async counterpart of hedged_call; primary and alternate are coroutine functions.
+    The losing request is cancelled.
+    """
+    deadline_seconds = deadline_seconds or current_deadline.get() or DEFAULT_DEADLINE
+    start = time.monotonic()
+    if alternate is None:
+        try:
+            return await asyncio.wait_for(_async_timed(primary_name, primary, deadline_seconds), deadline_seconds)
+        except asyncio.TimeoutError:
+            _count('deadline_exceeded')
+            raise DeadlineExceeded(f"No answer from {primary_name} within {deadline_seconds:.1f}s")
+
+    _count('calls')
+    tasks = {asyncio.ensure_future(_async_timed(primary_name, primary, deadline_seconds)): primary_name}
+    hedged = False
+    last_error = None
+    delay = hedge_delay(primary_name)
+    try:
+        while tasks:
+            remaining = deadline_seconds - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+            timeout = remaining if hedged else min(remaining, max(0.0, delay - (time.monotonic() - start)))
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                name = tasks.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    print(f"Method: async_hedged_call | {name} failed: {e}")
+                    last_error = e
+                    continue
+                if name == alternate_name:
+                    _count('fallback_wins')
+                if hedged:
+                    print(f"Method: async_hedged_call | {name} answered first after {time.monotonic() - start:.2f}s")
+                return result
+
+            if not hedged and (not tasks or time.monotonic() - start >= delay):
+                hedged = True
+                _count('hedged')
+                remaining = deadline_seconds - (time.monotonic() - start)
+                print(f"Method: async_hedged_call | No answer from {primary_name} after {time.monotonic() - start:.2f}s, sending to {alternate_name}")
+                tasks[asyncio.ensure_future(_async_timed(alternate_name, alternate, remaining))] = alternate_name
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if last_error is not None and not tasks:
+        raise last_error
+    _count('deadline_exceeded')
+    raise DeadlineExceeded(f"No answer from {primary_name} or {alternate_name} within {deadline_seconds:.1f}s")
@@ -0,0 +1,149 @@
+import itertools
+import threading
+import time
+
+# API key pools.
+# A provider can be configured with several keys in the [OpenAI] section of
+# config.ini, either numbered or as one comma separated list:
+#   deepseek_key = sk-aaa
+#   deepseek_key2 = sk-bbb
+#   deepseek_keys = sk-ccc, sk-ddd
+# Each call takes the least loaded healthy key (round robin between equally
+# loaded ones). A key answering 429 is evicted for its Retry-After, or for a
+# growing cooldown, and a key failing repeatedly is evicted for a short while.
+
+RATE_LIMIT_COOLDOWN = 5.0
+MAX_COOLDOWN = 300.0
+AUTH_ERROR_COOLDOWN = 600.0
+ERRORS_BEFORE_EVICTION = 3
+ERROR_COOLDOWN = 30.0
+
+
+def keys_from_config(section, name):
+    """
+    Returns the distinct non-empty keys configured as name, name2, name3, ... and names.
+    section: a configparser section, e.g. config['OpenAI']
+    """
+    keys = []
+    for option in [name] + [f"{name}{i}" for i in range(2, 10)]:
+        if section.get(option):
+            keys.append(section.get(option).strip())
+    for key in section.get(f"{name}s", fallback='').split(','):
+        if key.strip():
+            keys.append(key.strip())
+    return list(dict.fromkeys(keys))
+
+
+class KeyState:
+
+    def __init__(self, key):
+        self.key = key
+        self.in_flight = 0
+        self.evicted_until = 0.0
+        self.rate_limited_count = 0
+        self.consecutive_errors = 0
+        self.requests = 0
+        self.errors = 0
+
+    def label(self):
+        # Never print the full key
+        return f"...{self.key[-4:]}" if len(self.key) > 4 else "..."
+
+
+class KeyPool:
+
+    def __init__(self, provider, keys, strategy='least_loaded'):
+        if not keys:
+            raise ValueError(f"No API key configured for provider '{provider}'")
+        self.provider = provider
+        self.states = [KeyState(key) for key in keys]
+        self.strategy = strategy
+        self.rotation = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.states)
+
+    def acquire(self):
+        """
+        Picks a key for one request and counts it as in flight. If every key is
+        evicted, the one coming back first is used rather than failing.
+        """
+        with self.lock:
+            now = time.monotonic()
+            healthy = [state for state in self.states if state.evicted_until <= now]
+            if not healthy:
+                healthy = [min(self.states, key=lambda state: state.evicted_until)]
+
+            turn = next(self.rotation)
+            if self.strategy == 'round_robin':
+                state = healthy[turn % len(healthy)]
+            else:
+                least = min(state.in_flight for state in healthy)
+                candidates = [state for state in healthy if state.in_flight == least]
+                state = candidates[turn % len(candidates)]
+            state.in_flight += 1
+            state.requests += 1
+            return state
+
+    def release(self, state, error=None, rate_limited=False, auth_error=False, retry_after=None):
+        """
+        Reports the outcome of a request made with the key of state.
+        Returns the seconds until a healthy key is available again (0 if one is).
+        """
+        with self.lock:
+            state.in_flight -= 1
+            now = time.monotonic()
+            if error is None:
+                state.consecutive_errors = 0
+                state.rate_limited_count = 0
+            else:
+                state.errors += 1
+                state.consecutive_errors += 1
+                cooldown = 0.0
+                if auth_error:
+                    cooldown = AUTH_ERROR_COOLDOWN
+                elif rate_limited:
+                    state.rate_limited_count += 1
+                    cooldown = retry_after or min(MAX_COOLDOWN, RATE_LIMIT_COOLDOWN * 2 ** (state.rate_limited_count - 1))
+                elif state.consecutive_errors >= ERRORS_BEFORE_EVICTION:
+                    cooldown = ERROR_COOLDOWN
+                if cooldown:
+                    state.evicted_until = max(state.evicted_until, now + cooldown)
+                    print(f"Method: KeyPool | {self.provider} key {state.label()} evicted for {cooldown:.0f}s after: {error}")
+
+            return max(0.0, min(state.evicted_until for state in self.states) - now)
+
+    def cancel(self, state):
+        # The request was cancelled before its outcome was known (e.g. the losing side of a hedge)
+        with self.lock:
+            state.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            return [
+                {
+                    'key': state.label(),
+                    'requests': state.requests,
+                    'errors': state.errors,
+                    'in_flight': state.in_flight,
+                    'evicted_for': max(0.0, state.evicted_until - now),
+                }
+                for state in self.states
+            ]
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(provider, keys):
+    """
+    Returns the pool shared by every client of the process using these keys at this provider.
+    """
+    with pools_lock:
+        pool = pools.get((provider, tuple(keys)))
+        if pool is None:
+            pool = KeyPool(provider, keys)
+            pools[(provider, tuple(keys))] = pool
+        return pool
@@ -0,0 +1,263 @@
+import threading
+import configparser
+import os
+from functools import lru_cache
+
+# Token budgets for the prompts.
+# Each kind of call (decision, talk, schedule, reflection, ...) gets a token
+# budget per prompt section. A section over its budget is cut down: ranked
+# memories (RankedText) lose their lowest-scoring lines first, after the longest
+# of those lines were shortened; other sections keep their first lines. Token
+# counts use tiktoken when it is installed, and 4 characters per token otherwise.
+# The cached prompt tokens reported by the providers (prompt prefix caching) are
+# counted here as well, per provider and model.
+# Budgets come from the optional [PromptBudget] section of config.ini, as
+# <call type>.<section> = tokens, 0 meaning unlimited, e.g.:
+#   decision.memories = 1200
+#   talk.npc_descriptions = 400
+#   max_line_tokens = 120     ranked lines longer than this are shortened first
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+config = configparser.ConfigParser()
+# Adjust the path to locate config.ini one level above this file's directory
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.ini')
+config.read(config_path)
+
+DEFAULT_BUDGETS = {
+    'decision': {'memories': 1200, 'reflections': 400, 'schedule': 600, 'npc_descriptions': 500},
+    'talk': {'memories': 800, 'reflections': 300, 'schedule': 600, 'npc_descriptions': 400},
+    'schedule': {'memories': 800, 'reflections': 400, 'schedule': 0},
+    'reflection': {'memories': 2000, 'reflections': 600},
+    'generation': {'memories': 800, 'reflections': 400},
+    'condense': {'memories': 2000, 'reflections': 600, 'schedule': 600, 'condensed': 600},
+}
+MAX_LINE_TOKENS = config.getint('PromptBudget', 'max_line_tokens', fallback=120)
+ELLIPSIS = "..."
+
+
+class RankedText(str):
+    """
+    Text made of lines with a relevance score each, e.g. retrieved memories.
+    It is a plain str for every other use; budgets cut its lowest-scoring lines
+    first and keep the remaining ones in their order.
+    """
+
+    def __new__(cls, lines, scores):
+        text = super().__new__(cls, "\n".join(lines))
+        text.lines = list(lines)
+        text.scores = list(scores)
+        return text
+
+
+############################################
+# Token Counting
+############################################
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Models of other providers: an OpenAI encoding is close enough for budgeting
+        return tiktoken.get_encoding("o200k_base")
+
+def count_tokens(text, model=None):
+    if not text:
+        return 0
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    return len(_encoding(model or "gpt-4o").encode(text, disallowed_special=()))
+
+def truncate_tokens(text, max_tokens, model=None):
+    """
+    First max_tokens tokens of text, with an ellipsis when something was cut.
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    if tiktoken is None:
+        return text[:max_tokens * 4].rstrip() + ELLIPSIS
+    encoding = _encoding(model or "gpt-4o")
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]).rstrip() + ELLIPSIS
+
+
+############################################
+# Fitting Sections
+############################################
+
+def fit_ranked(text, budget, model=None):
+    """
+    Shortens then drops the lowest-scoring lines of a RankedText until it fits in budget tokens.
+    """
+    lines = list(text.lines)
+    counts = [count_tokens(line, model) for line in lines]
+    by_score = sorted(range(len(lines)), key=lambda i: text.scores[i])
+
+    # Compress: shorten the over-long lines, lowest scores first
+    for i in by_score:
+        if sum(counts) <= budget:
+            break
+        if counts[i] > MAX_LINE_TOKENS:
+            lines[i] = truncate_tokens(lines[i], MAX_LINE_TOKENS, model)
+            counts[i] = count_tokens(lines[i], model)
+
+    # Drop: remove whole lines, lowest scores first, keeping at least the best one
+    kept = set(range(len(lines)))
+    for i in by_score[:-1]:
+        if sum(counts[j] for j in kept) <= budget:
+            break
+        kept.discard(i)
+
+    kept = sorted(kept)
+    return RankedText([lines[i] for i in kept], [text.scores[i] for i in kept])
+
+def fit_text(text, budget, model=None):
+    """
+    Keeps the first lines of text that fit in budget tokens (part of a line if none fits).
+    """
+    lines = text.split("\n")
+    kept = []
+    used = 0
+    for line in lines:
+        tokens = count_tokens(line + "\n", model)
+        if used + tokens > budget:
+            break
+        kept.append(line)
+        used += tokens
+    if not kept:
+        return truncate_tokens(text, budget, model)
+    if len(kept) < len(lines):
+        kept.append(ELLIPSIS)
+    return "\n".join(kept)
+
+
+stats_lock = threading.Lock()
+budget_counters = {}
+static_fits = {}  # (call type, model, section, text) -> (fitted text, (tokens kept, tokens given))
+
+class PromptBudget:
+    """
+    Fits the sections of one prompt in the budgets of its call type, and reports
+    the tokens used by each:
+        budget = LLMPrompt.PromptBudget('decision', model_large)
+        memories_str, reflections_str = budget.fit_all(memories=memories_str, reflections=reflections_str)
+        ...
+        budget.report(prompt)
+    """
+
+    def __init__(self, call_type, model=None):
+        self.call_type = call_type
+        self.model = model
+        self.sections = {}  # name -> (tokens kept, tokens given)
+
+    def budget(self, section):
+        option = f"{self.call_type}.{section}"
+        if config.has_option('PromptBudget', option):
+            return config.getint('PromptBudget', option)
+        return DEFAULT_BUDGETS.get(self.call_type, {}).get(section, 0)
+
+    def fit(self, section, text):
+        text = text if text is not None else ""
+        given = count_tokens(text, self.model)
+        budget = self.budget(section)
+        if budget and given > budget:
+            if isinstance(text, RankedText):
+                text = fit_ranked(text, budget, self.model)
+            else:
+                text = fit_text(str(text), budget, self.model)
+        self.sections[section] = (count_tokens(text, self.model), given)
+        return text
+
+    def fit_static(self, section, text):
+        """
+        fit() for a section that is the same on every call, e.g. the characters of the town,
+        computed once so that it stays part of a cacheable prompt prefix.
+        """
+        key = (self.call_type, self.model, section, text)
+        with stats_lock:
+            fitted = static_fits.get(key)
+        if fitted is None:
+            fitted = (self.fit(section, text), self.sections[section])
+            with stats_lock:
+                static_fits[key] = fitted
+        text, self.sections[section] = fitted
+        return text
+
+    def fit_all(self, **sections):
+        """
+        Fits every section given as name=text, and returns the texts in the same order.
+        """
+        return tuple(self.fit(section, text) for section, text in sections.items())
+
+    def report(self, prompt=None):
+        total = count_tokens(prompt, self.model) if prompt is not None else None
+        saved = sum(given - kept for kept, given in self.sections.values())
+        with stats_lock:
+            counts = budget_counters.setdefault(self.call_type, {'prompts': 0, 'prompt_tokens': 0, 'saved_tokens': 0})
+            counts['prompts'] += 1
+            counts['prompt_tokens'] += total or 0
+            counts['saved_tokens'] += saved
+        sections = ", ".join(f"{name} {kept}/{given}" for name, (kept, given) in self.sections.items())
+        total_text = f" | prompt {total} tokens" if total is not None else ""
+        print(f"Method: PromptBudget | {self.call_type} | {sections}{total_text}")
+
+
+def budget_stats():
+    with stats_lock:
+        return {call_type: dict(counts) for call_type, counts in budget_counters.items()}
+
+def print_budget_stats():
+    for call_type, stats in budget_stats().items():
+        average = stats['prompt_tokens'] / stats['prompts'] if stats['prompts'] else 0
+        print(f"Method: LLMPrompt.budget_stats | {call_type} | Prompts: {stats['prompts']}, average prompt: {average:.0f} tokens, "
+              f"tokens cut: {stats['saved_tokens']}")
+
+
+############################################
+# Prompt Cache Hits
+############################################
+
+cache_counters = {}
+
+def cached_prompt_tokens(usage):
+    """
+    Prompt tokens served from the provider's prompt cache, as reported in the usage of a completion:
+    prompt_tokens_details.cached_tokens (OpenAI, Gemini) or prompt_cache_hit_tokens (DeepSeek).
+    """
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+    return cached or 0
+
+def record_usage(name, usage):
+    """
+    Counts the prompt tokens of a chat completion and how many of them were cache hits.
+    name: "<provider>/<model>"
+    """
+    prompt_tokens = getattr(usage, 'prompt_tokens', None)
+    if usage is None or prompt_tokens is None:
+        return
+    cached = cached_prompt_tokens(usage)
+    with stats_lock:
+        counts = cache_counters.setdefault(name, {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0})
+        counts['calls'] += 1
+        counts['prompt_tokens'] += prompt_tokens
+        counts['cached_tokens'] += cached
+    hit_rate = cached / prompt_tokens if prompt_tokens else 0.0
+    print(f"Method: LLMPrompt.record_usage | {name} | Prompt: {prompt_tokens} tokens, cached: {cached} ({hit_rate:.0%})")
+
+def cache_stats():
+    with stats_lock:
+        return {name: dict(counts) for name, counts in cache_counters.items()}
+
+def print_cache_stats():
+    for name, stats in cache_stats().items():
+        hit_rate = stats['cached_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0.0
+        print(f"Method: LLMPrompt.cache_stats | {name} | Calls: {stats['calls']}, prompt tokens: {stats['prompt_tokens']}, "
+              f"cached: {stats['cached_tokens']} ({hit_rate:.0%})")
@@ -0,0 +1,268 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+import configparser
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Provider-wide rate limiting for every LLM and embedding call of the process.
+# Each (provider, model) pair gets a limiter with a request bucket (RPM), a token
+# bucket (TPM) and a cap on requests in flight. Callers queue in priority order,
+# so a flood of background work (importance, reflections, schedules) cannot delay
+# what viewers see (talk turns), and the quota is used up without tripping 429s.
+#
+# Limits come from the optional [RateLimit] section of config.ini, per provider
+# or per provider and model, 0 meaning unlimited. They are per API key, and are
+# multiplied by the number of keys in the provider's key pool, e.g.:
+#   openai.rpm = 500
+#   openai.tpm = 200000
+#   openai.gpt-4o.tpm = 30000
+#   deepseek.max_concurrency = 32
+
+config = configparser.ConfigParser()
+# Adjust the path to locate config.ini one level above this file's directory
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.ini')
+config.read(config_path)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+DEFAULT_LIMITS = {
+    'openai': {'rpm': 500, 'tpm': 200000, 'max_concurrency': 32},
+    'google': {'rpm': 1000, 'tpm': 1000000, 'max_concurrency': 32},
+    'deepseek': {'rpm': 0, 'tpm': 0, 'max_concurrency': 32},
+}
+FALLBACK_LIMITS = {'rpm': 0, 'tpm': 0, 'max_concurrency': 32}
+# Interval at which coroutines waiting for a slot look again
+ASYNC_POLL_SECONDS = 0.02
+
+# Priority of the calls made in the current context (thread, task graph step or asyncio task)
+current_priority = ContextVar('llm_priority', default=PRIORITY_NORMAL)
+
+
+@contextmanager
+def priority(level):
+    """
+    Runs the LLM calls made inside the block with the given priority:
+        with LLMRateLimit.priority(LLMRateLimit.PRIORITY_HIGH):
+            BhrLgcGPTProcess.talkTurn(...)
+    """
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+def estimate_tokens(request):
+    """
+    Rough token count of a chat or embedding request: prompt characters / 4 plus the completion allowance.
+    """
+    if 'messages' in request:
+        prompt_chars = sum(len(str(message.get('content', ''))) for message in request['messages'])
+        return prompt_chars // 4 + int(request.get('max_tokens') or 500)
+    inputs = request.get('input', '')
+    if isinstance(inputs, list):
+        return sum(len(str(text)) for text in inputs) // 4 + 1
+    return len(str(inputs)) // 4 + 1
+
+
+class TokenBucket:
+    """
+    Refills per_minute units per minute, up to one minute of burst. Usage reported
+    after the fact may push it below zero, which then delays the next callers.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # Requests larger than the bucket only wait for a full bucket
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+
+class LimiterTimeout(Exception):
+    pass
+
+
+class ProviderLimiter:
+
+    def __init__(self, name, rpm=0, tpm=0, max_concurrency=32):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.max_concurrency = max_concurrency if max_concurrency > 0 else float('inf')
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.total_requests = 0
+        self.total_wait = 0.0
+
+    def _wait_time(self, tokens, now):
+        wait = max(0.0, self.paused_until - now)
+        if self.requests is not None:
+            self.requests.refill(now)
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None:
+            self.tokens.refill(now)
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def _admissible(self, entry, tokens, now):
+        # Called with the condition held: (whether entry can be admitted now, seconds to wait otherwise)
+        wait = self._wait_time(tokens, now)
+        return self.waiters[0] == entry and wait == 0 and self.in_flight < self.max_concurrency, wait
+
+    def _admit(self, tokens, start):
+        # Called with the condition held: gives the slot to the first waiter
+        heapq.heappop(self.waiters)
+        if self.requests is not None:
+            self.requests.level -= 1
+        if self.tokens is not None:
+            self.tokens.level -= tokens
+        self.in_flight += 1
+        self.total_requests += 1
+        waited = time.monotonic() - start
+        self.total_wait += waited
+        return waited
+
+    def _withdraw(self, entry):
+        # Called with the condition held
+        self.waiters.remove(entry)
+        heapq.heapify(self.waiters)
+
+    def _log_wait(self, waited, priority):
+        if waited > 1.0:
+            print(f"Method: ProviderLimiter | {self.name} | Waited {waited:.2f}s for a slot, priority {priority}, in flight {self.in_flight}")
+
+    def acquire(self, tokens, priority=PRIORITY_NORMAL, timeout=None):
+        """
+        Blocks until this caller is first in priority order and the buckets and the
+        concurrency cap allow one more request of `tokens` estimated tokens.
+        """
+        start = time.monotonic()
+        entry = (priority, next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    admissible, wait = self._admissible(entry, tokens, now)
+                    if admissible:
+                        break
+                    if timeout is not None and now - start + min(wait, 0.05) > timeout:
+                        raise LimiterTimeout(f"Rate limiter '{self.name}' could not admit the request within {timeout:.1f}s")
+                    # Woken up early by releases, or after the buckets refilled
+                    self.condition.wait(wait if wait > 0 else 1.0)
+                waited = self._admit(tokens, start)
+            except BaseException:
+                self._withdraw(entry)
+                raise
+            finally:
+                self.condition.notify_all()
+        self._log_wait(waited, priority)
+
+    async def async_acquire(self, tokens, priority=PRIORITY_NORMAL, timeout=None):
+        """
+        acquire() for coroutines. It waits with asyncio.sleep instead of holding a
+        worker thread, and takes the slot in the same step as the check, so a
+        cancelled caller (a losing hedge, a timeout) leaves the queue without a slot.
+        """
+        start = time.monotonic()
+        entry = (priority, next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.waiters, entry)
+        try:
+            while True:
+                with self.condition:
+                    now = time.monotonic()
+                    admissible, wait = self._admissible(entry, tokens, now)
+                    if admissible:
+                        waited = self._admit(tokens, start)
+                        self.condition.notify_all()
+                        break
+                if timeout is not None and now - start + min(wait, 0.05) > timeout:
+                    raise LimiterTimeout(f"Rate limiter '{self.name}' could not admit the request within {timeout:.1f}s")
+                # Releases from threads cannot wake the event loop, so poll while only the cap or the queue holds us
+                await asyncio.sleep(wait if wait > 0 else ASYNC_POLL_SECONDS)
+        except BaseException:
+            with self.condition:
+                self._withdraw(entry)
+                self.condition.notify_all()
+            raise
+        self._log_wait(waited, priority)
+
+    def release(self, estimated_tokens=0, used_tokens=None):
+        with self.condition:
+            self.in_flight -= 1
+            if self.tokens is not None and used_tokens is not None:
+                # Correct the estimate with the usage reported by the provider
+                self.tokens.level -= used_tokens - estimated_tokens
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        """
+        Stops admitting requests for `seconds`, e.g. after a 429 with a Retry-After header.
+        """
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.condition.notify_all()
+        print(f"Method: ProviderLimiter | {self.name} | Rate limited by the provider, pausing for {seconds:.1f}s")
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+def _setting(provider, model, name):
+    for key in (f"{provider}.{model}.{name}", f"{provider}.{name}"):
+        if config.has_option('RateLimit', key):
+            return config.getint('RateLimit', key)
+    return DEFAULT_LIMITS.get(provider, FALLBACK_LIMITS)[name]
+
+def get_limiter(provider, model, key_count=1):
+    """
+    Returns the limiter shared by all calls to `model` at `provider`,
+    sized for key_count API keys.
+    """
+    with limiters_lock:
+        limiter = limiters.get((provider, model))
+        if limiter is None:
+            limiter = ProviderLimiter(
+                f"{provider}/{model}",
+                rpm=_setting(provider, model, 'rpm') * key_count,
+                tpm=_setting(provider, model, 'tpm') * key_count,
+                max_concurrency=_setting(provider, model, 'max_concurrency') * key_count,
+            )
+            limiters[(provider, model)] = limiter
+        return limiter
+
+def limiter_stats():
+    with limiters_lock:
+        return {
+            limiter.name: {
+                'requests': limiter.total_requests,
+                'average_wait': limiter.total_wait / limiter.total_requests if limiter.total_requests else 0.0,
+                'in_flight': limiter.in_flight,
+                'queued': len(limiter.waiters),
+            }
+            for limiter in limiters.values()
+        }
+
+def print_limiter_stats():
+    for name, stats in limiter_stats().items():
+        print(f"Method: LLMRateLimit.limiter_stats | {name} | Requests: {stats['requests']}, average wait: {stats['average_wait']:.2f}s, "
+              f"in flight: {stats['in_flight']}, queued: {stats['queued']}")
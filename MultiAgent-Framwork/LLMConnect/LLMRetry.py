@@ -0,0 +1,98 @@
+import asyncio
+import random
+import threading
+import time
+
+# Bounded retries with jittered exponential backoff, shared by every LLM call site.
+# The call layer of LLMCon retries transient provider errors (429, timeouts,
+# connection errors, 5xx) within the call's deadline, and the callers retry
+# answers they cannot parse, e.g.:
+#   importance = LLMRetry.retry_call(
+#       lambda: int(BhrLgcGPTProcess.get_importance(text)),
+#       name='importance', retry_on=(ValueError, TypeError), default=DEFAULT_IMPORTANCE,
+#   )
+# With a default, the call never raises: once the attempts are used up (or on an
+# error that is not retried) the default is returned and counted.
+
+ATTEMPTS = 3
+BASE_DELAY = 0.5
+MAX_DELAY = 8.0
+
+NO_DEFAULT = object()
+
+counters_lock = threading.Lock()
+retry_counters = {}
+
+
+def _count(name, counter):
+    with counters_lock:
+        counts = retry_counters.setdefault(name, {'calls': 0, 'retries': 0, 'failures': 0, 'defaults': 0})
+        counts[counter] += 1
+
+
+def backoff(attempt, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    """
+    Seconds to sleep before retry number `attempt` (1 for the first retry):
+    uniform between 0 and base_delay * 2 ** (attempt - 1), capped at max_delay.
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def _give_up(name, error, default):
+    if default is NO_DEFAULT:
+        _count(name, 'failures')
+        raise error
+    _count(name, 'defaults')
+    print(f"Method: retry_call | {name} | Giving up after: {error}. Using the default {default!r}")
+    return default
+
+
+def retry_call(fn, name='llm', attempts=ATTEMPTS, retry_on=(Exception,), default=NO_DEFAULT,
+               base_delay=BASE_DELAY, max_delay=MAX_DELAY, deadline=None):
+    """
+    Calls fn() up to `attempts` times while it raises one of retry_on.
+    deadline: time.monotonic() value after which no new attempt is started
+    """
+    _count(name, 'calls')
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except retry_on as e:
+            delay = backoff(attempt, base_delay, max_delay)
+            if attempt == attempts or (deadline is not None and time.monotonic() + delay >= deadline):
+                return _give_up(name, e, default)
+            _count(name, 'retries')
+            print(f"Method: retry_call | {name} | Attempt {attempt} failed: {e}. Retrying in {delay:.2f}s")
+            time.sleep(delay)
+        except Exception as e:
+            return _give_up(name, e, default)
+
+
+async def async_retry_call(fn, name='llm', attempts=ATTEMPTS, retry_on=(Exception,), default=NO_DEFAULT,
+                           base_delay=BASE_DELAY, max_delay=MAX_DELAY, deadline=None):
+    """
+    Async counterpart of retry_call; fn is a coroutine function.
+    """
+    _count(name, 'calls')
+    for attempt in range(1, attempts + 1):
+        try:
+            return await fn()
+        except retry_on as e:
+            delay = backoff(attempt, base_delay, max_delay)
+            if attempt == attempts or (deadline is not None and time.monotonic() + delay >= deadline):
+                return _give_up(name, e, default)
+            _count(name, 'retries')
+            print(f"Method: async_retry_call | {name} | Attempt {attempt} failed: {e}. Retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            return _give_up(name, e, default)
+
+
+def retry_stats():
+    with counters_lock:
+        return {name: dict(counts) for name, counts in retry_counters.items()}
+
+def print_retry_stats():
+    for name, stats in retry_stats().items():
+        print(f"Method: LLMRetry.retry_stats | {name} | Calls: {stats['calls']}, retries: {stats['retries']}, "
+              f"failures: {stats['failures']}, defaults used: {stats['defaults']}")